@@ -3,12 +3,13 @@
 from kajiki.loader import FileLoader, MockLoader, PackageLoader
 from kajiki.template import Template
 from kajiki.text import TextTemplate
-from kajiki.util import expose, flattener
+from kajiki.util import expose, flattener, memoize
 from kajiki.xml_template import XMLTemplate
 
 __all__ = [
     "expose",
     "flattener",
+    "memoize",
     "Template",
     "MockLoader",
     "FileLoader",
@@ -1,13 +1,17 @@
-"""Command-line interface to Kajiki to render a single template."""
+"""Command-line interface to Kajiki to render a single template, or a batch of templates."""
 
 import argparse
+import concurrent.futures
 import json
 import os
 import pathlib
 import site
 import sys
+import tempfile
+import time
 
 import kajiki.loader
+import kajiki.profile
 
 try:
     import tomllib
@@ -29,6 +33,110 @@ def _kv_pair(pair):
     return key, value
 
 
+def _load_manifest(path):
+    """Load the list of jobs of a batch manifest.
+
+    The manifest is a JSON list of jobs, or a JSON or TOML document
+    with a ``jobs`` list.  Each job is a table with the ``template``
+    to render, the ``output`` file to write and optionally the
+    ``variables`` of the template.
+    """
+    if path.suffix == ".toml":
+        if not _TOML_AVAILABLE:
+            msg = "TOML manifests require Python 3.11 or newer"
+            raise ValueError(msg)
+        with path.open("rb") as f:
+            manifest = tomllib.load(f)
+    else:
+        with path.open("r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    jobs = manifest.get("jobs") if isinstance(manifest, dict) else manifest
+    if not isinstance(jobs, list):
+        msg = f"{path}: expected a list of jobs"
+        raise ValueError(msg)  # noqa: TRY004
+    for i, job in enumerate(jobs):
+        if not isinstance(job, dict) or "template" not in job or "output" not in job:
+            msg = f"{path}: job {i} must have a template and an output"
+            raise ValueError(msg)
+    return jobs
+
+
+_batch_loader = None
+
+
+def _init_batch_worker(loader_type, loader_kwargs, site_dirs):
+    global _batch_loader  # noqa: PLW0603
+    for path in site_dirs:
+        site.addsitedir(path)
+    _batch_loader = loader_type(**loader_kwargs)
+
+
+def _render_job(template, variables, output):
+    """Render a batch job in a worker, return the time it took."""
+    start = time.perf_counter()
+    tpl = _batch_loader.import_(template)(variables)
+    output = pathlib.Path(output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with output.open("w", encoding="utf-8") as f:
+        tpl.render_to(f)
+    return time.perf_counter() - start
+
+
+def _run_batch(opts, jobs, loader_kwargs, template_variables):
+    """Render the batch ``jobs``.
+
+    Each template is compiled once, by this process, into the cache
+    directory the worker processes load it from.  The time spent on
+    each template and job is reported on stderr, as are the jobs that
+    failed, whose number is returned.
+    """
+    loader_type = opts.loader_type
+    site_dirs = opts.paths if loader_type is kajiki.loader.PackageLoader else []
+    errors = {}
+    with tempfile.TemporaryDirectory(prefix="kajiki-") as tmp_dir:
+        loader_kwargs = dict(loader_kwargs, cache_dir=opts.cache_dir or tmp_dir)
+        loader = loader_type(**loader_kwargs)
+        for template in dict.fromkeys(job["template"] for job in jobs):
+            start = time.perf_counter()
+            try:
+                loader.dependencies(template)
+            except Exception as e:  # noqa: BLE001
+                errors[template] = e
+                continue
+            sys.stderr.write(f"compiled {template} in {time.perf_counter() - start:.3f}s\n")
+
+        with concurrent.futures.ProcessPoolExecutor(
+            opts.jobs,
+            initializer=_init_batch_worker,
+            initargs=(loader_type, loader_kwargs, site_dirs),
+        ) as executor:
+            futures = [
+                None
+                if job["template"] in errors
+                else executor.submit(
+                    _render_job,
+                    job["template"],
+                    dict(template_variables, **job.get("variables", {})),
+                    job["output"],
+                )
+                for job in jobs
+            ]
+            failed = 0
+            for job, future in zip(jobs, futures):
+                error = errors.get(job["template"])
+                if error is None:
+                    try:
+                        seconds = future.result()
+                    except Exception as e:  # noqa: BLE001
+                        error = e
+                if error is None:
+                    sys.stderr.write(f"rendered {job['output']} in {seconds:.3f}s\n")
+                else:
+                    failed += 1
+                    sys.stderr.write(f"{job['template']} -> {job['output']}: {type(error).__name__}: {error}\n")
+    return failed
+
+
 def main(argv=None):
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument(
@@ -84,8 +192,32 @@ def main(argv=None):
         default=kajiki.loader.FileLoader,
         help="Load based on package name instead of file path.",
     )
+    parser.add_argument(
+        "--batch",
+        type=pathlib.Path,
+        metavar="MANIFEST",
+        help="Render the jobs listed in a JSON or TOML manifest instead of a single template.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="Number of processes rendering the batch jobs.  Defaults to the number of CPUs.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="Directory caching the compiled templates of a batch.  Defaults to a temporary directory.",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="FILE",
+        type=pathlib.Path,
+        help="Profile the render, writing a report of the slowest template lines to stderr "
+        "and the collapsed stacks of the render, for flame graph tools, to FILE.",
+    )
     parser.add_argument(
         "file_or_package",
+        nargs="?",
         help="Filename or package to load.",
     )
     parser.add_argument(
@@ -97,11 +229,19 @@ def main(argv=None):
     )
 
     opts = parser.parse_args(argv)
+    if opts.batch and opts.file_or_package is not None:
+        parser.error("file_or_package and output_file can't be used with --batch")
+    if (opts.batch is None) == (opts.file_or_package is None):
+        parser.error("either a file_or_package or a --batch manifest is required")
+    if opts.batch and opts.profile:
+        parser.error("--profile can't be used with --batch")
 
     loader_kwargs = {}
     if opts.loader_type is kajiki.loader.PackageLoader:
         for path in opts.paths:
             site.addsitedir(path)
+    elif opts.batch:
+        loader_kwargs["path"] = [*opts.paths, "."]
     else:
         opts.paths.append(os.path.dirname(opts.file_or_package) or ".")
         loader_kwargs["path"] = opts.paths
@@ -118,10 +258,27 @@ def main(argv=None):
 
     template_variables.update(dict(opts.template_variables))
 
+    if opts.batch:
+        try:
+            jobs = _load_manifest(opts.batch)
+        except ValueError as e:
+            parser.error(str(e))
+        failed = _run_batch(opts, jobs, dict(loader_kwargs, force_mode=opts.force_mode), template_variables)
+        if failed:
+            parser.exit(1, f"{failed} of {len(jobs)} batch jobs failed\n")
+        return
+
     loader = opts.loader_type(force_mode=opts.force_mode, **loader_kwargs)
     template = loader.import_(opts.file_or_package)
-    result = template(template_variables).render()
-    opts.output_file.write(result)
+    if opts.profile:
+        instance = template(template_variables)
+        with kajiki.profile.Profiler() as profiler:
+            instance.render_to(opts.output_file)
+        sys.stderr.write(profiler.report())
+        with opts.profile.open("w", encoding="utf-8") as f:
+            profiler.write_collapsed(f)
+    else:
+        template(template_variables).render_to(opts.output_file)
 
     # Close the output file to avoid a ResourceWarning during unit
     # tests on Python 3.4+.  But don't close stdout, just flush it
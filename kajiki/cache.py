@@ -0,0 +1,127 @@
+"""Backends storing the output of ``py:cache`` fragments.
+
+A backend is any object with the two methods:
+
+* ``get(key)`` - returns the string stored for ``key``, or ``None``
+  when there is none or it expired.
+* ``set(key, value, ttl=None)`` - stores the string ``value`` for ``key``,
+  for ``ttl`` seconds, or for the default time to live of the backend
+  when ``ttl`` is ``None``.
+
+Keys are ``(fragment, key)`` tuples, where ``fragment`` identifies the
+``py:cache`` directive in its template and ``key`` is the value of its
+key expression.
+
+Templates use :data:`default_cache` unless they are compiled with
+another ``fragment_cache``.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+
+class LRUCache:
+    """Cache fragments in memory, evicting the least recently used first.
+
+    At most ``maxsize`` fragments are kept, each one for ``ttl`` seconds
+    unless the directive gives another time to live, or forever when
+    ``ttl`` is ``None``. It's safe to share between threads.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._timer = timer
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires <= self._timer():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = None if ttl is None else self._timer() + ttl
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class FileCache:
+    """Cache fragments in files of ``directory``, shared between processes.
+
+    Each fragment is stored in a file named after the hash of the
+    ``repr()`` of its key, so keys should be made of values with a stable
+    representation such as strings, numbers and tuples of them.
+    Expired fragments are removed when they are looked up.
+    """
+
+    def __init__(self, directory, ttl=None, timer=time.time):
+        self.directory = Path(directory)
+        self.ttl = ttl
+        self._timer = timer
+
+    def _path(self, key):
+        return self.directory / (hashlib.sha256(repr(key).encode("utf-8")).hexdigest() + ".kjf")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            expires, _, value = path.read_bytes().decode("utf-8").partition("\n")
+            expires = float(expires) if expires else None
+        except (OSError, ValueError):
+            return None
+        if expires is not None and expires <= self._timer():
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        """Store the fragment, failing to write it is not an error."""
+        if ttl is None:
+            ttl = self.ttl
+        expires = "" if ttl is None else repr(self._timer() + ttl)
+        path = self._path(key)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            tmp_path.write_bytes(f"{expires}\n{value}".encode())
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+
+    def clear(self):
+        for path in self.directory.glob("*.kjf"):
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+
+# The backend of templates not given a ``fragment_cache``.
+default_cache = LRUCache()
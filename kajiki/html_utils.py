@@ -12,3 +12,38 @@ HTML_EMPTY_ATTRS = {
 HTML_OPTIONAL_END_TAGS = {"area", "base", "br", "col", "hr", "img", "input", "link", "meta", "param"}
 HTML_REQUIRED_END_TAGS = {"script"}
 HTML_CDATA_TAGS = {"script", "style"}
+
+
+def escape_html(text):
+    """Encode ampersands, angle brackets and double quotes in ``text``.
+
+    The single quote is not escaped as all HTML attributes are
+    double-quoted in Kajiki output.
+    """
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
+
+
+_escape_cache = {}
+_ESCAPE_CACHE_SIZE = 1024
+_ESCAPE_CACHE_MAX_LEN = 64
+
+
+def escape_html_cached(text):
+    """Same as :func:`escape_html`, optimized for template output.
+
+    Text without any character to escape is returned as is, and
+    the result for short strings is cached as the same values
+    (names, labels, CSS classes...) tend to be rendered over and over.
+    """
+    escaped = _escape_cache.get(text)
+    if escaped is not None:
+        return escaped
+    if "&" in text or "<" in text or ">" in text or '"' in text:
+        escaped = escape_html(text)
+    else:
+        escaped = text
+    if len(text) <= _ESCAPE_CACHE_MAX_LEN:
+        if len(_escape_cache) >= _ESCAPE_CACHE_SIZE:
+            _escape_cache.clear()
+        _escape_cache[text] = escaped
+    return escaped
@@ -1,7 +1,7 @@
 from io import BytesIO
 from tokenize import TokenError
 
-from kajiki.ir import ExprNode, TranslatableTextNode
+from kajiki.ir import AttrNode, ExprNode, TranslatableTextNode
 
 
 def gettext(s):
@@ -33,7 +33,7 @@ def extract(fileobj, keywords, comment_tags, options):
         is_fragment=options.get("is_fragment", False),
     )
     ir = compiler.compile()
-    for node in ir:
+    for node in _expand_inline_attrs(ir):
         if isinstance(node, TranslatableTextNode):
             if node.text.strip():
                 yield (node.lineno, "_", node.text, [])
@@ -43,3 +43,12 @@ def extract(fileobj, keywords, comment_tags, options):
                     yield (node.lineno, e[1], e[2], e[3])
             except (TokenError, SyntaxError) as e:
                 raise KajikiSyntaxError(e, source, "<string>", node.lineno, 0) from e
+
+
+def _expand_inline_attrs(ir):
+    """Iterate over the nodes of ``ir`` and the parts of inline attributes."""
+    for node in ir:
+        if isinstance(node, AttrNode.InlineAttr):
+            yield from node.parts
+        else:
+            yield node
@@ -1,17 +1,43 @@
+import ast
 import re
 from itertools import chain
 
+from kajiki.html_utils import HTML_EMPTY_ATTRS, escape_html
 from kajiki.util import default_alias_for, flattener, gen_name, window
 
+# Statements emitting the output of template functions, as generators
+# and in accumulator mode.
+YIELD = "yield {}"
+APPEND = "_kj_out.append({})"
 
-def generate_python(ir):
+
+def generate_python(ir, is_async=False, accumulate=False):  # noqa: FBT002
+    """Generate the lines of Python code for the ``ir`` tree.
+
+    When ``is_async`` is true the template functions are generated
+    as asynchronous generators, which allows ``await`` and ``async for``
+    inside the template.
+
+    When ``accumulate`` is true the template functions are generated as
+    plain functions appending their output to a ``_kj_out`` list instead
+    of yielding it, which avoids resuming a generator for each fragment.
+    """
+    if is_async and accumulate:
+        msg = "Asynchronous templates can't be generated in accumulator mode"
+        raise ValueError(msg)
     cur_indent = 0
     for node in flattener(ir):
         if isinstance(node, IndentNode):
             cur_indent += 4
         elif isinstance(node, DedentNode):
             cur_indent -= 4
-        for line in node.py():
+        if is_async:
+            lines = node.py_async()
+        elif accumulate:
+            lines = node.py_accumulate()
+        else:
+            lines = node.py()
+        for line in lines:
             if isinstance(line, IndentNode):
                 cur_indent += 4
             elif isinstance(line, DedentNode):
@@ -21,6 +47,10 @@ def generate_python(ir):
 
 
 class Node:
+    # Names of the helpers of ``__kj__`` the code of the node calls,
+    # bound to local variables at the start of template functions.
+    helpers = ()
+
     def __init__(self):
         self.filename = "<string>"
         self.lineno = 0
@@ -28,6 +58,14 @@ class Node:
     def py(self):  # pragma no cover
         return []
 
+    def py_async(self):
+        """Python code of the node when generating an asynchronous template."""
+        return self.py()
+
+    def py_accumulate(self):
+        """Python code of the node when generating in accumulator mode."""
+        return self.py()
+
     def __iter__(self):
         yield self
 
@@ -40,6 +78,23 @@ class PassNode(Node):
         # 'pass' would result in: TypeError: 'NoneType' object is not iterable
         yield self.line('yield ""')
 
+    def py_accumulate(self):
+        yield self.line("pass")
+
+
+class OutputStartNode(Node):
+    """Creates the output list of a function in accumulator mode."""
+
+    def py_accumulate(self):
+        yield self.line("_kj_out = []")
+
+
+class OutputEndNode(Node):
+    """Returns the output list of a function in accumulator mode."""
+
+    def py_accumulate(self):
+        yield self.line("return iter(_kj_out)")
+
 
 class HierNode(Node):
     """Base for nodes that contain an indented Python block (def, for, if etc.)"""
@@ -51,13 +106,62 @@ class HierNode(Node):
     def body_iter(self):
         yield from optimize(flattener(map(flattener, self.body)))
 
+    def block_iter(self):
+        """Iterate over the body, which can't be empty in an indented block."""
+        is_empty = True
+        for x in self.body_iter():
+            yield x
+            is_empty = False
+        if is_empty:  # In Python, a block without a body is a SyntaxError.
+            yield PassNode()
+
     def __iter__(self):
         yield self
         yield IndentNode()
-        yield from self.body_iter()
+        yield from self.block_iter()
+        yield DedentNode()
+
+    def function_iter(self):
+        """Iterate over the node as a function producing output."""
+        body = list(self.block_iter())
+        helpers = sorted({name for node in body for name in node.helpers})
+        yield self
+        yield IndentNode()
+        yield OutputStartNode()
+        if helpers:
+            yield HelpersNode(helpers, self)
+        yield from body
+        yield OutputEndNode()
         yield DedentNode()
 
 
+class HelpersNode(Node):
+    """Binds the helpers used by a template function to local variables.
+
+    Each helper is then looked up once per call of the function instead
+    of once per use, nested functions use them from the closure.
+    """
+
+    def __init__(self, names, parent):
+        super().__init__()
+        self.names = names
+        self.filename = parent.filename
+        self.lineno = parent.lineno
+
+    def py(self):
+        for name in self.names:
+            yield self.line(f"{helper(name)} = {HELPER_SCOPES.get(name, 'self')}.__kj__.{name}")
+
+
+# Template instance the helpers are looked up on when it isn't ``self``.
+HELPER_SCOPES = {"gettext": "local"}
+
+
+def helper(name):
+    """Name of the local variable bound to the helper ``name``."""
+    return f"_kj_{name}"
+
+
 class IndentNode(Node):
     pass
 
@@ -76,19 +180,24 @@ class TemplateNode(HierNode):
     The generated class will then be passed to :meth:`kajiki.template.Template` to
     create a :class:`kajiki.template._Template` subclass that has the
     ``render`` method to render the template.
+
+    ``dependencies`` lists the ``(kind, name)`` pairs of the templates
+    the template extends, imports or includes, where ``kind`` is one of
+    ``"extends"``, ``"import"`` and ``"include"``.
     """
 
     class TemplateTail(Node):
         def py(self):
             yield self.line("template = kajiki.Template(template)")
 
-    def __init__(self, mod_py=None, defs=None):
+    def __init__(self, mod_py=None, defs=None, dependencies=None):
         super().__init__(defs)
         if mod_py is None:
             mod_py = []
         if defs is None:
             defs = []
         self.mod_py = [x for x in mod_py if x is not None]
+        self.dependencies = list(dependencies or ())
 
     def py(self):
         yield self.line("class template:")
@@ -118,8 +227,11 @@ class IncludeNode(Node):
         super().__init__()
         self.tpl_name = tpl_name
 
-    def py(self):
-        yield self.line(f"yield local.__kj__.import_({self.tpl_name!r}, None, self.__globals__).__main__()")
+    def py(self, out=YIELD):
+        yield self.line(out.format(f"local.__kj__.import_({self.tpl_name!r}, None, self.__globals__).__main__()"))
+
+    def py_accumulate(self):
+        return self.py(out=APPEND)
 
 
 class ExtendNode(Node):
@@ -127,31 +239,32 @@ class ExtendNode(Node):
         super().__init__()
         self.tpl_name = tpl_name
 
-    def py(self):
-        yield self.line(f"yield local.__kj__.extend({self.tpl_name!r}).__main__()")
+    def py(self, out=YIELD):
+        yield self.line(out.format(f"local.__kj__.extend({self.tpl_name!r}).__main__()"))
+
+    def py_accumulate(self):
+        return self.py(out=APPEND)
 
 
 class DefNode(HierNode):
     prefix = "@kajiki.expose"
 
-    def __init__(self, decl, *body):
+    def __init__(self, decl, *body, memoize=None):
         super().__init__(body)
         self.decl = decl
+        self.memoize = memoize
 
-    def py(self):
+    def py(self, def_="def"):
         yield self.line(self.prefix)
-        yield self.line(f"def {self.decl}:")
+        if self.memoize:
+            yield self.line(f"@kajiki.memoize({self.memoize!r})")
+        yield self.line(f"{def_} {self.decl}:")
+
+    def py_async(self):
+        return self.py(def_="async def")
 
     def __iter__(self):
-        yield self
-        yield IndentNode()
-        is_empty = True
-        for x in self.body_iter():
-            yield x
-            is_empty = False
-        if is_empty:  # In Python, a function without a body is a SyntaxError.
-            yield PassNode()  # Prevent creation of a function without a body
-        yield DedentNode()
+        return self.function_iter()
 
 
 class InnerDefNode(DefNode):
@@ -164,8 +277,11 @@ class CallNode(HierNode):
             super().__init__()
             self.call = call
 
-        def py(self):
-            yield self.line("yield " + self.call)
+        def py(self, out=YIELD):
+            yield self.line(out.format(self.call))
+
+        def py_accumulate(self):
+            return self.py(out=APPEND)
 
     def __init__(self, caller, callee, *body):
         super().__init__(body)
@@ -177,12 +293,75 @@ class CallNode(HierNode):
         yield self.line("@__kj__.flattener.decorate")
         yield self.line(f"def {self.decl}:")
 
+    def py_async(self):
+        yield self.line("@__kj__.flattener.decorate")
+        yield self.line(f"async def {self.decl}:")
+
+    def __iter__(self):
+        yield from self.function_iter()
+        yield self.CallTail(self.call)
+
+
+class CacheNode(HierNode):
+    """Node rendering its body only when its output isn't cached.
+
+    The output is looked up in the fragment cache of the template by
+    ``fragment_id``, identifying the node, and the value of the ``key``
+    expression. Otherwise the body is rendered by a nested function
+    and its output stored for ``ttl`` seconds (an expression too).
+    """
+
+    class CacheFunction(HierNode):
+        def __init__(self, parent, body):
+            super().__init__(body)
+            self.p = parent
+            self.filename = parent.filename
+            self.lineno = parent.lineno
+
+        def py(self):
+            yield self.line(f"def {self.p.fname}():")
+
+        def py_async(self):
+            yield self.line(f"async def {self.p.fname}():")
+
+    class CacheTail(Node):
+        def __init__(self, parent):
+            super().__init__()
+            self.p = parent
+            self.filename = parent.filename
+            self.lineno = parent.lineno
+
+        def py(self, collect="self.__kj__.collect", out=YIELD):
+            p = self.p
+            rendered = f"{collect}({p.fname}())"
+            yield self.line(f"{p.var} = self.__kj__.cache_store({p.fragment_id!r}, {p.var}_key, {p.ttl}, {rendered})")
+            yield DedentNode()
+            yield self.line(out.format(p.var))
+
+        def py_async(self):
+            return self.py(collect="await self.__kj__.collect_async")
+
+        def py_accumulate(self):
+            return self.py(out=APPEND)
+
+    def __init__(self, fragment_id, key, ttl, *body):
+        super().__init__(body)
+        self.fragment_id = fragment_id
+        self.key = key
+        self.ttl = ttl or "None"
+        self.var = gen_name()
+        self.fname = gen_name()
+
+    def py(self):
+        yield self.line(f"{self.var}_key = ({self.key})")
+        yield self.line(f"{self.var} = self.__kj__.cache_lookup({self.fragment_id!r}, {self.var}_key)")
+        yield self.line(f"if {self.var} is None:")
+
     def __iter__(self):
         yield self
         yield IndentNode()
-        yield from self.body_iter()
-        yield DedentNode()
-        yield self.CallTail(self.call)
+        yield from self.CacheFunction(self, self.body).function_iter()
+        yield self.CacheTail(self)
 
 
 class ForNode(HierNode):
@@ -191,7 +370,12 @@ class ForNode(HierNode):
         self.decl = decl
 
     def py(self):
-        yield self.line(f"for {self.decl}:")
+        decl = self.decl.lstrip()
+        if decl.startswith("async "):
+            # py:for="async x in items" iterates over an asynchronous iterable.
+            yield self.line(f"async for {decl[6:].lstrip()}:")
+        else:
+            yield self.line(f"for {self.decl}:")
 
 
 class WithNode(HierNode):
@@ -287,7 +471,7 @@ class MatchCaseNode(HierNode):
 
     def __iter__(self):
         yield self
-        yield from self.body_iter()
+        yield from self.block_iter()
         yield DedentNode()
 
 
@@ -316,18 +500,29 @@ class TextNode(Node):
         self.text = text
         self.guard = guard
 
-    def py(self):
-        s = f"yield {self.text!r}"
+    def __iter__(self):
+        if self.guard != NEVER:
+            yield self
+
+    def py(self, out=YIELD):
+        s = out.format(repr(self.text))
         if self.guard:
             yield self.line(f"if {self.guard}: {s}")
         else:
             yield self.line(s)
 
+    def py_accumulate(self):
+        return self.py(out=APPEND)
+
 
 class TranslatableTextNode(TextNode):
-    def py(self):
+    @property
+    def helpers(self):
+        return ("gettext",) if self.text.strip() else ()
+
+    def py(self, out=YIELD):
         text = self.text.strip()
-        s = f"yield local.__kj__.gettext({self.text!r})" if text else f"yield {self.text!r}"
+        s = out.format(f"{helper('gettext')}({self.text!r})" if text else repr(self.text))
         if self.guard:
             yield self.line(f"if {self.guard}: {s}")
         else:
@@ -337,34 +532,117 @@ class TranslatableTextNode(TextNode):
 class ExprNode(Node):
     """Node that contains a Python expression to be evaluated when the template
     is executed.
+
+    Expressions made of a number literal are rendered at compile time.
     """
 
+    _re_number = re.compile(r"\s*-?\.?[0-9]")
+
     def __init__(self, text, safe=False):  # noqa: FBT002
         super().__init__()
         self.text = text
         self.safe = safe
 
-    def py(self):
+    @property
+    def helpers(self):
+        return () if self.safe else ("escape",)
+
+    def number_literal(self):
+        """Return the value of the expression if it's a number literal."""
+        if not self._re_number.match(self.text):
+            return None
+        try:
+            value = ast.literal_eval(self.text.strip())
+        except (ValueError, SyntaxError):
+            return None
+        return value if type(value) in (int, float) else None
+
+    def __iter__(self):
+        value = self.number_literal()
+        if value is None:
+            yield self
+            return
+        node = TextNode(str(value))
+        node.filename = self.filename
+        node.lineno = self.lineno
+        yield node
+
+    def py(self, out=YIELD):
         if self.safe:
-            yield self.line(f"yield {self.text}")
+            yield self.line(out.format(self.text))
         else:
-            yield self.line(f"yield self.__kj__.escape({self.text})")
+            yield self.line(out.format(f"{helper('escape')}({self.text})"))
+
+    def py_accumulate(self):
+        return self.py(out=APPEND)
 
 
 class AttrNode(HierNode):
     """Node that renders HTML/XML attributes."""
 
     class AttrTail(Node):
+        """Renders the value collected from the generator of the attribute."""
+
         def __init__(self, parent):
             super().__init__()
             self.p = parent
 
-        def py(self):
+        @property
+        def helpers(self):
+            return () if self.p.is_html_empty() else ("escape_attr",)
+
+        def py(self, collect="self.__kj__.collect", out=YIELD):
             gen = self.p.genname
-            x = gen_name()
-            yield self.line(f"{gen} = self.__kj__.collect({gen}())")
-            yield self.line(f"for {x} in self.__kj__.render_attrs({{{self.p.attr!r}:{gen}}}, {self.p.mode!r}):")
-            yield self.line(f"    yield {x}")
+            yield self.line(f"{gen} = {collect}({gen}())")
+            yield self.line(self.p.render_value(gen, out))
+
+        def py_async(self):
+            return self.py(collect="await self.__kj__.collect_async")
+
+        def py_accumulate(self):
+            return self.py(out=APPEND)
+
+    class InlineAttr(Node):
+        """Renders an attribute made of text and expressions without
+        nested generators, see :meth:`AttrNode.inline_parts`.
+        """
+
+        def __init__(self, parent, parts):
+            super().__init__()
+            self.p = parent
+            self.parts = parts
+            self.filename = parent.filename
+            self.lineno = parent.lineno
+
+        @property
+        def helpers(self):
+            if len(self.parts) == 1 and self.p.is_html_empty():
+                return ()
+            return ("escape_attr",)
+
+        def py(self, out=YIELD):
+            attr = self.p.attr
+            if len(self.parts) == 1:
+                # A single expression, the attribute is omitted when it's None.
+                x = gen_name()
+                yield self.line(f"{x} = {self.parts[0].text}")
+                yield self.line(self.p.render_value(x, out))
+                return
+            code = []
+            text = f' {attr}="'
+            for part in self.parts:
+                if type(part) == TextNode:
+                    text += escape_html(part.text)
+                    continue
+                if text:
+                    code.append(repr(text))
+                code.append(f"{helper('escape_attr')}({part.text})")
+                text = ""
+            code.append(repr(text + '"'))
+            yield self.line(out.format(" + ".join(code)))
+
+        def py_accumulate(self):
+            return self.py(out=APPEND)
 
     def __init__(self, attr, value, guard=None, mode="xml"):
         super().__init__(value)
@@ -376,33 +654,115 @@ class AttrNode(HierNode):
     def py(self):
         yield self.line(f"def {self.genname}():")
 
+    def py_async(self):
+        yield self.line(f"async def {self.genname}():")
+
+    def is_html_empty(self):
+        """Whether the attribute is rendered without value, like ``checked``."""
+        return self.mode.startswith("html") and self.attr in HTML_EMPTY_ATTRS
+
+    def render_value(self, x, out):
+        """Code rendering the attribute with the value of the variable ``x``.
+
+        The attribute is omitted when the value is ``None``.
+        """
+        if self.is_html_empty():
+            value = repr(" " + self.attr.lower())
+        else:
+            start = f' {self.attr}="'
+            value = f"{start!r} + {helper('escape_attr')}({x}) + '\"'"
+        return f"if {x} is not None: " + out.format(value)
+
+    def static_text(self):
+        """Return the rendered attribute when its value is constant.
+
+        If the value contains any expression ``None`` is returned
+        and the attribute has to be rendered at runtime.
+        """
+        if not all(type(x) == TextNode and not x.guard for x in self.body):
+            return None
+        if self.is_html_empty():
+            return " " + self.attr.lower()
+        value = "".join(x.text for x in self.body)
+        return f' {self.attr}="{escape_html(value)}"'
+
+    def inline_parts(self):
+        """Return the parts of the value if it can be rendered inline.
+
+        That's the case of a single expression or of text concatenated
+        with expressions, which don't need the value to be collected
+        by a nested generator. Otherwise ``None`` is returned.
+        """
+        if not all(type(x) in (TextNode, ExprNode) and not getattr(x, "guard", None) for x in self.body):
+            return None
+        n_exprs = sum(type(x) == ExprNode for x in self.body)
+        if n_exprs == 1 and len(self.body) == 1:
+            return self.body
+        if self.is_html_empty():
+            return None
+        if n_exprs == len(self.body):
+            # Omitted only when all the expressions are None.
+            return None
+        return self.body
+
     def __iter__(self):
-        if self.guard:
+        if self.guard == NEVER:
+            return
+        text = self.static_text()
+        if text is not None:
+            # Folded into a plain TextNode, so that optimize() can merge it
+            # with the text of the tag around it.
+            node = TextNode(text, self.guard)
+            node.filename = self.filename
+            node.lineno = self.lineno
+            yield node
+        elif self.guard:
             new_body = IfNode(self.guard, AttrNode(self.attr, value=self.body, mode=self.mode))
             yield from new_body
+        elif self.inline_parts() is not None:
+            yield self.InlineAttr(self, self.inline_parts())
         else:
             yield self
             yield IndentNode()
+            yield OutputStartNode()
             if self.body:
                 yield from self.body_iter()
             else:
                 yield TextNode("")
+            yield OutputEndNode()
             yield DedentNode()
             yield self.AttrTail(self)
 
 
 class AttrsNode(Node):
-    def __init__(self, attrs, guard=None, mode="xml"):
+    """Node that renders the attributes of a ``py:attrs`` expression.
+
+    Unless ``sort`` is false they are rendered in alphabetical order,
+    otherwise in the order of the mapping or sequence of pairs.
+    """
+
+    helpers = ("render_attrs",)
+
+    def __init__(self, attrs, guard=None, mode="xml", sort=True):  # noqa: FBT002
         super().__init__()
         self.attrs = attrs
         self.guard = guard
         self.mode = mode
+        self.sort = sort
 
-    def py(self):
+    def __iter__(self):
+        if self.guard != NEVER:
+            yield self
+
+    def py(self, accumulate=False):  # noqa: FBT002
         x = gen_name()
+        args = f"{self.attrs}, {self.mode!r}" if self.sort else f"{self.attrs}, {self.mode!r}, False"
 
         def _body():
-            yield self.line(f"for {x} in self.__kj__.render_attrs({self.attrs}, {self.mode!r}):")
+            if accumulate:
+                yield self.line(f"_kj_out.extend({helper('render_attrs')}({args}))")
+                return
+            yield self.line(f"for {x} in {helper('render_attrs')}({args}):")
             yield self.line(f"    yield {x}")
 
         if self.guard:
@@ -413,6 +773,9 @@ class AttrsNode(Node):
             for line in _body():
                 yield line
 
+    def py_accumulate(self):
+        return self.py(accumulate=True)
+
 
 class PythonNode(Node):
     def __init__(self, *body):
@@ -444,7 +807,16 @@ class PythonNode(Node):
             yield line[len(prefix) :]
 
 
+# Guard of nodes which are never rendered, such as the tag of py:strip="".
+NEVER = "False"
+
+
 def optimize(iter_node):
+    """Merge consecutive :class:`TextNode` with the same guard.
+
+    Each merged node saves a ``yield`` and a generator resumption
+    when the template is rendered.
+    """
     last_node = None
     for node in iter_node:
         if type(node) == TextNode and type(last_node) == TextNode and last_node.guard == node.guard:
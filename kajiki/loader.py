@@ -1,7 +1,14 @@
 from __future__ import annotations
 
+import concurrent.futures
+import fnmatch
+import functools
+import hashlib
+import marshal
 import os
 import sys
+import threading
+import time
 from pathlib import Path
 
 if sys.version_info < (3, 9):
@@ -11,24 +18,178 @@ else:
 
 from kajiki.util import default_alias_for
 
+try:
+    from importlib.metadata import PackageNotFoundError, version
+except ImportError:  # pragma no cover
+    _KAJIKI_VERSION = "unknown"
+else:
+    try:
+        _KAJIKI_VERSION = version("kajiki")
+    except PackageNotFoundError:
+        _KAJIKI_VERSION = "unknown"
+
+
+@functools.lru_cache(maxsize=None)
+def _compiler_fingerprint():
+    """Identify the code compiling templates in the cache keys.
+
+    This is the kajiki version and a hash of the modules of kajiki, so
+    that the cache is not reused after changing them in a development
+    checkout, where the version stays the same.
+    """
+    digest = hashlib.sha256(_KAJIKI_VERSION.encode("utf-8"))
+    for path in sorted(Path(__file__).parent.glob("*.py")):
+        try:
+            digest.update(path.name.encode("utf-8") + b"\0" + path.read_bytes())
+        except OSError:
+            pass
+    return digest.hexdigest()
+
+
+def _callable_id(func):
+    """Identify the compile callable ``func`` the same way in every process.
+
+    Functions are identified by their name, where they are defined, their
+    defaults and the values they close over, partials by their function
+    and arguments. ``None`` is returned when ``func`` can't be identified,
+    for instance when it closes over an object without a stable repr.
+    """
+    if isinstance(func, functools.partial):
+        parts = [_callable_id(func.func)]
+        parts.extend(_value_id(arg) for arg in func.args)
+        parts.extend(_value_id(item) for item in sorted(func.keywords.items()))
+        return None if None in parts else f"partial({', '.join(parts)})"
+    name = getattr(func, "__qualname__", None)
+    if name is None:
+        return None
+    func_id = f"{getattr(func, '__module__', '')}.{name}"
+    code = getattr(func, "__code__", None)
+    if code is None:
+        return func_id
+    try:
+        cells = tuple(cell.cell_contents for cell in func.__closure__ or ())
+    except ValueError:  # An empty cell.
+        return None
+    values = _value_id((func.__defaults__, func.__kwdefaults__, cells))
+    if values is None:
+        return None
+    return f"{func_id}@{code.co_filename}:{code.co_firstlineno}{values}"
+
+
+def _value_id(value):
+    """The repr of ``value`` if it's the same in every process, else ``None``."""
+    if value is None or type(value) in (bool, int, float, str, bytes):
+        return repr(value)
+    if type(value) is tuple:
+        parts = [_value_id(item) for item in value]
+        return None if None in parts else f"({', '.join(parts)})"
+    if type(value) is dict:
+        return _value_id(tuple(sorted(value.items())))
+    if callable(value):
+        return _callable_id(value)
+    return None
+
 
 class Loader:
     def __init__(self, reload=False):  # noqa: FBT002
         self._reload = reload
         self.modules = {}
+        self._locks_lock = threading.Lock()
+        self._compile_locks = {}
+        self._dependents = {}
 
     def import_(self, name, **kwargs):
         """Returns the template if it is already in the cache,
         else loads the template, caches it and returns it.
+
+        The loader can be shared between threads: a template is
+        compiled by one thread at a time, and threads waiting for it
+        use the template compiled in the meantime instead of compiling
+        it again.
         """
         mod = self.modules.get(name)
-        if not self._reload and mod:
+        if mod and not self._is_stale(name):
             return mod
-        mod = self._load(name, **kwargs)
-        mod.loader = self
-        self.modules[name] = mod
+        with self._compile_lock(name):
+            current = self.modules.get(name)
+            if current and (current is not mod or not self._is_stale(name)):
+                # Compiled by another thread while we were waiting.
+                return current
+            mod = self._load(name, **kwargs)
+            mod.loader = self
+            self._track_dependencies(name, mod, self.modules.get(name))
+            self.modules[name] = mod
         return mod
 
+    def _track_dependencies(self, name, mod, previous=None):
+        """Update the reverse-dependency graph for the template ``name``."""
+        with self._locks_lock:
+            for _, dep in getattr(previous, "dependencies", ()):
+                self._dependents.get(dep, set()).discard(name)
+            for _, dep in getattr(mod, "dependencies", ()):
+                self._dependents.setdefault(dep, set()).add(name)
+
+    def dependencies(self, name):
+        """Return the names of all the templates ``name`` depends on.
+
+        These are the templates it extends, imports or includes, the
+        templates those depend on and so on, in the order they are
+        found.  All of them are loaded, which allows to preload the
+        whole closure of a page template before rendering it.
+        """
+        found = []
+        seen = {name}
+        pending = [(name, {})]
+        while pending:
+            current, kwargs = pending.pop(0)
+            for kind, dep in self.import_(current, **kwargs).dependencies:
+                if dep in seen:
+                    continue
+                seen.add(dep)
+                found.append(dep)
+                # Load them the way they are loaded while rendering.
+                pending.append((dep, {} if kind == "extends" else {"is_fragment": True}))
+        return found
+
+    def dependents(self, name):
+        """Return the names of the loaded templates depending on ``name``.
+
+        This is the reverse of :meth:`dependencies`: the loaded templates
+        extending, importing or including ``name``, directly or not.
+        """
+        found = []
+        seen = {name}
+        pending = [name]
+        with self._locks_lock:
+            while pending:
+                for dep in sorted(self._dependents.get(pending.pop(0), ())):
+                    if dep not in seen:
+                        seen.add(dep)
+                        found.append(dep)
+                        pending.append(dep)
+        return found
+
+    def invalidate(self, name):
+        """Drop ``name`` and the templates depending on it from the cache.
+
+        They are loaded again the next time they are imported.
+        """
+        for dep in [name, *self.dependents(name)]:
+            mod = self.modules.pop(dep, None)
+            self._track_dependencies(dep, None, mod)
+
+    def _is_stale(self, name):  # noqa: ARG002
+        """Whether the cached template ``name`` has to be loaded again."""
+        return self._reload
+
+    def _compile_lock(self, name):
+        """Return the lock held while compiling the template ``name``."""
+        with self._locks_lock:
+            lock = self._compile_locks.get(name)
+            if lock is None:
+                lock = self._compile_locks[name] = threading.Lock()
+            return lock
+
     def default_alias_for(self, name):
         return default_alias_for(name)
 
@@ -41,8 +202,9 @@ class MockLoader(Loader):
     def __init__(self, modules):
         super().__init__()
         self.modules.update(modules)
-        for v in self.modules.values():
+        for k, v in self.modules.items():
             v.loader = self
+            self._track_dependencies(k, v)
 
 
 class FileLoader(Loader):
@@ -53,6 +215,8 @@ class FileLoader(Loader):
         force_mode=None,
         autoescape_text=False,  # noqa: FBT002
         xml_autoblocks=None,
+        cache_dir=None,
+        reload_interval=0,
         **template_options,
     ):
         super().__init__(reload=reload)
@@ -68,13 +232,17 @@ class FileLoader(Loader):
         self._force_mode = force_mode
         self._autoescape_text = autoescape_text
         self._xml_autoblocks = xml_autoblocks
+        self._cache_dir = None if cache_dir is None else Path(cache_dir)
+        self._reload_interval = reload_interval
+        self._stamps = {}
         self._template_options = template_options
         self.extension_map = {
-            "txt": lambda **kw: TextTemplate(autoescape=self._autoescape_text, **kw),
+            "txt": lambda is_fragment=False, **kw: TextTemplate(autoescape=self._autoescape_text, **kw),  # noqa: ARG005
             "xml": XMLTemplate,
             "html": lambda **kw: XMLTemplate(mode="html", **kw),
             "html5": lambda **kw: XMLTemplate(mode="html5", **kw),
         }
+        self._default_extension_map = self.extension_map.copy()
 
     def _filename(self, name: str) -> str | Path | None:
         """Get the filename of the requested resource."""
@@ -98,17 +266,183 @@ class FileLoader(Loader):
             raise FileNotFoundError(msg)
         return path
 
+    def preload(self, pattern="**/*", workers=None):
+        """Compile all the templates matching ``pattern`` up front.
+
+        ``pattern`` is a glob pattern relative to each directory of the
+        search path, files with an unknown extension are skipped.
+        Templates imported or included by other templates are loaded as
+        fragments, like they are while rendering.
+
+        With ``workers`` the templates are compiled by a pool of that many
+        processes feeding the cache directory, so the loader needs a
+        ``cache_dir`` and its options have to be picklable.
+
+        Returns a dict mapping the name of each template to the seconds
+        spent compiling it.
+        """
+        names = []
+        for base in self.path:
+            for path in sorted(Path(base).glob(pattern)):
+                name = path.relative_to(base).as_posix()
+                ext = path.suffix.lstrip(".")
+                if path.is_file() and (self._force_mode or ext in self.extension_map) and name not in names:
+                    names.append(name)
+        return self._preload(names, workers)
+
+    def _preload(self, names, workers):
+        """Compile the templates ``names`` and return their timings."""
+        if workers and self._cache_dir is None:
+            msg = "Preloading templates with workers requires a cache_dir"
+            raise ValueError(msg)
+        if workers:
+            timings, loaded_fragments = self._preload_templates(names, {}, workers), set()
+        else:
+            timings, loaded_fragments = self._preload_in_order(names)
+        fragments = {dep for name in names for kind, dep in self.modules[name].dependencies if kind != "extends"}
+        fragments = [name for name in names if name in fragments and name not in loaded_fragments]
+        for name in fragments:
+            # Loaded as a page first, load it again the way it is used.
+            self._track_dependencies(name, None, self.modules.pop(name, None))
+        timings.update(self._preload_templates(fragments, {"is_fragment": True}, workers))
+        return timings
+
+    def _preload_in_order(self, names):
+        """Compile the templates ``names`` one at a time.
+
+        The templates imported or included by a template are loaded as
+        fragments right after it, so that they are only compiled once
+        unless they were met before as pages.  Returns the timings and
+        the names loaded as fragments.
+        """
+        timings = {}
+        loaded_fragments = set()
+        wanted = set(names)
+        for name in names:
+            pending = [(name, {})]
+            while pending:
+                current, kwargs = pending.pop()
+                if current in timings:
+                    continue
+                timings.update(self._preload_templates([current], kwargs, None))
+                if kwargs:
+                    loaded_fragments.add(current)
+                pending.extend(
+                    (dep, {"is_fragment": True})
+                    for kind, dep in self.modules[current].dependencies
+                    if kind != "extends" and dep in wanted
+                )
+        return timings, loaded_fragments
+
+    def _preload_templates(self, names, kwargs, workers):
+        timings = {}
+        if workers:
+            with concurrent.futures.ProcessPoolExecutor(
+                workers,
+                initializer=_init_preload_worker,
+                initargs=(type(self), self._worker_args()),
+            ) as executor:
+                timings.update(zip(names, executor.map(_preload_worker, names, [kwargs] * len(names))))
+        for name in names:
+            start = time.perf_counter()
+            self.import_(name, **kwargs)
+            timings.setdefault(name, time.perf_counter() - start)
+        return timings
+
+    def _worker_args(self):
+        """Arguments creating a loader like this one in a preload worker."""
+        return {
+            "path": self.path,
+            "force_mode": self._force_mode,
+            "autoescape_text": self._autoescape_text,
+            "xml_autoblocks": self._xml_autoblocks,
+            "cache_dir": self._cache_dir,
+            **self._template_options,
+        }
+
     def _load(self, name, encoding="utf-8", **kwargs):
-        """Load a template from file."""
-        from kajiki import TextTemplate, XMLTemplate
+        """Load a template from file.
 
+        When the loader has a ``cache_dir`` the compiled code of the
+        template is looked up there first, and stored there after
+        compiling the template otherwise.
+        """
         options = self._template_options.copy()
         options.update(kwargs)
 
         resource = self._find_resource(name)
+        stamp = self._stamp(resource) if self._reload else None
+        tpl = self._load_resource(resource, encoding, options)
+        if self._reload:
+            # Stamped only once compiled, so a broken file is reloaded
+            # instead of leaving the previous template in use.
+            self._stamps[name] = (resource, stamp, time.monotonic())
+        return tpl
+
+    def _load_resource(self, resource, encoding, options):
+        """Compile the template ``resource`` or load it from ``cache_dir``."""
         source = resource.read_text(encoding=encoding)
 
+        cache_key = None if self._cache_dir is None else self._cache_key(resource, source, options)
+        if cache_key is None:
+            return self._compile(resource, source, options)
+
+        cache_file = self._cache_dir / (cache_key + ".kjc")
+        entry = self._read_cache(cache_file)
+        if entry is not None:
+            from kajiki.template import from_code
+
+            return from_code(
+                filename=str(resource),
+                base_globals=options.get("base_globals"),
+                escape=options.get("escape"),
+                fragment_cache=options.get("fragment_cache"),
+                **entry,
+            )
+
+        tpl = self._compile(resource, source, options)
+        self._write_cache(cache_file, tpl)
+        return tpl
+
+    def _is_stale(self, name):
+        """In reload mode, check whether the template file changed.
+
+        Files are checked at most once every ``reload_interval`` seconds,
+        comparing their modification time, size and inode with the ones
+        they had when they were loaded.
+        """
+        if not self._reload:
+            return False
+        if name not in self._stamps:
+            return True
+        resource, stamp, checked = self._stamps[name]
+        now = time.monotonic()
+        if now - checked < self._reload_interval:
+            return False
+        if stamp is None or self._stamp(resource) != stamp:
+            return True
+        self._stamps[name] = (resource, stamp, now)
+        return False
+
+    @staticmethod
+    def _stamp(resource):
+        """Return what identifies the current version of ``resource``.
+
+        ``None`` means it can't be told, and the resource is reloaded
+        every time.
+        """
+        try:
+            st = os.stat(resource)
+        except (OSError, TypeError):
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _compile(self, resource, source, options):
+        """Compile the template source read from ``resource``."""
+        from kajiki import TextTemplate, XMLTemplate
+
         if self._force_mode == "text":
+            options.pop("is_fragment", None)
             return TextTemplate(
                 source=source,
                 filename=str(resource),
@@ -128,10 +462,110 @@ class FileLoader(Loader):
         ext = Path(resource.name).suffix.lstrip(".")
         return self.extension_map[ext](source=source, filename=str(resource), **options)
 
+    def _cache_key(self, resource, source, options):
+        """Key of the compiled ``source`` in the cache directory.
+
+        Anything that changes the generated code is part of the key:
+        the source itself, the code of kajiki, the Python version, the
+        function of ``extension_map`` compiling it and the options the
+        template is compiled with.  ``None`` is returned when that
+        function can't be identified, and the template isn't cached.
+        """
+        compile_options = sorted(
+            (k, v) for k, v in options.items() if k not in ("base_globals", "escape", "fragment_cache")
+        )
+        ext = Path(resource.name).suffix
+        compile_func = None if self._force_mode else self.extension_map.get(ext.lstrip("."))
+        if compile_func is None or compile_func is self._default_extension_map.get(ext.lstrip(".")):
+            compile_id = None
+        else:
+            compile_id = _callable_id(compile_func)
+            if compile_id is None:
+                return None
+        key = hashlib.sha256()
+        for part in (
+            _compiler_fingerprint(),
+            sys.implementation.cache_tag,
+            ext,
+            compile_id,
+            self._force_mode,
+            self._autoescape_text,
+            self._xml_autoblocks,
+            compile_options,
+        ):
+            key.update(repr(part).encode("utf-8") + b"\0")
+        key.update(source.encode("utf-8"))
+        return key.hexdigest()
+
+    def _read_cache(self, cache_file):
+        """Return the cache entry stored in ``cache_file``, if any."""
+        try:
+            entry = marshal.loads(cache_file.read_bytes())  # noqa: S302
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        if not isinstance(entry, dict):
+            return None
+        return entry
+
+    def _write_cache(self, cache_file, tpl):
+        """Store the compiled code of ``tpl`` in ``cache_file``.
+
+        Failing to write the cache is not an error, the template
+        will just be compiled again the next time.
+        """
+        code = getattr(tpl, "py_code", None)
+        if code is None:
+            # Not a kajiki template, e.g. a custom entry of extension_map.
+            return
+        entry = {
+            "code": code,
+            "py_text": tpl.py_text,
+            "py_linenos": tpl.py_linenos,
+            "dependencies": tpl.dependencies,
+        }
+        tmp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+        try:
+            self._cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp_file.write_bytes(marshal.dumps(entry))
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            pass
+
 
 class PackageLoader(FileLoader):
-    def __init__(self, reload=False, force_mode=None):  # noqa: FBT002
-        super().__init__(None, reload=reload, force_mode=force_mode)
+    _extensions = (".xml", ".html", ".html5", ".txt")
+
+    def __init__(self, reload=False, force_mode=None, cache_dir=None, reload_interval=0):  # noqa: FBT002
+        super().__init__(
+            None,
+            reload=reload,
+            force_mode=force_mode,
+            cache_dir=cache_dir,
+            reload_interval=reload_interval,
+        )
+
+    def preload(self, package, pattern="*", workers=None):
+        """Compile all the templates of ``package`` and its subpackages.
+
+        ``pattern`` is matched against the file names, see
+        :meth:`FileLoader.preload` for the other arguments and the
+        returned timings.
+        """
+        names = []
+        packages = [package]
+        while packages:
+            current = packages.pop(0)
+            for resource in sorted(importlib_resources.files(current).iterdir(), key=lambda r: r.name):
+                if resource.is_dir() and resource.joinpath("__init__.py").is_file():
+                    packages.append(f"{current}.{resource.name}")
+                    continue
+                root, ext = os.path.splitext(resource.name)
+                if resource.is_file() and ext in self._extensions and fnmatch.fnmatch(resource.name, pattern):
+                    names.append(f"{current}.{root}")
+        return self._preload(names, workers)
+
+    def _worker_args(self):
+        return {"force_mode": self._force_mode, "cache_dir": self._cache_dir}
 
     def _find_resource(self, name):
         package, module = name.rsplit(".", 1)
@@ -149,9 +583,24 @@ class PackageLoader(FileLoader):
             if root != module:
                 continue
 
-            for match_ext in (".xml", ".html", ".html5", ".txt"):
+            for match_ext in self._extensions:
                 if match_ext == ext:
                     return resource
 
         msg = f"Unknown template {name!r}"
         raise FileNotFoundError(msg)
+
+
+_preload_loader = None
+
+
+def _init_preload_worker(loader_type, loader_args):
+    global _preload_loader  # noqa: PLW0603
+    _preload_loader = loader_type(**loader_args)
+
+
+def _preload_worker(name, kwargs):
+    """Compile ``name`` into the cache directory, return the time spent."""
+    start = time.perf_counter()
+    _preload_loader.import_(name, **kwargs)
+    return time.perf_counter() - start
@@ -0,0 +1,308 @@
+"""Profiler attributing the time spent rendering to template lines.
+
+The code of template functions is mapped back to the lines of their
+template file (see :meth:`kajiki.template.TplFunc.annotate_lnotab`),
+so the profiler reports where render time goes in the templates
+themselves::
+
+    with Profiler() as profiler:
+        tpl(context).render()
+    print(profiler.report())
+    with open("render.folded", "w") as f:
+        profiler.write_collapsed(f)
+
+For each ``file:line`` it records the time spent running it, excluding
+the other template functions it calls, and the number of times it ran.
+For each span, the ``__main__`` function of a template, a ``py:block``
+or a ``py:def``, it records the number of calls and the time spent in it
+and in the spans nested in it, even when nested functions run after it
+yielded them. :meth:`Profiler.write_collapsed` writes the time of each
+stack of spans and lines in the collapsed format read by flame graph
+tools.
+
+The profiler uses :mod:`sys.monitoring` on Python 3.12 and newer, with
+the profiler tool id or another free one when :mod:`cProfile` holds it,
+and a trace function of :func:`sys.settrace` before, putting back the
+previous one when stopped. Only template functions are traced, any
+other code they call is counted as part of the line calling it. It
+profiles the renders of one thread at a time.
+"""
+
+import inspect
+import sys
+from time import perf_counter
+
+import kajiki
+from kajiki.util import flattener
+
+_GENERATOR_FLAGS = inspect.CO_GENERATOR | inspect.CO_COROUTINE | inspect.CO_ASYNC_GENERATOR
+# The sys.monitoring tool ids without a predefined use.
+_FREE_TOOL_IDS = (3, 4)
+
+
+def span_name(code):
+    """Return the name of the span of template function ``code``."""
+    name = code.co_name
+    if name == "__main__":
+        return code.co_filename
+    if name.startswith("_kj_block_"):
+        return f"{code.co_filename}:py:block {name[10:]}"
+    return f"{code.co_filename}:{name}()"
+
+
+class Profiler:
+    """Record the time spent rendering each line of the templates.
+
+    Start it with :meth:`start` and :meth:`stop`, or as a context
+    manager. It can be started and stopped several times to profile
+    more renders.
+
+    ``lines`` maps ``(filename, lineno)`` to ``[seconds, hits]``,
+    ``spans`` maps span names to ``[seconds, calls]`` and ``stacks``
+    maps tuples of span names, ending with a ``file:line``, to seconds.
+    The time a function spends before its first line is counted on the
+    line of its ``py:def`` or ``py:block``, and on the stack of the span
+    alone for the ``__main__`` function, which has no line of its own.
+    """
+
+    def __init__(self, timer=perf_counter):
+        self.timer = timer
+        self.lines = {}
+        self.spans = {}
+        self.stacks = {}
+        self._stack = []
+        self._paths = {}
+        self._parents = {}
+        self._is_template = {}
+        self._previous_trace = None
+        self._tool = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        if sys.version_info >= (3, 12):
+            self._start_monitoring()
+        else:
+            self._previous_trace = sys.gettrace()
+            sys.settrace(self._trace)
+
+    def stop(self):
+        if sys.version_info >= (3, 12):
+            self._stop_monitoring()
+        else:
+            # Give the trace function back to a debugger or coverage.
+            sys.settrace(self._previous_trace)
+            self._previous_trace = None
+        self._stack.clear()
+        self._paths.clear()
+        self._parents.clear()
+
+    def _start_monitoring(self):
+        monitoring = sys.monitoring
+        events = monitoring.events
+        # The profiler tool id is taken when running under cProfile,
+        # fall back to the ids left free for other tools.
+        for tool in (monitoring.PROFILER_ID, *_FREE_TOOL_IDS):
+            if monitoring.get_tool(tool) is None:
+                break
+        else:
+            msg = "No sys.monitoring tool id is free to profile templates"
+            raise RuntimeError(msg)
+        monitoring.use_tool_id(tool, "kajiki")
+        self._tool = tool
+        callbacks = {
+            events.PY_START: self._on_enter,
+            events.PY_RESUME: self._on_enter,
+            events.PY_THROW: self._on_throw,
+            events.PY_RETURN: self._on_leave,
+            events.PY_YIELD: self._on_leave,
+            events.PY_UNWIND: self._on_unwind,
+            events.LINE: self._on_line,
+        }
+        for event, callback in callbacks.items():
+            monitoring.register_callback(tool, event, callback)
+        monitoring.set_events(tool, sum(callbacks))
+
+    def _stop_monitoring(self):
+        monitoring = sys.monitoring
+        tool = self._tool
+        if tool is None:
+            return
+        self._tool = None
+        monitoring.set_events(tool, 0)
+        monitoring.restart_events()
+        monitoring.free_tool_id(tool)
+
+    def _template_code(self, code, frame):
+        """Tell whether ``code`` is the code of a template function."""
+        is_template = self._is_template.get(code)
+        if is_template is None:
+            is_template = self._is_template[code] = frame.f_globals.get("__kj__") is kajiki
+        return is_template
+
+    def _on_enter(self, code, offset):  # noqa: ARG002
+        frame = sys._getframe(1)  # noqa: SLF001
+        if not self._template_code(code, frame):
+            return sys.monitoring.DISABLE
+        self._enter(frame)
+        return None
+
+    def _on_throw(self, code, offset, exc):  # noqa: ARG002
+        frame = sys._getframe(1)  # noqa: SLF001
+        if self._template_code(code, frame):
+            self._enter(frame)
+
+    def _on_leave(self, code, offset, value):  # noqa: ARG002
+        frame = sys._getframe(1)  # noqa: SLF001
+        if not self._template_code(code, frame):
+            return sys.monitoring.DISABLE
+        self._leave(frame, value)
+        return None
+
+    def _on_unwind(self, code, offset, exc):  # noqa: ARG002
+        frame = sys._getframe(1)  # noqa: SLF001
+        if self._template_code(code, frame):
+            self._leave(frame, None)
+
+    def _on_line(self, code, lineno):
+        frame = sys._getframe(1)  # noqa: SLF001
+        if not self._template_code(code, frame):
+            return sys.monitoring.DISABLE
+        self._line(frame, lineno)
+        return None
+
+    def _trace(self, frame, event, arg):  # noqa: ARG002
+        if not self._template_code(frame.f_code, frame):
+            return None
+        self._enter(frame)
+        return self._trace_frame
+
+    def _trace_frame(self, frame, event, arg):
+        if event == "line":
+            self._line(frame, frame.f_lineno)
+        elif event == "return":
+            self._leave(frame, arg)
+        return self._trace_frame
+
+    def _enter(self, frame):
+        """Start timing ``frame``, called or resumed."""
+        now = self.timer()
+        stack = self._stack
+        if stack:
+            self._add(stack[-1], now)
+        path = self._paths.get(frame)
+        if path is None:
+            # A function runs inside the span which yielded it, when
+            # flattened, or else inside the span calling it.
+            parent = self._parents.pop(frame, None)
+            if parent is None:
+                parent = stack[-1][1] if stack else ()
+            name = span_name(frame.f_code)
+            path = self._paths[frame] = (*parent, name)
+            span = self.spans.get(name)
+            if span is None:
+                self.spans[name] = [0.0, 1]
+            else:
+                span[1] += 1
+        # The code before the first line maps to the line of the
+        # py:def or py:block, or to none for __main__.
+        stack.append([frame, path, frame.f_lineno or frame.f_code.co_firstlineno, now])
+
+    def _line(self, frame, lineno):
+        """Stop timing the previous line of ``frame`` and start ``lineno``."""
+        stack = self._stack
+        if not stack or stack[-1][0] is not frame:
+            return
+        now = self.timer()
+        top = stack[-1]
+        self._add(top, now)
+        top[2] = lineno
+        top[3] = now
+        if not lineno:
+            return
+        line = self.lines.get((frame.f_code.co_filename, lineno))
+        if line is None:
+            self.lines[(frame.f_code.co_filename, lineno)] = [0.0, 1]
+        else:
+            line[1] += 1
+
+    def _leave(self, frame, value):
+        """Stop timing ``frame``, which returned or yielded ``value``."""
+        stack = self._stack
+        if not stack or stack[-1][0] is not frame:
+            return
+        now = self.timer()
+        top = stack.pop()
+        self._add(top, now)
+        if type(value) is flattener:
+            iterator = value.iterator
+            child = getattr(iterator, "gi_frame", None) or getattr(iterator, "ag_frame", None)
+            if child is not None:
+                self._parents[child] = top[1]
+        if not frame.f_code.co_flags & _GENERATOR_FLAGS:
+            del self._paths[frame]
+        if stack:
+            stack[-1][3] = now
+
+    def _add(self, entry, now):
+        frame, path, lineno, start = entry
+        elapsed = now - start
+        if lineno:
+            filename = frame.f_code.co_filename
+            line = self.lines.get((filename, lineno))
+            if line is None:
+                self.lines[(filename, lineno)] = [elapsed, 0]
+            else:
+                line[0] += elapsed
+            key = (*path, f"{filename}:{lineno}")
+        else:
+            key = path
+        self.stacks[key] = self.stacks.get(key, 0.0) + elapsed
+        for name in set(path):
+            self.spans[name][0] += elapsed
+
+    def report(self, limit=20):
+        """Return the report of the lines and spans taking the most time.
+
+        At most ``limit`` lines and spans are listed, or all of them
+        when ``limit`` is ``None``.
+        """
+        out = [f"{'time (ms)':>12} {'hits':>8}  line"]
+        lines = sorted(self.lines.items(), key=lambda item: item[1][0], reverse=True)
+        for (filename, lineno), (elapsed, hits) in lines[:limit]:
+            out.append(f"{elapsed * 1000:12.3f} {hits:8d}  {filename}:{lineno}")
+        out.append("")
+        out.append(f"{'time (ms)':>12} {'calls':>8}  span")
+        spans = sorted(self.spans.items(), key=lambda item: item[1][0], reverse=True)
+        for name, (elapsed, calls) in spans[:limit]:
+            out.append(f"{elapsed * 1000:12.3f} {calls:8d}  {name}")
+        return "\n".join(out) + "\n"
+
+    def write_collapsed(self, fp):
+        """Write the stacks to ``fp`` in the collapsed stack format.
+
+        Each line is a stack of spans ending with a line, separated by
+        ``;``, followed by its time in microseconds, which is what
+        ``flamegraph.pl`` or speedscope read.
+        """
+        for path, elapsed in sorted(self.stacks.items()):
+            microseconds = round(elapsed * 1_000_000)
+            if microseconds:
+                fp.write(f"{';'.join(path)} {microseconds}\n")
+
+
+def profile_render(template, context=None, repeat=1):
+    """Render ``template`` with ``context`` ``repeat`` times under a new
+    :class:`Profiler` and return it.
+    """
+    profiler = Profiler()
+    for _ in range(repeat):
+        instance = template(context)
+        with profiler:
+            instance.render()
+    return profiler
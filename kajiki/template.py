@@ -1,6 +1,7 @@
+import codecs
 import dis
-import functools
-import re
+import inspect
+import io
 import types
 from sys import version_info
 
@@ -8,15 +9,72 @@ import linetable
 
 import kajiki
 from kajiki import i18n, lnotab
-from kajiki.html_utils import HTML_EMPTY_ATTRS
+from kajiki.cache import LRUCache, default_cache
+from kajiki.html_utils import HTML_EMPTY_ATTRS, escape_html_cached
 from kajiki.ir import generate_python
 from kajiki.util import flattener, literal
 
+# Types rendered by str() without escaping, subclasses might override __str__.
+_NUMBER_TYPES = frozenset((int, float, bool))
 
-class _obj:  # noqa: N801
-    def __init__(self, **kw):
-        for k, v in kw.items():
-            setattr(self, k, v)
+
+class _Helper:
+    """A method of the template, bound the first time it is looked up on
+    the helpers and kept in their ``__dict__`` for the next lookups.
+    """
+
+    __slots__ = ("method", "name")
+
+    def __init__(self, method):
+        self.method = method
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, helpers, owner=None):
+        if helpers is None:
+            return self
+        bound = helpers.__dict__[self.name] = getattr(helpers._template, self.method)  # noqa: SLF001
+        return bound
+
+
+class _Helpers:
+    """The helpers of a template used by the generated code as ``__kj__``.
+
+    They are the methods of the template, only bound when the generated
+    code first looks them up instead of each time a template is created.
+    """
+
+    __slots__ = ("__dict__", "_template")
+
+    def __init__(self, template):
+        self._template = template
+
+    extend = _Helper("_extend")
+    push_switch = _Helper("_push_switch")
+    pop_switch = _Helper("_pop_switch")
+    case = _Helper("_case")
+    import_ = _Helper("_import")
+    escape = _Helper("_escape")
+    gettext = _Helper("_gettext")
+    render_attrs = _Helper("_render_attrs")
+    push_with = _Helper("_push_with")
+    pop_with = _Helper("_pop_with")
+    collect = _Helper("_collect")
+    collect_async = _Helper("_collect_async")
+    escape_attr = _Helper("_escape_attr")
+    cache_lookup = _Helper("_cache_lookup")
+    cache_store = _Helper("_cache_store")
+
+
+# The globals every template starts from. base_globals are added to them
+# for each instance, so changing them in place shows in the next render.
+_TEMPLATE_GLOBALS = {
+    "literal": literal,
+    "Markup": literal,
+    "__builtins__": __builtins__,
+    "__kj__": kajiki,
+}
 
 
 class _Template:
@@ -46,45 +104,30 @@ class _Template:
     loader = None
     base_globals = None
     filename = None
+    dependencies = ()
+    fragment_cache = default_cache
 
     def __init__(self, context=None):
         if context is None:
             context = {}
         self._context = context
-        base_globals = self.base_globals or {}
-        self.__globals__ = {
-            "local": self,
-            "self": self,
-            "defined": lambda x: x in self.__globals__,
-            "literal": literal,
-            "Markup": literal,
-            "gettext": i18n.gettext,
-            "__builtins__": __builtins__,
-            "__kj__": kajiki,
-        }
-        self.__globals__.update(base_globals)
-        for k, v in self.__methods__:
-            v = v.bind_instance(self)  # noqa: PLW2901
-            setattr(self, k, v)
-            self.__globals__[k] = v
-        self.__kj__ = _obj(
-            extend=self._extend,
-            push_switch=self._push_switch,
-            pop_switch=self._pop_switch,
-            case=self._case,
-            import_=self._import,
-            escape=self._escape,
-            gettext=self._gettext,
-            render_attrs=self._render_attrs,
-            push_with=self._push_with,
-            pop_with=self._pop_with,
-            collect=self._collect,
-        )
+        self.__globals__ = gbls = _TEMPLATE_GLOBALS.copy()
+        gbls.update(self.base_globals or {})
+        # Set unless base_globals provide them.
+        gbls.setdefault("local", self)
+        gbls.setdefault("self", self)
+        gbls.setdefault("defined", gbls.__contains__)
+        gbls.setdefault("gettext", i18n.gettext)
+        # Bound per instance: their globals are the ones of this instance.
+        methods = {k: v.bind_instance(self) for k, v in self.__methods__}
+        self.__dict__.update(methods)
+        gbls.update(methods)
+        self.__kj__ = _Helpers(self)
         self._switch_stack = []
         self._with_stack = []
-        self.__globals__.update(context)
-        self.__globals__["_"] = self.__globals__["gettext"]
-        self.__globals__["value_of"] = self.__globals__.get
+        gbls.update(context)
+        gbls["_"] = gbls["gettext"]
+        gbls["value_of"] = gbls.get
 
     def __iter__(self):
         """We convert the chunk to string because it can be of any type
@@ -98,6 +141,60 @@ class _Template:
         """Render the template to a string."""
         return "".join(self)
 
+    def render_to(self, fp, encoding=None):
+        """Render the template writing the output to ``fp`` as it's produced.
+
+        ``fp`` can be a ``bytearray``, which the output is appended to,
+        or any object with a ``write`` method such as a file or
+        :class:`io.StringIO`. The output is encoded with ``encoding``
+        for bytearrays and binary files (UTF-8 by default), and for
+        other objects only if ``encoding`` is given.
+        """
+        if isinstance(fp, bytearray):
+            write = fp.extend
+        else:
+            write = fp.write
+            if encoding is None and not isinstance(fp, (io.RawIOBase, io.BufferedIOBase)):
+                for chunk in self.__main__():
+                    write(chunk if type(chunk) is str else str(chunk))
+                return
+        encode = codecs.getincrementalencoder(encoding or "utf-8")().encode
+        for chunk in self.__main__():
+            write(encode(chunk if type(chunk) is str else str(chunk)))
+        write(encode("", final=True))
+
+    async def render_async(self):
+        """Render the template asynchronously, yielding the output as strings.
+
+        This is how templates compiled with ``is_async`` are rendered,
+        as they can await coroutines and asynchronous iterables.
+        Synchronous templates can be rendered this way too.
+        """
+        async for chunk in self.__main__():
+            yield str(chunk)
+
+    def render_chunks(self, chunk_size=8192, encoding="utf-8"):
+        """Render the template to chunks of bytes encoded with ``encoding``.
+
+        Every chunk but the last one is exactly ``chunk_size`` bytes long,
+        so the output can be streamed with bounded memory and a
+        predictable number of writes.
+        """
+        if chunk_size <= 0:
+            msg = "chunk_size must be a positive integer"
+            raise ValueError(msg)
+        encoder = codecs.getincrementalencoder(encoding)()
+        buf = bytearray()
+        for chunk in self:
+            buf += encoder.encode(chunk)
+            while len(buf) >= chunk_size:
+                yield bytes(buf[:chunk_size])
+                del buf[:chunk_size]
+        buf += encoder.encode("", final=True)
+        while buf:
+            yield bytes(buf[:chunk_size])
+            del buf[:chunk_size]
+
     def _gettext(self, s):
         """Used by the code generated by the template to translate static text"""
         return self.__globals__["gettext"](s)
@@ -205,49 +302,111 @@ class _Template:
         """Returns the given HTML with ampersands, carets and quotes encoded."""
         if value is None or isinstance(value, flattener):
             return value
+        value_type = type(value)
+        if value_type is str:
+            return self._escape_text(value)
+        if value_type in _NUMBER_TYPES:
+            # Numbers never contain anything to escape.
+            return str(value)
         if hasattr(value, "__html__"):
             return value.__html__()
-        uval = str(value)
-        if self._re_escape.search(uval):  # Scan the string before working.
-            # stdlib escape() is inconsistent between Python 2 and Python 3.
-            # In 3, html.escape() translates the single quote to '&#39;'
-            # In 2.6 and 2.7, cgi.escape() does not touch the single quote.
-            # Preserve our tests and Kajiki behaviour across Python versions:
-            return uval.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
-            # .replace("'", '&#39;'))
-            # Above we do NOT escape the single quote; we don't need it because
-            # all HTML attributes are double-quoted in our output.
-        return uval
-
-    _re_escape = re.compile(r'&|<|>|"')
-
-    def _render_attrs(self, attrs, mode):
+        return self._escape_text(str(value))
+
+    # Unlike html.escape() this does not touch the single quote.
+    _escape_text = staticmethod(escape_html_cached)
+
+    def _escape_attr(self, value):
+        """Escape a value rendered inside an attribute.
+
+        The value is converted to string the same way :meth:`._collect`
+        does before :meth:`._render_attrs` escapes it, with ``None``
+        contributing nothing to the attribute.  The output of template
+        functions is escaped as it is rendered, so that functions
+        rendering attributes can be nested however deep.
+        """
+        if value is None:
+            return ""
+        if isinstance(value, flattener):
+            return flattener(value, escape=self._escape_str)
+        return self._escape(str(value))
+
+    def _escape_str(self, value):
+        """Escape ``value`` converted to string."""
+        return self._escape(value if type(value) is str else str(value))
+
+    def _render_attrs(self, attrs, mode, sort=True):  # noqa: FBT002
         """Render tag attributes in key="value" format.
 
         A :class:`kajiki.ir.AttrsNode` will generate
         code that in fact leads to this function to generate
         the html for tag attributes.
+
+        The attributes are rendered in alphabetical order, unless
+        ``sort`` is false.
         """
+        if attrs is None:
+            return
         if hasattr(attrs, "items"):
             attrs = attrs.items()
-        if attrs is not None:
-            for k, v in sorted(attrs):
-                if k in HTML_EMPTY_ATTRS and v in (True, False):
+        if sort:
+            attrs = sorted(attrs)
+        is_html = mode.startswith("html")
+        for k, v in attrs:
+            if k in HTML_EMPTY_ATTRS:
+                if v in (True, False):
                     v = k if v else None  # noqa: PLW2901
                 if v is None:
                     continue
-                if mode.startswith("html") and k in HTML_EMPTY_ATTRS:
+                if is_html:
                     yield " " + k.lower()
-                else:
-                    yield f' {k}="{self._escape(v)}"'
+                    continue
+            elif v is None:
+                continue
+            yield f' {k}="{self._escape(v)}"'
+
+    def _cache_lookup(self, fragment_id, key):
+        """Return the cached output of a ``py:cache`` fragment, if any."""
+        return self.fragment_cache.get((fragment_id, key))
+
+    def _cache_store(self, fragment_id, key, ttl, output):
+        """Store the output of a ``py:cache`` fragment and return it."""
+        if output is None:
+            output = ""
+        elif isinstance(output, flattener):
+            output = output.accumulate_str()
+        self.fragment_cache.set((fragment_id, key), output, ttl)
+        return output
 
     def _collect(self, it):
+        """Collect the output of ``it``, ``None`` when it has none.
+
+        The output of nested template functions isn't rendered, the
+        result is then a flattener of the collected parts.
+        """
         result = []
+        nested = False
         for part in it:
             if part is None:
                 continue
             if isinstance(part, flattener):
-                result.append(str(part.accumulate_str()))
+                result.append(part)
+                nested = True
+            else:
+                result.append(str(part))
+        if not result:
+            return None
+        if nested:
+            return flattener(iter(result))
+        return "".join(result)
+
+    async def _collect_async(self, it):
+        """Asynchronous version of :meth:`._collect`."""
+        result = []
+        async for part in it:
+            if part is None:
+                continue
+            if isinstance(part, flattener):
+                result.append("".join([str(x) async for x in part]))
             else:
                 result.append(str(part))
         if result:
@@ -290,11 +449,20 @@ def Template(ns):  # noqa: N802
     for name in dir(ns):
         value = getattr(ns, name)
         if getattr(value, "exposed", False):
-            methods.append((name, TplFunc(getattr(value, "__func__", value))))
+            func = getattr(value, "__func__", value)
+            scope = getattr(func, "memoize", None)
+            methods.append((name, TplFunc(func) if scope is None else MemoizedTplFunc(func, scope=scope)))
     return type(ns.__name__, (_Template,), dct)
 
 
-def from_ir(ir_node, base_globals=None):
+def from_ir(
+    ir_node,
+    base_globals=None,
+    is_async=False,  # noqa: FBT002
+    accumulate=False,  # noqa: FBT002
+    escape=None,
+    fragment_cache=None,
+):
     """Creates a template class from Intermediate Representation TemplateNode.
 
     This actually creates the class defined by the TemplateNode by executing
@@ -302,35 +470,170 @@ def from_ir(ir_node, base_globals=None):
     The returned class is a subclass of :class:`kajiki.template._Template`.
 
     It is possible to use `base_globals` to set context values
-    or replace default ones
+    or replace default ones.
+
+    When `is_async` is true the template functions are generated as
+    asynchronous generators and the template has to be rendered
+    through :meth:`._Template.render_async`.
+
+    When `accumulate` is true the template functions append their output
+    to a list instead of yielding it, see :func:`kajiki.ir.generate_python`.
+    Python blocks of such templates can't ``yield``.
+
+    `escape` selects how the template escapes the values it renders,
+    see :func:`escape_function`, and `fragment_cache` is the backend
+    storing the output of ``py:cache`` fragments, see :mod:`kajiki.cache`.
     """
-    if base_globals is None:
-        base_globals = {}
-    py_lines = list(generate_python(ir_node))
+    py_lines = list(generate_python(ir_node, is_async=is_async, accumulate=accumulate))
     py_text = "\n".join(map(str, py_lines))
     py_linenos = []
     last_lineno = 0
     py_lineno = 1
     for line in py_lines:
+        if line._indent <= 4:  # noqa: SLF001, PLR2004
+            # Each template function maps to lines of its own.
+            last_lineno = 0
         lno = max(last_lineno, line._lineno or 0)  # noqa: SLF001
         for _ in range(str(line).count("\n") + 1):
             py_linenos.append((py_lineno, lno))
             py_lineno += 1
         last_lineno = lno
-    dct = {"kajiki": kajiki}
     try:
-        exec(py_text, dct)  # noqa: S102
+        code = compile(py_text, "<string>", "exec")
     except (SyntaxError, IndentationError) as e:  # pragma no cover
         raise KajikiSyntaxError(e.msg, py_text, e.filename, e.lineno, e.offset) from e
+    if accumulate:
+        _check_accumulator_code(code, py_text, py_linenos, ir_node.filename)
+    tpl = from_code(
+        code,
+        py_text,
+        py_linenos,
+        ir_node.filename,
+        base_globals=base_globals,
+        dependencies=getattr(ir_node, "dependencies", ()),
+        escape=escape,
+        fragment_cache=fragment_cache,
+    )
+    tpl.py_code = code
+    return tpl
+
+
+def _check_accumulator_code(code, py_text, py_linenos, filename):
+    """Ensure no function of a template compiled in accumulator mode is a generator.
+
+    That happens when a Python block of the template uses ``yield``,
+    whose output would replace the accumulated one.  Only the template
+    functions are checked, functions defined by Python blocks can be
+    generators.
+    """
+    lines = py_text.splitlines()
+    for const in code.co_consts:
+        if not isinstance(const, types.CodeType):
+            continue
+        if const.co_flags & inspect.CO_OPTIMIZED and not _is_template_function(const, lines):
+            continue
+        if const.co_flags & inspect.CO_GENERATOR:
+            msg = "yield can't be used in templates compiled with accumulate=True"
+            raise KajikiSyntaxError(msg, py_text, filename, dict(py_linenos).get(const.co_firstlineno, 0), 0)
+        _check_accumulator_code(const, py_text, py_linenos, filename)
+
+
+def _is_template_function(code, lines):
+    """Whether ``code`` is generated for the template rather than written in it.
+
+    Template functions are the ``py:def``, blocks and ``__main__``,
+    decorated by the generated code, and the helper functions it names.
+    """
+    if code.co_name.startswith("_kj_"):
+        return True
+    decorator = lines[code.co_firstlineno - 1].strip() if code.co_firstlineno <= len(lines) else ""
+    return decorator in ("@kajiki.expose", "@__kj__.flattener.decorate")
+
+
+def from_code(
+    code,
+    py_text,
+    py_linenos,
+    filename,
+    base_globals=None,
+    dependencies=(),
+    escape=None,
+    fragment_cache=None,
+):
+    """Creates a template class from the compiled code of a template module.
+
+    ``code`` is the code object compiled from ``py_text`` and ``py_linenos``
+    is the list of ``(python line, template line)`` pairs used to map
+    the generated code back to the template ``filename``.
+    ``dependencies`` are the ``(kind, name)`` pairs of the templates it
+    extends, imports or includes, see :class:`kajiki.ir.TemplateNode`.
+
+    This is what :func:`from_ir` uses once the Python code has been
+    generated, and allows loaders to skip parsing and code generation
+    when they already have the compiled code around.
+    """
+    if base_globals is None:
+        base_globals = {}
+    dct = {"kajiki": kajiki}
+    exec(code, dct)  # noqa: S102
     tpl = dct["template"]
     tpl.base_globals = base_globals.copy()
     tpl.base_globals.update(dct)
     tpl.py_text = py_text
-    tpl.filename = ir_node.filename
+    tpl.py_linenos = py_linenos
+    tpl.filename = filename
+    tpl.dependencies = tuple((kind, name) for kind, name in dependencies)
+    if escape is not None:
+        tpl._escape_text = staticmethod(escape_function(escape))  # noqa: SLF001
+    if fragment_cache is not None:
+        tpl.fragment_cache = fragment_cache
     tpl.annotate_lnotab(py_linenos)
     return tpl
 
 
+def escape_function(escape):
+    """Return the function escaping text for the ``escape`` option.
+
+    ``escape`` can be:
+
+        - ``"kajiki"`` (the default) escapes ``&``, ``<``, ``>`` and ``"``,
+          caching the result for short strings.
+        - ``"markupsafe"`` uses :func:`markupsafe.escape`, implemented in C,
+          which also escapes single quotes. The ``markupsafe`` package must
+          be installed.
+        - Any callable taking the text to escape and returning it escaped.
+    """
+    if escape is None or escape == "kajiki":
+        return escape_html_cached
+    if escape == "markupsafe":
+        try:
+            from markupsafe import escape as markupsafe_escape
+        except ImportError:
+            msg = "The markupsafe package is required by escape='markupsafe'"
+            raise ValueError(msg) from None
+        return markupsafe_escape
+    if callable(escape):
+        return escape
+    msg = f"Unknown escape {escape!r}, expected 'kajiki', 'markupsafe' or a callable"
+    raise ValueError(msg)
+
+
+def options_fingerprint(**options):
+    """Return a string identifying compile options affecting the output.
+
+    It's part of the id of ``py:cache`` fragments, so that a source
+    compiled with different options doesn't share their output.
+    Callables, such as a custom ``escape``, are identified by their
+    qualified name, which is the same in every process.
+    """
+    parts = []
+    for name, value in sorted(options.items()):
+        if callable(value):
+            value = f"{getattr(value, '__module__', '')}.{getattr(value, '__qualname__', type(value).__name__)}"  # noqa: PLW2901
+        parts.append(f"{name}={value!r}")
+    return ",".join(parts)
+
+
 class TplFunc:
     """A template function attached to a _Template.
 
@@ -342,6 +645,8 @@ class TplFunc:
     ``_Template`` with the attached functions.
     """
 
+    __slots__ = ("_bound_func", "_func", "_inst")
+
     def __init__(self, func, inst=None):
         self._func = func
         self._inst = inst
@@ -356,22 +661,20 @@ class TplFunc:
         return f"<unbound tpl_function {self._func.__name__!r}>"
 
     def __call__(self, *args, **kwargs):
-        if self._bound_func is None:
-            self._bound_func = self._bind_globals(self._inst.__globals__)
-        return self._bound_func(*args, **kwargs)
+        func = self._bound_func
+        if func is None:
+            func = self._bound_func = self._bind_globals(self._inst.__globals__)
+        return flattener(func(*args, **kwargs))
 
     def _bind_globals(self, globals):  # noqa: A002
-        """Return a function which has the globals dict set to 'globals'
-        and which flattens the result of self._func'.
-        """
-        func = types.FunctionType(
+        """Return self._func with the globals dict set to 'globals'."""
+        return types.FunctionType(
             self._func.__code__,
             globals,
             self._func.__name__,
             self._func.__defaults__,
             self._func.__closure__,
         )
-        return functools.update_wrapper(lambda *a, **kw: flattener(func(*a, **kw)), func)
 
     def annotate_lnotab(self, filename, py_to_tpl, py_to_tpl_dct):
         if not py_to_tpl:
@@ -409,6 +712,63 @@ class TplFunc:
         return
 
 
+class MemoizedTplFunc(TplFunc):
+    """A template function caching its output by arguments.
+
+    Created for the functions decorated by :func:`kajiki.memoize`, which
+    is what ``py:memoize`` compiles to. The output of a call is collected
+    once and returned as a literal by later calls with equal arguments
+    of the same types.
+    With the ``"render"`` scope the cache belongs to the template instance,
+    with the ``"process"`` scope it's shared by all the instances. Both
+    keep at most ``maxsize`` outputs, and calls with unhashable arguments
+    are not cached.
+    """
+
+    __slots__ = ("_cache", "_scope")
+    maxsize = 128
+
+    def __init__(self, func, inst=None, scope="render", cache=None):
+        super().__init__(func, inst)
+        self._scope = scope
+        if cache is None and scope == "process":
+            cache = LRUCache(self.maxsize)
+        self._cache = cache
+
+    def bind_instance(self, inst):
+        if self._scope == "process":
+            return MemoizedTplFunc(self._func, inst, self._scope, self._cache)
+        return MemoizedTplFunc(self._func, inst, self._scope)
+
+    def __call__(self, *args, **kwargs):
+        # Typed like lru_cache(typed=True): f(1), f(True) and f(1.0) render
+        # differently although their arguments are equal.
+        if kwargs:
+            items = tuple(sorted(kwargs.items()))
+            key = (args, items, tuple(map(type, args)), tuple(type(v) for _, v in items))
+        else:
+            key = (args, tuple(map(type, args)))
+        cache = self._cache
+        if cache is None:
+            cache = self._cache = LRUCache(self.maxsize)
+        try:
+            output = cache.get(key)
+        except TypeError:
+            return super().__call__(*args, **kwargs)
+        if output is None:
+            result = super().__call__(*args, **kwargs)
+            if hasattr(result.iterator, "__anext__"):
+                return flattener(self._store_async(key, result))
+            output = result.accumulate_str()
+            cache.set(key, output)
+        return literal(output)
+
+    async def _store_async(self, key, result):
+        output = "".join([x if type(x) is str else str(x) async for x in result])
+        self._cache.set(key, output)
+        yield output
+
+
 def patch_code_file_lines(code, filename, firstlineno, lnotab):
     code_args = (
         code.co_argcount,
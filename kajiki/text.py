@@ -10,16 +10,17 @@ Notable in this module are:
 * _Parser._parse_<tagname> - consumes the body of a tag and returns an ir.Node.
 """
 
+import ast
 import codecs
 import collections
-import io
 import re
 import shlex
-import tokenize
+import zlib
 from itertools import chain
 
 import kajiki
 from kajiki import ir
+from kajiki.util import find_braced_expr_end, number_annotation
 
 _pattern = r"""
 \$(?:
@@ -41,7 +42,16 @@ _pattern = r"""
 _re_pattern = re.compile(_pattern, re.VERBOSE | re.IGNORECASE | re.MULTILINE)
 
 
-def TextTemplate(source=None, filename=None, autoescape=False, encoding="utf-8"):  # noqa: FBT002, N802
+def TextTemplate(  # noqa: N802
+    source=None,
+    filename=None,
+    autoescape=False,  # noqa: FBT002
+    encoding="utf-8",
+    is_async=False,  # noqa: FBT002
+    accumulate=False,  # noqa: FBT002
+    escape=None,
+    fragment_cache=None,
+):
     assert source or filename, (  # noqa: S101
         "You must either provide a *source* argument " "or a *filename* argument to TextTemplate()."
     )
@@ -54,16 +64,12 @@ def TextTemplate(source=None, filename=None, autoescape=False, encoding="utf-8")
         source, str
     ), f"*source* must be a unicode string, not a {type(source)}"
     scanner = _Scanner(filename, source)
-    tree = _Parser(scanner, autoescape).parse()
+    salt = kajiki.template.options_fingerprint(autoescape=autoescape, escape=escape or "kajiki")
+    tree = _Parser(scanner, autoescape, fragment_salt=salt).parse()
     tree.filename = filename
-    return kajiki.template.from_ir(tree)
-
-
-def _diff_pos(last_pos, new_pos):
-    """Compute the number of characters between line/column 2-tuples."""
-    if last_pos[0] == new_pos[0]:
-        return new_pos[1] - last_pos[1]
-    return new_pos[1]
+    return kajiki.template.from_ir(
+        tree, is_async=is_async, accumulate=accumulate, escape=escape, fragment_cache=fragment_cache
+    )
 
 
 class _Scanner:
@@ -74,8 +80,19 @@ class _Scanner:
         self.pos = 0
 
     def __iter__(self):
+        """Scan the source once, from start to end.
+
+        Each match of the pattern is searched from the end of the
+        previous token, so that the source of expressions and tags
+        is never scanned again.
+        """
         source = self.source
-        for mo in _re_pattern.finditer(source):
+        search_pos = 0
+        while True:
+            mo = _re_pattern.search(source, search_pos)
+            if mo is None:
+                break
+            search_pos = mo.end()
             start = mo.start()
             if start > self.pos:
                 yield self.text(source[self.pos : start])
@@ -106,6 +123,7 @@ class _Scanner:
                 for i, line in enumerate(self.source.splitlines(), 1):
                     msg += f"{i:3} {line}\n"
                 raise SyntaxError(msg)
+            search_pos = max(search_pos, self.pos)
         if self.pos != len(source):
             yield self.text(source[self.pos :])
 
@@ -152,33 +170,17 @@ class _Scanner:
         return self.tag(tagname, body)
 
     def _get_braced_expr(self):
-        braces = 0
-
-        # We start at the brace right before the current scanner's
-        # position, as we don't want Python's tokenizer to complain
-        # when it sees the closing brace.  In other words, make it
-        # always start and finish with balanced braces.
-        src_io = io.StringIO(self.source[self.pos - 1 :])
-        text_len = -1
-
-        last_end = (1, 0)
-        for token in tokenize.generate_tokens(src_io.readline):
-            if token.string == "{":
-                braces += 1
-            if token.string == "}":
-                braces -= 1
-
-            text_len += _diff_pos(last_end, token.end)
-            last_end = token.end
-            if not braces:
-                text = self.source[self.pos : self.pos + text_len - 1]
-                self.pos += text_len
-                return self.expr(text)
-        return None
+        end = find_braced_expr_end(self.source, self.pos)
+        if end < 0:
+            msg = "Braced expression not terminated"
+            raise kajiki.template.KajikiSyntaxError(msg, self.source, self.filename, self.lineno, 0)
+        text = self.source[self.pos : end]
+        self.pos = end + 1
+        return self.expr(text)
 
 
 class _Parser:
-    def __init__(self, tokenizer, autoescape=False):  # noqa: FBT002
+    def __init__(self, tokenizer, autoescape=False, fragment_salt=""):  # noqa: FBT002
         self.tokenizer = tokenizer
         self.functions = collections.defaultdict(list)
         self.functions["__main__()"] = []
@@ -187,12 +189,15 @@ class _Parser:
         self.autoescape = autoescape
         self._in_def = False
         self._is_child = False
+        self.dependencies = []
+        self.cache_fragments = 0
+        self.fragment_salt = fragment_salt
 
     def parse(self):
         body = list(self._parse_body())
         self.functions["__main__()"] = body[:-1]
         defs = [ir.DefNode(k, *v) for k, v in self.functions.items()]
-        return ir.TemplateNode(self.mod_py, defs)
+        return ir.TemplateNode(self.mod_py, defs, self.dependencies)
 
     def text(self, token):
         text = "".join(_unescape_newlines(token.text))
@@ -202,7 +207,12 @@ class _Parser:
         return node
 
     def expr(self, token):
-        node = ir.ExprNode(token.text, safe=not self.autoescape)
+        number_text = number_annotation(token.text)
+        if number_text is not None:
+            # Numbers never need to be escaped.
+            node = ir.ExprNode(number_text, safe=True)
+        else:
+            node = ir.ExprNode(token.text, safe=not self.autoescape)
         node.filename = token.filename
         node.lineno = token.lineno
         return node
@@ -274,16 +284,42 @@ class _Parser:
         body = list(self._parse_body("end"))
         return ir.ElseNode(*body[:-1])
 
+    def _parse_cache(self, token):
+        """Parse ``{%cache key%}`` or ``{%cache key, ttl=seconds%}``."""
+        call = f"_({token.body})"
+        try:
+            tree = compile(call, token.filename, "eval", ast.PyCF_ONLY_AST | ast.PyCF_ALLOW_TOP_LEVEL_AWAIT)
+            keywords = {kw.arg: kw.value for kw in tree.body.keywords}
+            (key,) = tree.body.args or [keywords.pop("key")]
+            ttl = keywords.pop("ttl", None)
+            if keywords:
+                raise KeyError(next(iter(keywords)))
+        except (SyntaxError, KeyError, ValueError) as e:
+            msg = f"Invalid cache directive {token.body.strip()!r}"
+            raise kajiki.template.KajikiSyntaxError(msg, self.tokenizer.source, token.filename, token.lineno, 0) from e
+        self.cache_fragments += 1
+        checksum = zlib.crc32(f"{self.fragment_salt}\n{self.tokenizer.source}".encode())
+        fragment_id = f"{token.filename}:{token.lineno}:{self.cache_fragments}:{checksum:08x}"
+        body = list(self._parse_body("end"))
+        return ir.CacheNode(
+            fragment_id,
+            ast.get_source_segment(call, key),
+            ttl and ast.get_source_segment(call, ttl),
+            *body[:-1],
+        )
+
     def _parse_extends(self, token):
         parts = shlex.split(token.body)
         fn = parts[0]
         assert len(parts) == 1  # noqa: S101
         self._is_child = True
+        self.dependencies.append(("extends", fn))
         return ir.ExtendNode(fn)
 
     def _parse_import(self, token):
         parts = shlex.split(token.body)
         fn = parts[0]
+        self.dependencies.append(("import", fn))
         if len(parts) > 1:
             assert parts[1] == "as"  # noqa: S101
             return ir.ImportNode(fn, parts[2])
@@ -293,6 +329,7 @@ class _Parser:
         parts = shlex.split(token.body)
         fn = parts[0]
         assert len(parts) == 1  # noqa: S101
+        self.dependencies.append(("include", fn))
         return ir.IncludeNode(fn)
 
     def _parse_py(self, token):
@@ -1,4 +1,5 @@
 import os.path
+import re
 from collections import deque
 from random import randint
 from threading import local
@@ -9,11 +10,39 @@ def expose(func):
     return func
 
 
+def memoize(scope="render"):
+    """Make a template function cache its output by arguments.
+
+    The output is cached for the ``scope`` of a single ``"render"``
+    or of the whole ``"process"``, see :class:`kajiki.template.MemoizedTplFunc`.
+    """
+    if scope not in ("render", "process"):
+        msg = f"Unknown memoize scope {scope!r}, expected 'render' or 'process'"
+        raise ValueError(msg)
+
+    def decorate(func):
+        func.memoize = scope
+        return func
+
+    return decorate
+
+
 class flattener:  # noqa: N801
-    def __init__(self, iterator):
-        while type(iterator) == flattener:
+    """The output of a template function, flattening the nested outputs.
+
+    With an ``escape`` function, the output is escaped by it as it is
+    iterated, nested outputs included, which is how values rendered in
+    attributes are escaped without collecting them first.
+    """
+
+    def __init__(self, iterator, escape=None):
+        while type(iterator) == flattener and iterator.escape is None:
             iterator = iterator.iterator
+        if type(iterator) == flattener:
+            # Keep the escaping of the nested output.
+            iterator = iter((iterator,))
         self.iterator = iterator
+        self.escape = escape
 
     @classmethod
     def decorate(cls, func):
@@ -22,35 +51,78 @@ class flattener:  # noqa: N801
 
         return inner
 
+    def __add__(self, other):
+        # Concatenated to the text around an attribute value by the
+        # generated code, without rendering it.
+        return flattener(iter((self, other)))
+
+    def __radd__(self, other):
+        return flattener(iter((other, self)))
+
     def accumulate_str(self):
-        if type(self.iterator) == flattener:
-            return self.iterator.accumulate_str()
-        s = ""
-        iter_stack = [self.iterator]
+        """Return the whole output as a single string."""
+        parts = []
+        append = parts.append
+        for x in self:
+            append(x if type(x) is str else str(x))
+        return "".join(parts)
+
+    def __iter__(self):
+        """Iterate over the output, walking nested flatteners with a stack.
+
+        Nested template functions, however deep, are iterated without
+        a generator frame per level of nesting, nor recursion.
+        """
+        iter_stack = []
+        it = iter(self.iterator)
+        # The escape functions of the output being iterated, as a linked
+        # list of (escape, outer escapes) pairs, innermost first.
+        escapes = None if self.escape is None else (self.escape, None)
+        while True:
+            for x in it:
+                if type(x) == flattener:
+                    iter_stack.append((it, escapes))
+                    it = iter(x.iterator)
+                    if x.escape is not None:
+                        escapes = (x.escape, escapes)
+                    break
+                if x is not None:
+                    if escapes is not None:
+                        x = _escape_with(escapes, x)
+                    yield x
+            else:
+                if not iter_stack:
+                    return
+                it, escapes = iter_stack.pop()
+
+    async def __aiter__(self):
+        """Iterate over the output of both synchronous and asynchronous iterators."""
+        iter_stack = [(self.iterator, None if self.escape is None else (self.escape, None))]
         while iter_stack:
+            it, escapes = iter_stack[-1]
             try:
-                x = next(iter_stack[-1])
-            except StopIteration:
+                x = await it.__anext__() if hasattr(it, "__anext__") else next(it)
+            except (StopIteration, StopAsyncIteration):
                 iter_stack.pop()
                 continue
             if type(x) == flattener:
-                iter_stack.append(x.iterator)
-            elif x is None:
-                pass
-            else:
-                s += x
-        return s
-
-    def __iter__(self):
-        for x in self.iterator:
-            if type(x) == flattener:
-                for xx in x:
-                    if xx is not None:
-                        yield xx
+                if x.escape is not None:
+                    escapes = (x.escape, escapes)
+                iter_stack.append((x.iterator, escapes))
             elif x is not None:
+                if escapes is not None:
+                    x = _escape_with(escapes, x)
                 yield x
 
 
+def _escape_with(escapes, x):
+    """Escape ``x`` by the linked list of ``escapes`` of :class:`flattener`."""
+    while escapes is not None:
+        escape, escapes = escapes
+        x = escape(x)
+    return x
+
+
 def literal(text):
     return flattener(iter([text]))
 
@@ -90,3 +162,81 @@ def window(seq, n=2):
 
 def default_alias_for(name):
     return os.path.splitext(os.path.basename(name))[0]
+
+
+_braced_expr_re = re.compile(r"""[{}]|#[^\n]*|(?P<quote>'{3}|"{3}|'|")""")
+_string_end_res = {
+    quote: re.compile(r"\\.|" + quote + ("" if len(quote) == 3 else r"|\n"), re.DOTALL)
+    for quote in ("'''", '"""', "'", '"')
+}
+
+
+def find_braced_expr_end(source, pos):
+    """Find the end of the Python expression starting at ``source[pos]``.
+
+    The expression is expected to follow an opening brace, this returns
+    the position of the matching closing brace, skipping braces inside
+    nested braces, string literals and comments, or -1 when the source
+    ends first (or inside a string literal).
+
+    This only scans the expression itself, so that finding all the
+    expressions of a template takes linear time.
+    """
+    depth = 1
+    while True:
+        mo = _braced_expr_re.search(source, pos)
+        if mo is None:
+            return -1
+        pos = mo.end()
+        token = mo.group()
+        if token == "{":
+            depth += 1
+        elif token == "}":
+            depth -= 1
+            if not depth:
+                return mo.start()
+        elif mo.group("quote"):
+            end_re = _string_end_res[token]
+            while True:
+                mo = end_re.search(source, pos)
+                if mo is None or mo.group() == "\n":
+                    return -1
+                pos = mo.end()
+                if mo.group() == token:
+                    break
+
+
+_number_annotation_re = re.compile(r"\s*(int|float)\s*:(?!=)")
+
+# Types accepted by each number annotation, subclasses might override __str__.
+_NUMBER_ANNOTATIONS = {
+    "int": frozenset((int, bool)),
+    "float": frozenset((float, int, bool)),
+}
+
+
+def number_annotation(text):
+    """Convert an expression annotated as a number, such as ``int: len(x)``.
+
+    The annotation tells that the expression evaluates to a number,
+    which can be rendered without escaping. This returns the expression
+    rendered by :func:`render_number`, so that a wrong annotation can't
+    inject markup, or ``None`` when ``text`` isn't annotated.
+    """
+    mo = _number_annotation_re.match(text)
+    if mo is None:
+        return None
+    return f"__kj__.util.render_number(({text[mo.end() :]}), {mo.group(1)!r})"
+
+
+def render_number(value, annotation):
+    """Render the ``value`` of an expression annotated as a number.
+
+    It is rendered like the same expression without annotation, once
+    checked to be of a type allowed by ``annotation``, ``"int"`` or
+    ``"float"``; a ``TypeError`` is raised otherwise.
+    """
+    if type(value) not in _NUMBER_ANNOTATIONS[annotation]:
+        msg = f"Expression annotated as {annotation} evaluated to {type(value).__name__}"
+        raise TypeError(msg)
+    return str(value)
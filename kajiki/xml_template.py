@@ -1,20 +1,20 @@
 import abc
+import ast
 import collections
 import html
 import io
 import re
+import zlib
 from codecs import open
 from sys import version_info
 from xml import sax
-from xml.dom import minidom as dom
 from xml.sax import SAXParseException
 
 from kajiki import ir, template
 from kajiki.doctype import DocumentTypeDeclaration, extract_dtd
 from kajiki.html_utils import HTML_CDATA_TAGS, HTML_OPTIONAL_END_TAGS, HTML_REQUIRED_END_TAGS
 from kajiki.markup_template import QDIRECTIVES, QDIRECTIVES_DICT
-
-impl = dom.getDOMImplementation(" ")
+from kajiki.util import find_braced_expr_end, number_annotation
 
 
 def XMLTemplate(  # noqa: N802
@@ -27,11 +27,16 @@ def XMLTemplate(  # noqa: N802
     cdata_scripts=True,  # noqa: FBT002
     strip_text=False,  # noqa: FBT002
     base_globals=None,
+    is_async=False,  # noqa: FBT002
+    accumulate=False,  # noqa: FBT002
+    escape=None,
+    sort_attrs=True,  # noqa: FBT002
+    fragment_cache=None,
 ):
     """Given XML source code of a Kajiki Templates parses and returns
     a template class.
 
-    The source code is parsed to its DOM representation by
+    The source code is parsed to a tree of nodes by
     :class:`._Parser`, which is then expanded to separate directives
     from tags by :class:`._DomTransformer` and then compiled to the
     *Intermediate Representation* tree by :class:`._Compiler`.
@@ -45,6 +50,24 @@ def XMLTemplate(  # noqa: N802
 
     Calling ``.render()`` on an instance of the generate class will
     then render the template.
+
+    With ``is_async`` the template is compiled to asynchronous code,
+    which can ``await`` inside expressions and iterate asynchronous
+    iterables with ``py:for="async x in items"``. It has to be
+    rendered through ``.render_async()``.
+
+    With ``accumulate`` the template functions append their output to
+    a list instead of being generators, which renders faster templates
+    made of many nested functions and blocks.
+
+    ``escape`` selects the function escaping the rendered values, see
+    :func:`kajiki.template.escape_function`.
+
+    With ``sort_attrs`` false the attributes of ``py:attrs`` are
+    rendered in the order of the mapping instead of being sorted.
+
+    ``fragment_cache`` is the backend storing the output of ``py:cache``
+    fragments, :data:`kajiki.cache.default_cache` by default.
     """
     if source is None:
         with open(filename, encoding=encoding) as f:
@@ -60,8 +83,17 @@ def XMLTemplate(  # noqa: N802
         is_fragment=is_fragment,
         autoblocks=autoblocks,
         cdata_scripts=cdata_scripts,
+        sort_attrs=sort_attrs,
+        fragment_salt=template.options_fingerprint(strip_text=strip_text, escape=escape or "kajiki"),
     ).compile()
-    return template.from_ir(ir_, base_globals=base_globals)
+    return template.from_ir(
+        ir_,
+        base_globals=base_globals,
+        is_async=is_async,
+        accumulate=accumulate,
+        escape=escape,
+        fragment_cache=fragment_cache,
+    )
 
 
 def annotate(gen):
@@ -74,7 +106,7 @@ def annotate(gen):
 
 
 class _Compiler:
-    """Compiles a DOM tree into IR :class:`kajiki.ir.TemplateNode`.
+    """Compiles a tree of nodes into IR :class:`kajiki.ir.TemplateNode`.
 
     Intermediate Representation is a tree of nodes that represent
     Python Code that should be generated to execute the template.
@@ -88,27 +120,44 @@ class _Compiler:
         is_fragment=False,  # noqa: FBT002
         autoblocks=None,
         cdata_scripts=True,  # noqa: FBT002
+        sort_attrs=True,  # noqa: FBT002
+        fragment_salt="",
     ):
+        """``fragment_salt`` identifies the options affecting the output
+        which are not given to the compiler, see :meth:`_compile_cache`.
+        """
         self.filename = filename
         self.doc = doc
         self.is_fragment = is_fragment
         self.functions = collections.defaultdict(list)
         self.functions["__main__()"] = []
         self.function_lnos = {}
+        self.memoized = {}
         self.mod_py = []
         self.autoblocks = autoblocks or []
         self.cdata_scripts = cdata_scripts
+        self.sort_attrs = sort_attrs
         self.in_def = False
         self.is_child = False
+        self.dependencies = []
+        self.cache_fragments = 0
         # The rendering mode is either specified in the *mode* argument,
         # or inferred from the DTD:
-        self._dtd = DocumentTypeDeclaration.matching(self.doc._dtd)  # noqa: SLF001
+        self._dtd = DocumentTypeDeclaration.matching(self.doc.dtd)
         if mode:
             self.mode = mode
         elif self._dtd:
             self.mode = self._dtd.rendering_mode
         else:  # The template might contain an unknown DTD
             self.mode = "xml"  # by default
+        self.fragment_salt = template.options_fingerprint(
+            mode=self.mode,
+            is_fragment=is_fragment,
+            autoblocks=self.autoblocks,
+            cdata_scripts=cdata_scripts,
+            sort_attrs=sort_attrs,
+            salt=fragment_salt,
+        )
 
     def compile(self):
         """Compile the document provided by :class:`._Parser`.
@@ -132,7 +181,7 @@ class _Compiler:
             never be called twice or might lead to unexpected results.
         """
         templateNodes = [  # noqa: N806
-            n for n in self.doc.childNodes if not isinstance(n, dom.Comment)
+            n for n in self.doc.children if not isinstance(n, _Comment)
         ]
         if len(templateNodes) != 1:
             msg = "expected a single root node in document"
@@ -141,8 +190,8 @@ class _Compiler:
         body = list(self._compile_node(templateNodes[0]))
         # Never emit doctypes on fragments
         if not self.is_fragment and not self.is_child:
-            if self.doc._dtd:  # noqa: SLF001
-                dtd = self.doc._dtd  # noqa: SLF001
+            if self.doc.dtd:
+                dtd = self.doc.dtd
             elif self.mode == "html5":
                 dtd = "<!DOCTYPE html>"
             else:
@@ -155,10 +204,10 @@ class _Compiler:
         self.functions["__main__()"] = body
         defs = []
         for k, v in self.functions.items():
-            node = ir.DefNode(k, *v)
+            node = ir.DefNode(k, *v, memoize=self.memoized.get(k))
             node.lineno = self.function_lnos.get(k)
             defs.append(node)
-        node = ir.TemplateNode(self.mod_py, defs)
+        node = ir.TemplateNode(self.mod_py, defs, self.dependencies)
         node.filename = self.filename
         node.lineno = 0
         return node
@@ -170,23 +219,23 @@ class _Compiler:
         ir_node.lineno = dom_node.lineno
 
     def _is_autoblock(self, node):
-        if node.tagName not in self.autoblocks:
+        if node.tag not in self.autoblocks:
             return False
 
-        if node.hasAttribute("py:autoblock"):
-            guard = node.getAttribute("py:autoblock").lower()
+        if node.has("py:autoblock"):
+            guard = node.get("py:autoblock").lower()
             if guard not in ("false", "true"):
                 msg = "py:autoblock is evaluated at compile time " "and only accepts True/False constants"
                 raise ValueError(msg)
             if guard == "false":
                 # We throw away the attribute so it doesn't remain in rendered nodes.
-                node.removeAttribute("py:autoblock")
+                node.pop("py:autoblock")
                 return False
 
         return True
 
     def _compile_node(self, node):
-        """Convert a DOM node to its intermediate representation.
+        """Convert a node to its intermediate representation.
 
         Calls specific compile functions for special nodes and any
         directive that was expanded by :meth:`._DomTransformer._expand_directives`.
@@ -194,19 +243,19 @@ class _Compiler:
 
         Automatically converts any ``autoblock`` node to a ``py:block`` directive.
         """
-        if isinstance(node, dom.Comment):
+        if isinstance(node, _Comment):
             return self._compile_comment(node)
-        if isinstance(node, dom.Text):
+        if isinstance(node, _Text):
             return self._compile_text(node)
-        if isinstance(node, dom.ProcessingInstruction):
+        if isinstance(node, _ProcessingInstruction):
             return self._compile_pi(node)
         if self._is_autoblock(node):
             # Set the name of the block equal to the tag itself.
-            node.setAttribute("name", node.tagName)
+            node.set("name", node.tag)
             return self._compile_block(node)
-        if node.tagName.startswith("py:"):
+        if node.tag.startswith("py:"):
             # Handle directives
-            compiler = getattr(self, "_compile_{}".format(node.tagName.split(":")[-1]), self._compile_xml)
+            compiler = getattr(self, "_compile_{}".format(node.tag.split(":")[-1]), self._compile_xml)
             return compiler(node)
         return self._compile_xml(node)
 
@@ -229,15 +278,15 @@ class _Compiler:
         compile the children too.
         """
         content = attrs = guard = None
-        if node.hasAttribute("py:strip"):
-            guard = node.getAttribute("py:strip")
+        if node.has("py:strip"):
+            guard = node.get("py:strip")
             if guard == "":  # py:strip="" means yes, do strip the tag  # noqa: SIM108
                 guard = "False"
             else:
                 guard = f"not ({guard})"
-            node.removeAttribute("py:strip")
-        yield ir.TextNode(f"<{node.tagName}", guard)
-        for k, v in sorted(node.attributes.items()):
+            node.pop("py:strip")
+        yield ir.TextNode(f"<{node.tag}", guard)
+        for k, v in sorted(node.attrs):
             tc = _TextCompiler(
                 self.filename,
                 v,
@@ -248,30 +297,30 @@ class _Compiler:
             )
             v = list(tc)  # noqa: PLW2901
             if k == "py:content":
-                content = node.getAttribute("py:content")
+                content = node.get("py:content")
                 continue
             elif k == "py:attrs":
-                attrs = node.getAttribute("py:attrs")
+                attrs = node.get("py:attrs")
                 continue
             yield ir.AttrNode(k, v, guard, self.mode)
         if attrs:
-            yield ir.AttrsNode(attrs, guard, self.mode)
+            yield ir.AttrsNode(attrs, guard, self.mode, self.sort_attrs)
         if content:
             yield ir.TextNode(">", guard)
             yield ir.ExprNode(content)
-            yield ir.TextNode(f"</{node.tagName}>", guard)
-        elif node.childNodes:
+            yield ir.TextNode(f"</{node.tag}>", guard)
+        elif node.children:
             yield ir.TextNode(">", guard)
-            if self.cdata_scripts and node.tagName in HTML_CDATA_TAGS:
+            if self.cdata_scripts and node.tag in HTML_CDATA_TAGS:
                 # Special behaviour for <script>, <style> tags:
                 if self.mode == "xml":  # Start escaping
                     yield ir.TextNode("/*<![CDATA[*/")
                 # Need to unescape the contents of these tags
-                for child in node.childNodes:
+                for child in node.children:
                     # CDATA for scripts and styles are automatically managed.
-                    if getattr(child, "_cdata", False):
+                    if child.cdata:
                         continue
-                    assert isinstance(child, dom.Text)  # noqa: S101
+                    assert isinstance(child, _Text)  # noqa: S101
                     for x in self._compile_text(child):
                         if child.escaped:  # If user declared CDATA no escaping happened.
                             x.text = html.unescape(x.text)
@@ -279,29 +328,43 @@ class _Compiler:
                 if self.mode == "xml":  # Finish escaping
                     yield ir.TextNode("/*]]>*/")
             else:
-                for cn in node.childNodes:
+                for cn in node.children:
                     # Keep CDATA sections around if declared by user
-                    if getattr(cn, "_cdata", False):
+                    if isinstance(cn, _Text) and cn.cdata:
                         yield ir.TextNode(cn.data)
                         continue
                     for x in self._compile_node(cn):
                         yield x
-            if not (self.mode.startswith("html") and node.tagName in HTML_OPTIONAL_END_TAGS):
-                yield ir.TextNode(f"</{node.tagName}>", guard)
-        elif node.tagName in HTML_REQUIRED_END_TAGS:
-            yield ir.TextNode(f"></{node.tagName}>", guard)
+            if not (self.mode.startswith("html") and node.tag in HTML_OPTIONAL_END_TAGS):
+                yield ir.TextNode(f"</{node.tag}>", guard)
+        elif node.tag in HTML_REQUIRED_END_TAGS:
+            yield ir.TextNode(f"></{node.tag}>", guard)
         elif self.mode.startswith("html"):
-            if node.tagName in HTML_OPTIONAL_END_TAGS:
+            if node.tag in HTML_OPTIONAL_END_TAGS:
                 yield ir.TextNode(">", guard)
             else:
-                yield ir.TextNode(f"></{node.tagName}>", guard)
+                yield ir.TextNode(f"></{node.tag}>", guard)
         else:
             yield ir.TextNode("/>", guard)
 
+    @annotate
+    def _compile_cache(self, node):
+        """Convert py:cache nodes to their intermediate representation.
+
+        The fragment is identified by the position of the directive and
+        the checksum of the template source and of the options affecting
+        its output, so that templates without a filename, or compiled
+        with other options, don't share their fragments.
+        """
+        self.cache_fragments += 1
+        checksum = zlib.crc32(f"{self.fragment_salt}\n{self.doc.source}".encode())
+        fragment_id = f"{self.filename}:{node.lineno}:{self.cache_fragments}:{checksum:08x}"
+        yield ir.CacheNode(fragment_id, node.get("key"), node.get("ttl") or None, *self._compile_nop(node))
+
     @annotate
     def _compile_replace(self, node):
         """Convert py:replace nodes to their intermediate representation."""
-        yield ir.ExprNode(node.getAttribute("value"))
+        yield ir.ExprNode(node.get("value"))
 
     @annotate
     def _compile_pi(self, node):
@@ -321,9 +384,10 @@ class _Compiler:
     @annotate
     def _compile_import(self, node):
         """Convert py:import nodes to their intermediate representation."""
-        href = node.getAttribute("href")
-        if node.hasAttribute("alias"):
-            yield ir.ImportNode(href, node.getAttribute("alias"))
+        href = node.get("href")
+        self.dependencies.append(("import", href))
+        if node.has("alias"):
+            yield ir.ImportNode(href, node.get("alias"))
         else:
             yield ir.ImportNode(href)
 
@@ -331,14 +395,16 @@ class _Compiler:
     def _compile_extends(self, node):
         """Convert py:extends nodes to their intermediate representation."""
         self.is_child = True
-        href = node.getAttribute("href")
+        href = node.get("href")
+        self.dependencies.append(("extends", href))
         yield ir.ExtendNode(href)
         yield from self._compile_nop(node)
 
     @annotate
     def _compile_include(self, node):
         """Convert py:include nodes to their intermediate representation."""
-        href = node.getAttribute("href")
+        href = node.get("href")
+        self.dependencies.append(("include", href))
         yield ir.IncludeNode(href)
 
     @annotate
@@ -348,12 +414,13 @@ class _Compiler:
         Any compiled block will be registered in the compiler functions
         registry to be provided to the template.
         """
-        fname = "_kj_block_" + node.getAttribute("name")
+        fname = "_kj_block_" + node.get("name")
         decl = fname + "()"
         body = list(self._compile_nop(node))
         if not body:
             body = [ir.PassNode()]
         self.functions[decl] = body
+        self.function_lnos[decl] = node.lineno
         if self.is_child:
             parent_block = "parent." + fname
             body.insert(0, ir.PythonNode(ir.TextNode(f"parent_block={parent_block}")))
@@ -366,29 +433,47 @@ class _Compiler:
 
         Any compiled definition will be registered in the compiler functions
         registry to be provided to the template.
+
+        ``py:memoize`` makes a top level function cache its output,
+        for the current render (``""`` or ``"render"``) or for the
+        whole process (``"process"``).
         """
+        memoize = None
+        if node.has("py:memoize"):
+            memoize = node.get("py:memoize") or "render"
+            if self.in_def or memoize not in ("render", "process"):
+                msg = "py:memoize must be 'render' or 'process' and can only be used on top level py:def"
+                raise XMLTemplateCompileError(
+                    msg,
+                    doc=self.doc,
+                    filename=self.filename,
+                    linen=node.lineno,
+                )
         old_in_def, self.in_def = self.in_def, True
         body = list(self._compile_nop(node))
         self.in_def = old_in_def
         if self.in_def:
-            yield ir.InnerDefNode(node.getAttribute("function"), *body)
+            yield ir.InnerDefNode(node.get("function"), *body)
         else:
-            self.functions[node.getAttribute("function")] = body
+            self.functions[node.get("function")] = body
+            self.function_lnos[node.get("function")] = node.lineno
+            if memoize:
+                self.memoized[node.get("function")] = memoize
 
     @annotate
     def _compile_call(self, node):
         """Convert py:call nodes to their intermediate representation."""
-        if node.childNodes[0].hasAttribute("args"):
-            defn = "$caller(" + node.childNodes[0].getAttribute("args") + ")"
+        if node.children[0].has("args"):
+            defn = "$caller(" + node.children[0].get("args") + ")"
         else:
             defn = "$caller()"
-        yield ir.CallNode(defn, node.getAttribute("function").replace("%caller", "$caller"), *self._compile_nop(node))
+        yield ir.CallNode(defn, node.get("function").replace("%caller", "$caller"), *self._compile_nop(node))
 
     @annotate
     def _compile_text(self, node):
         """Compile text nodes to their intermediate representation"""
         kwargs = {}
-        if node.parentNode and node.parentNode.tagName in HTML_CDATA_TAGS:
+        if node.parent and node.parent.tag in HTML_CDATA_TAGS:
             # script and style should always be untranslatable.
             kwargs["node_type"] = ir.TextNode
 
@@ -404,12 +489,12 @@ class _Compiler:
     @annotate
     def _compile_for(self, node):
         """Convert py:for nodes to their intermediate representation."""
-        yield ir.ForNode(node.getAttribute("each"), *list(self._compile_nop(node)))
+        yield ir.ForNode(node.get("each"), *list(self._compile_nop(node)))
 
     @annotate
     def _compile_with(self, node):
         """Convert py:with nodes to their intermediate representation."""
-        yield ir.WithNode(node.getAttribute("vars"), *list(self._compile_nop(node)))
+        yield ir.WithNode(node.get("vars"), *list(self._compile_nop(node)))
 
     @annotate
     def _compile_switch(self, node):
@@ -430,7 +515,7 @@ class _Compiler:
                 )
             body.append(n)
 
-        yield ir.SwitchNode(node.getAttribute("test"), *body)
+        yield ir.SwitchNode(node.get("test"), *body)
 
     @annotate
     def _compile_match(self, node):
@@ -459,15 +544,15 @@ class _Compiler:
                 )
             body.append(n)
 
-        yield ir.MatchNode(node.getAttribute("on"), *body)
+        yield ir.MatchNode(node.get("on"), *body)
 
     @annotate
     def _compile_case(self, node):
         """Convert py:case nodes to their intermediate representation."""
-        if node.getAttribute("value"):
-            yield ir.CaseNode(node.getAttribute("value"), *list(self._compile_nop(node)))
-        elif node.getAttribute("match"):
-            yield ir.MatchCaseNode(node.getAttribute("match"), *list(self._compile_nop(node)))
+        if node.get("value"):
+            yield ir.CaseNode(node.get("value"), *list(self._compile_nop(node)))
+        elif node.get("match"):
+            yield ir.MatchCaseNode(node.get("match"), *list(self._compile_nop(node)))
         else:
             msg = "case must have either value or match attribute, the former for py:switch, the latter for py:match"
             raise XMLTemplateCompileError(
@@ -480,15 +565,15 @@ class _Compiler:
     @annotate
     def _compile_if(self, node):
         """Convert py:if nodes to their intermediate representation."""
-        yield ir.IfNode(node.getAttribute("test"), *list(self._compile_nop(node)))
+        yield ir.IfNode(node.get("test"), *list(self._compile_nop(node)))
 
     @annotate
     def _compile_else(self, node):
         """Convert py:else nodes to their intermediate representation."""
         if (
-            getattr(node.parentNode, "tagName", "") != "py:nop"
-            and not node.parentNode.hasAttribute("py:switch")
-            and getattr(node.previousSibling, "tagName", "") != "py:if"
+            node.parent.tag != "py:nop"
+            and not node.parent.has("py:switch")
+            and getattr(node.previous_sibling(), "tag", "") != "py:if"
         ):
             msg = (
                 "py:else directive must be inside a py:switch or directly after py:if "
@@ -505,7 +590,7 @@ class _Compiler:
 
     @annotate
     def _compile_nop(self, node):
-        for c in node.childNodes:
+        for c in node.children:
             yield from self._compile_node(c)
 
 
@@ -551,10 +636,11 @@ class _TextCompiler:
         self.lineno += text.count("\n")
         return node
 
-    def expr(self, text):
+    def expr(self, text, number=False):  # noqa: FBT002
         # *safe* being True here avoids escaping twice, since
         # HTML attributes are always escaped in the end.
-        node = ir.ExprNode(text, safe=self.in_html_attr)
+        # Numbers never need to be escaped.
+        node = ir.ExprNode(text, safe=self.in_html_attr or number)
         node.lineno = self.real_lineno
         self.lineno += text.count("\n")
         return node
@@ -594,51 +680,21 @@ class _TextCompiler:
             yield self.text(source[self.pos :])
 
     def _get_braced_expr(self):
-        # see https://github.com/nandoflorestan/kajiki/pull/38
-        # Trying to get the position of a closing } in braced expressions
-        # So, self.source can be something like `1+1=${1+1} ahah`
-        # in this case this function gets called only once with
-        # self.pos equal to 6 this function must return the result of
-        # self.expr('1+1') and must set self.pos to 9
-        def py_expr(end=None):
-            return self.source[self.pos : end]
-
-        try:
-            self.pos += len(py_expr()) - len(py_expr().lstrip())
-            compile(py_expr(), "find_}", "eval")
-        except SyntaxError as se:
-            end = sum(
-                [self.pos, se.offset]
-                + [len(line) + 1 for idx, line in enumerate(py_expr().splitlines()) if idx < se.lineno - 1]
-            )
-            if py_expr(end)[-1] != "}":
-                # for example unclosed strings
-                msg = f"Kajiki can't compile the python expression `{py_expr()[:-1]}`"
-                raise XMLTemplateCompileError(
-                    msg,
-                    doc=self.doc,
-                    filename=self.filename,
-                    linen=self.lineno,
-                ) from None
-
-            # if the expression ends in a } then it may be valid
+        # self.source can be something like `1+1=${1+1} ahah`, in this
+        # case this function gets called with self.pos equal to 6 and
+        # must return the result of self.expr('1+1') and set self.pos to 10
+        source = self.source
+        while self.pos < len(source) and source[self.pos].isspace():
+            self.pos += 1
+        end = find_braced_expr_end(source, self.pos)
+        if end < 0:
             try:
-                compile(py_expr(end - 1), "check_validity", "eval")
+                compile(source[self.pos :], "find_}", "eval", flags=ast.PyCF_ALLOW_TOP_LEVEL_AWAIT)
             except SyntaxError:
-                # for example + operators with a single operand
-                msg = f"Kajiki detected an invalid python expression `{py_expr()[:-1]}`"
-                raise XMLTemplateCompileError(
-                    msg,
-                    doc=self.doc,
-                    filename=self.filename,
-                    linen=self.lineno,
-                ) from None
-
-            py_text = py_expr(end - 1)
-            self.pos = end
-            return self.expr(py_text)
-        else:
-            msg = "Braced expression not terminated"
+                # for example unclosed strings
+                msg = f"Kajiki can't compile the python expression `{source[self.pos :]}`"
+            else:
+                msg = "Braced expression not terminated"
             raise XMLTemplateCompileError(
                 msg,
                 doc=self.doc,
@@ -646,9 +702,150 @@ class _TextCompiler:
                 linen=self.lineno,
             )
 
+        py_text = source[self.pos : end]
+        number_text = number_annotation(py_text)
+        if number_text is not None:
+            py_text = number_text
+        try:
+            compile(py_text, "check_validity", "eval", flags=ast.PyCF_ALLOW_TOP_LEVEL_AWAIT)
+        except SyntaxError:
+            # for example + operators with a single operand
+            msg = f"Kajiki detected an invalid python expression `{py_text}`"
+            raise XMLTemplateCompileError(
+                msg,
+                doc=self.doc,
+                filename=self.filename,
+                linen=self.lineno,
+            ) from None
+        self.pos = end + 1
+        return self.expr(py_text, number=number_text is not None)
+
+
+class _Node:
+    """Base class of the nodes of the tree built by :class:`._Parser`.
+
+    This is a lightweight replacement for the DOM, only providing
+    what :class:`._DomTransformer` and :class:`._Compiler` need.
+    """
+
+    __slots__ = ("lineno", "parent")
+
+    def __init__(self, lineno=0):
+        self.lineno = lineno
+        self.parent = None
+
+    def previous_sibling(self):
+        """Return the node right before this one in its parent, if any."""
+        if self.parent is None:
+            return None
+        siblings = self.parent.children
+        for i, node in enumerate(siblings):
+            if node is self:
+                return siblings[i - 1] if i else None
+        return None
+
+
+class _Element(_Node):
+    """An XML element.
+
+    Like :class:`xml.etree.ElementTree.Element`, attributes are read
+    and written through :meth:`get` and :meth:`set`, but they are
+    stored as a list of ``(name, value)`` pairs in ``attrs``.
+    """
+
+    __slots__ = ("attrs", "children", "tag")
+
+    def __init__(self, tag, attrs=None, lineno=0):
+        super().__init__(lineno)
+        self.tag = tag
+        self.attrs = attrs if attrs is not None else []
+        self.children = []
+
+    def __repr__(self):  # pragma no cover
+        return f"<{self.__class__.__name__} {self.tag}>"
+
+    def has(self, name):
+        return any(k == name for k, _ in self.attrs)
+
+    def get(self, name, default=""):
+        for k, v in self.attrs:
+            if k == name:
+                return v
+        return default
+
+    def set(self, name, value):
+        for i, (k, _) in enumerate(self.attrs):
+            if k == name:
+                self.attrs[i] = (name, value)
+                return
+        self.attrs.append((name, value))
+
+    def pop(self, name, default=""):
+        for i, (k, v) in enumerate(self.attrs):
+            if k == name:
+                del self.attrs[i]
+                return v
+        return default
+
+    def append(self, child):
+        child.parent = self
+        self.children.append(child)
+
+    def insert(self, index, child):
+        child.parent = self
+        self.children.insert(index, child)
+
+
+class _Document(_Element):
+    """Root of the tree, holding the DOCTYPE and source of the template."""
+
+    __slots__ = ("dtd", "source")
+
+    def __init__(self):
+        super().__init__(None)
+        self.dtd = ""
+        self.source = ""
+
+
+class _Text(_Node):
+    """Text of the document.
+
+    ``escaped`` tells whether XML special characters in ``data`` were
+    escaped (they are not in CDATA sections), ``cdata`` marks the
+    ``<![CDATA[`` and ``]]>`` delimiters of CDATA sections.
+    """
+
+    __slots__ = ("cdata", "data", "escaped")
+
+    def __init__(self, data, lineno=0, escaped=False, cdata=False):  # noqa: FBT002
+        super().__init__(lineno)
+        self.data = data
+        self.escaped = escaped
+        self.cdata = cdata
+
+    def __repr__(self):  # pragma no cover
+        return f"<{self.__class__.__name__} {self.data!r}>"
+
+
+class _Comment(_Node):
+    __slots__ = ("data",)
+
+    def __init__(self, data, lineno=0):
+        super().__init__(lineno)
+        self.data = data
+
+
+class _ProcessingInstruction(_Node):
+    __slots__ = ("data", "target")
+
+    def __init__(self, target, data, lineno=0):
+        super().__init__(lineno)
+        self.target = target
+        self.data = data
+
 
 class _Parser(sax.ContentHandler):
-    """Parse an XML template into a Tree of DOM Nodes.
+    """Parse an XML template into a tree of nodes.
 
     Nodes should then be passed to a `_Compiler` to be
     converted into the intermediate representation and
@@ -675,16 +872,16 @@ class _Parser(sax.ContentHandler):
             msg = "The template source must be a unicode string."
             raise TypeError(msg)
         self._els = []
-        self._doc = dom.Document()
+        self._doc = _Document()
         self._filename = filename
         # Store the original DTD in the document for the compiler to use later
-        self._doc._dtd, position, source = extract_dtd(source)  # noqa: SLF001
+        self._doc.dtd, position, source = extract_dtd(source)
         # Use our own DTD just for XML parsing
         self._source = source[:position] + self.DTD + source[position:]
         self._cdata_stack = []
 
     def parse(self):
-        """Parse an XML/HTML document to its DOM representation."""
+        """Parse an XML/HTML document to a tree of nodes."""
         self._parser = parser = sax.make_parser()  # noqa: S317
         parser.setFeature(sax.handler.feature_external_pes, False)
         parser.setFeature(sax.handler.feature_external_ges, False)
@@ -706,7 +903,7 @@ class _Parser(sax.ContentHandler):
                 e.getColumnNumber(),
             ) from None
 
-        self._doc._source = self._source  # noqa: SLF001
+        self._doc.source = self._source
         return self._doc
 
     # ContentHandler implementation
@@ -714,30 +911,22 @@ class _Parser(sax.ContentHandler):
         self._els.append(self._doc)
 
     def startElement(self, name, attrs):  # noqa: N802
-        el = self._doc.createElement(name)
-        el.lineno = self._parser.getLineNumber()
-        for k, v in attrs.items():
-            el.setAttribute(k, v)
-        self._els[-1].appendChild(el)
+        el = _Element(name, list(attrs.items()), self._parser.getLineNumber())
+        self._els[-1].append(el)
         self._els.append(el)
 
     def endElement(self, name):  # noqa: N802
         popped = self._els.pop()
-        assert name == popped.tagName  # noqa: S101
+        assert name == popped.tag  # noqa: S101
 
     def characters(self, content):
         should_escape = not self._cdata_stack
         if should_escape:
             content = sax.saxutils.escape(content)
-        node = self._doc.createTextNode(content)
-        node.lineno = self._parser.getLineNumber()
-        node.escaped = should_escape
-        self._els[-1].appendChild(node)
+        self._els[-1].append(_Text(content, self._parser.getLineNumber(), escaped=should_escape))
 
     def processingInstruction(self, target, data):  # noqa: N802
-        node = self._doc.createProcessingInstruction(target, data)
-        node.lineno = self._parser.getLineNumber()
-        self._els[-1].appendChild(node)
+        self._els[-1].append(_ProcessingInstruction(target, data, self._parser.getLineNumber()))
 
     def skippedEntity(self, name):  # noqa: N802
         # Deals with an HTML entity such as &nbsp; (XML itself defines
@@ -774,26 +963,18 @@ class _Parser(sax.ContentHandler):
 
     # LexicalHandler implementation
     def comment(self, text):
-        node = self._doc.createComment(text)
-        node.lineno = self._parser.getLineNumber()
-        self._els[-1].appendChild(node)
+        self._els[-1].append(_Comment(text, self._parser.getLineNumber()))
 
     def startCDATA(self):  # noqa: N802
-        node = self._doc.createTextNode("<![CDATA[")
-        node._cdata = True  # noqa: SLF001
-        node.lineno = self._parser.getLineNumber()
-        self._els[-1].appendChild(node)
+        self._els[-1].append(_Text("<![CDATA[", self._parser.getLineNumber(), cdata=True))
         self._cdata_stack.append(self._els[-1])
 
     def endCDATA(self):  # noqa: N802
-        node = self._doc.createTextNode("]]>")
-        node._cdata = True  # noqa: SLF001
-        node.lineno = self._parser.getLineNumber()
-        self._els[-1].appendChild(node)
+        self._els[-1].append(_Text("]]>", self._parser.getLineNumber(), cdata=True))
         self._cdata_stack.pop()
 
     def startDTD(self, name, pubid, sysid):  # noqa: N802
-        self._doc.doctype = impl.createDocumentType(name, pubid, sysid)
+        pass
 
     def endDTD(self):  # noqa: N802
         pass
@@ -802,7 +983,7 @@ class _Parser(sax.ContentHandler):
 class _DomTransformer:
     """Applies standard Kajiki transformations to a parsed document.
 
-    Given a document generated by :class:`.Parser` it applies some
+    Given a document generated by :class:`._Parser` it applies some
     node transformations that are necessary before applying the
     compilation steps to achieve result we usually expect.
 
@@ -818,119 +999,92 @@ class _DomTransformer:
         self._strip_text = strip_text
 
     def transform(self):
-        """Applies all the DOM transformations to the document.
+        """Applies all the transformations to the document.
+
+        The whole tree is transformed in a single traversal, each
+        element having its directives expanded and its text children
+        merged, split and stripped before moving on to its children.
 
         Calling this twice will do nothing as the result is persisted.
         """
         if self._transformed:
             return self.doc
 
-        self.doc = self._expand_directives(self.doc)
-        self.doc = self._merge_text_nodes(self.doc)
-        self.doc = self._extract_nodes_leading_and_trailing_spaces(self.doc)
-        if self._strip_text:
-            self.doc = self._strip_text_nodes(self.doc)
+        self._transform_children(self.doc)
+        self._transformed = True
         return self.doc
 
-    @classmethod
-    def _merge_text_nodes(cls, tree):
-        """Merges consecutive TextNodes into a single TextNode.
+    def _transform_children(self, tree):
+        """Transforms the children of ``tree``.
 
-        Nodes are replaced with a new node whose data contains the
-        concatenation of all replaced nodes data.
-        Any other node (including CDATA TextNodes) splits runs of TextNodes.
+        Consecutive text nodes are merged into a single text node, any
+        other node (including CDATA delimiters) splits runs of text nodes.
+        Merged text nodes are then passed to :meth:`_split_text`, and
+        elements to :meth:`_expand_directives`.
         """
-        if isinstance(tree, dom.Document):
-            cls._merge_text_nodes(tree.firstChild)
-            return tree
-        if not isinstance(getattr(tree, "tagName", None), str):
-            return tree
-
-        # Squash all successive text nodes into a single one.
-        merge_node = None
-        for child in list(tree.childNodes):
-            if isinstance(child, dom.Text) and not getattr(child, "_cdata", False):
-                if merge_node is None:
-                    merge_node = child.ownerDocument.createTextNode(child.data)
-                    merge_node.lineno = child.lineno
-                    merge_node.escaped = child.escaped
-                    tree.replaceChild(newChild=merge_node, oldChild=child)
+        children = []
+        text = None
+        for child in tree.children:
+            if isinstance(child, _Text) and not child.cdata:
+                if text is None:
+                    text, parts = child, [child.data]
                 else:
-                    merge_node.data = merge_node.data + child.data
-                    tree.removeChild(child)
-            else:
-                merge_node = None
-
-        # Apply squashing to all children of current node.
-        for child in tree.childNodes:
-            if not isinstance(child, dom.Text):
-                cls._merge_text_nodes(child)
-
-        return tree
-
-    @classmethod
-    def _extract_nodes_leading_and_trailing_spaces(cls, tree):
-        """Extract the leading and trailing spaces of TextNodes to
-        separate nodes.
+                    parts.append(child.data)
+                continue
+            if text is not None:
+                text.data = "".join(parts)
+                self._split_text(text, children)
+                text = None
+            if isinstance(child, _Element):
+                child = self._expand_directives(child, tree)  # noqa: PLW2901
+            children.append(child)
+        if text is not None:
+            text.data = "".join(parts)
+            self._split_text(text, children)
+        tree.children = children
+
+    def _split_text(self, node, children):
+        """Append the text ``node`` to ``children``, extracting its leading
+        and trailing spaces to separate nodes.
 
         This is explicitly intended to make i18n easier, as we don't
         want people having to pay attention to spaces at being and end
         of text when translating it. So those are always extracted and
         only the meaningful part is preserved for translation.
-        """
-        for child in tree.childNodes:
-            if isinstance(child, dom.Text):
-                if not getattr(child, "_cdata", False):
-                    if not child.data.strip():
-                        # Already a totally empty node, do nothing...
-                        continue
 
-                    lstripped_data = child.data.lstrip()
-                    if len(lstripped_data) != len(child.data):
-                        # There is text to strip at begin, create a
-                        # new text node with empty space
-                        empty_text_len = len(child.data) - len(lstripped_data)
-                        empty_text = child.data[:empty_text_len]
-                        begin_node = child.ownerDocument.createTextNode(empty_text)
-                        begin_node.lineno = child.lineno
-                        begin_node.escaped = child.escaped
-                        tree.insertBefore(newChild=begin_node, refChild=child)
-                        child.lineno += child.data[:empty_text_len].count("\n")
-                        child.data = lstripped_data
-
-                    rstripped_data = child.data.rstrip()
-                    if len(rstripped_data) != len(child.data):
-                        # There is text to strip at end, create a new
-                        # text node with empty space
-                        empty_text_len = len(child.data) - len(rstripped_data)
-                        empty_text = child.data[-empty_text_len:]
-                        end_node = child.ownerDocument.createTextNode(empty_text)
-                        end_node.lineno = child.lineno + child.data[:-empty_text_len].count("\n")
-                        end_node.escaped = child.escaped
-                        tree.replaceChild(newChild=end_node, oldChild=child)
-                        tree.insertBefore(newChild=child, refChild=end_node)
-                        child.data = rstripped_data
-            else:
-                cls._extract_nodes_leading_and_trailing_spaces(child)
-        return tree
+        When stripping text, the spaces are removed instead, moving the
+        line number of the nodes forward the amount of lines stripped.
+        """
+        data = node.data
+        stripped = data.strip()
+        if not stripped:
+            # Already a totally empty node, only strip it.
+            if self._strip_text:
+                node.lineno += data.count("\n")
+                node.data = ""
+            children.append(node)
+            return
 
-    @classmethod
-    def _strip_text_nodes(cls, tree):
-        """Strips empty characters in all text nodes."""
-        for child in tree.childNodes:
-            if isinstance(child, dom.Text):
-                if not getattr(child, "_cdata", False):
-                    # Move lineno forward the amount of lines we are
-                    # going to strip.
-                    lstripped_data = child.data.lstrip()
-                    child.lineno += child.data[: len(child.data) - len(lstripped_data)].count("\n")
-                    child.data = child.data.strip()
-            else:
-                cls._strip_text_nodes(child)
-        return tree
+        start = len(data) - len(data.lstrip())
+        end = start + len(stripped)
+        if start:
+            children.append(self._space(data[:start], node.lineno, node))
+            node.lineno += data[:start].count("\n")
+        node.data = stripped
+        children.append(node)
+        if end != len(data):
+            children.append(self._space(data[end:], node.lineno + stripped.count("\n"), node))
+
+    def _space(self, space, lineno, node):
+        """Return a text node with the spaces extracted from ``node``."""
+        if self._strip_text:
+            lineno += space.count("\n")
+            space = ""
+        space_node = _Text(space, lineno, escaped=node.escaped)
+        space_node.parent = node.parent
+        return space_node
 
-    @classmethod
-    def _expand_directives(cls, tree, parent=None):
+    def _expand_directives(self, tree, parent, tag=None):
         """Expands directives attached to nodes into separate nodes.
 
         This will convert all instances of::
@@ -948,53 +1102,52 @@ class _DomTransformer:
         This ensures that whenever a template is processed there is no
         difference between the two formats as the Compiler will always
         receive the latter.
+
+        Returns the node replacing ``tree`` in ``parent``, once the
+        children of ``tree`` have been transformed too.
+
+        ``tag`` is the tag the node had in the template, directive tags
+        are renamed ``py:nop``.
         """
-        if isinstance(tree, dom.Document):
-            cls._expand_directives(tree.firstChild, tree)
-            return tree
-        if not isinstance(getattr(tree, "tagName", None), str):
-            return tree
-        if tree.tagName in QDIRECTIVES_DICT:
-            attrs = QDIRECTIVES_DICT[tree.tagName]
+        if tag is None:
+            tag = tree.tag
+        if tree.tag in QDIRECTIVES_DICT:
+            attrs = QDIRECTIVES_DICT[tree.tag]
             if not isinstance(attrs, tuple):
                 attrs = [attrs]
             for attr in attrs:
-                tree.setAttribute(tree.tagName, tree.getAttribute(attr))
-            tree.tagName = "py:nop"
-        if tree.tagName != "py:nop" and tree.hasAttribute("py:extends"):
-            value = tree.getAttribute("py:extends")
-            el = tree.ownerDocument.createElement("py:extends")
-            el.setAttribute("href", value)
-            el.lineno = tree.lineno
-            tree.removeAttribute("py:extends")
-            tree.childNodes.insert(0, el)
+                tree.set(tree.tag, tree.get(attr))
+            tree.tag = "py:nop"
+        names = {k for k, _ in tree.attrs}
+        if tree.tag != "py:nop" and "py:extends" in names:
+            el = _Element("py:extends", [("href", tree.pop("py:extends"))], tree.lineno)
+            tree.insert(0, el)
+            names.discard("py:extends")
         for directive, attr in QDIRECTIVES:
-            if not tree.hasAttribute(directive):
+            if directive not in names:
                 continue
-            value = tree.getAttribute(directive)
-            tree.removeAttribute(directive)
-            # nsmap = (parent is not None) and parent.nsmap or tree.nsmap
-            el = tree.ownerDocument.createElement(directive)
-            el.lineno = tree.lineno
+            value = tree.pop(directive)
+            el = _Element(directive, lineno=tree.lineno)
             if isinstance(attr, tuple):
                 # eg: handle bare py:case tags
                 for at in attr:
-                    el.setAttribute(at, dict(tree.attributes.items()).get(at))
-                if directive == "py:case" and tree.nodeName != "py:case":
-                    if tree.parentNode.nodeName == "py:match" or "py:match" in tree.parentNode.attributes:
+                    el.set(at, tree.get(at, None))
+                if directive == "py:case" and tag != "py:case":
+                    if parent.tag == "py:match" or parent.has("py:match"):
                         at = "on"
                     else:
                         at = "value"
-                    el.setAttribute(at, value)
+                    el.set(at, value)
             elif attr:
-                el.setAttribute(attr, value)
-            # el.setsourceline = tree.sourceline
-            parent.replaceChild(newChild=el, oldChild=tree)
-            el.appendChild(tree)
-            cls._expand_directives(tree, el)
+                el.set(attr, value)
+            if directive == "py:cache" and tag == "py:cache":
+                el.set("ttl", tree.pop("ttl", None))
+            elif directive == "py:def" and tree.has("py:memoize"):
+                el.set("py:memoize", tree.pop("py:memoize"))
+            el.parent = parent
+            el.append(self._expand_directives(tree, el, tag))
             return el
-        for child in tree.childNodes:
-            cls._expand_directives(child, tree)
+        self._transform_children(tree)
         return tree
 
 
@@ -1011,7 +1164,7 @@ class XMLTemplateCompileError(XMLTemplateError):
     """
 
     def __init__(self, msg, doc, filename, linen):
-        super().__init__(msg, getattr(doc, "_source", ""), filename, linen, 0)
+        super().__init__(msg, getattr(doc, "source", ""), filename, linen, 0)
 
 
 class XMLTemplateParseError(XMLTemplateError):
@@ -2,12 +2,14 @@
 # ruff: noqa: T201
 
 import time
+import timeit
 from collections import defaultdict
 from contextlib import contextmanager
 
 from genshi.template import MarkupTemplate
 
-from kajiki import XMLTemplate
+from kajiki import TextTemplate, XMLTemplate
+from kajiki.text import _Scanner
 
 FN = "tests/data/tables.html"
 
@@ -25,24 +27,83 @@ def timing(s):
 
 with timing("compile.kajiki"):
     fpt = XMLTemplate(filename=FN)
+with timing("compile.kajiki.accumulate"):
+    fpt_acc = XMLTemplate(filename=FN, accumulate=True)
 with timing("compile.genshi"), open(FN) as f:
     gt = MarkupTemplate(f)
 with timing("render.100.kajiki"):
     fpt({"size": 100}).render()
+with timing("render.100.kajiki.accumulate"):
+    fpt_acc({"size": 100}).render()
 with timing("render.100.genshi"):
     gt.generate(size=100).render()
 with timing("render.100.kajiki"):
     fpt({"size": 100}).render()
+with timing("render.100.kajiki.accumulate"):
+    fpt_acc({"size": 100}).render()
 with timing("render.100.genshi"):
     gt.generate(size=100).render()
 with timing("render.100.kajiki"):
     fpt({"size": 100}).render()
+with timing("render.100.kajiki.accumulate"):
+    fpt_acc({"size": 100}).render()
 with timing("render.100.genshi"):
     gt.generate(size=100).render()
 with timing("render.500.kajiki"):
     fpt({"size": 500}).render()
+with timing("render.500.kajiki.accumulate"):
+    fpt_acc({"size": 500}).render()
 with timing("render.500.genshi"):
     gt.generate(size=500).render()
 print("Compile kajiki speedup:", timings["compile.genshi"] / timings["compile.kajiki"])
 print("Render 100 kajiki speedup:", timings["render.100.genshi"] / timings["render.100.kajiki"])
 print("Render 500 kajiki speedup:", timings["render.500.genshi"] / timings["render.500.kajiki"])
+print(
+    "Render 100 accumulate speedup:",
+    timings["render.100.kajiki"] / timings["render.100.kajiki.accumulate"],
+)
+print(
+    "Render 500 accumulate speedup:",
+    timings["render.500.kajiki"] / timings["render.500.kajiki.accumulate"],
+)
+
+# Scanning text templates must take linear time in the number of expressions.
+for n in (1000, 4000, 16000):
+    source = "".join(f"Line {i}: ${{items[{i}]}} and $name.attr\n" for i in range(n))
+    with timing(f"scan.text.{n}"):
+        list(_Scanner("<string>", source))
+    with timing(f"compile.text.{n}"):
+        TextTemplate(source)
+for n in (4000, 16000):
+    print(
+        f"Text scan time ratio {n}/{n // 4} (linear is 4):",
+        timings[f"scan.text.{n}"] / timings[f"scan.text.{n // 4}"],
+    )
+
+# Escaping of expressions, per value type.
+escape = fpt({})._escape
+for label, value in (
+    ("int", 12345),
+    ("float", 3.25),
+    ("short", "Hello world"),
+    ("short.escaped", "Tom & Jerry"),
+    ("long", "Lorem ipsum dolor sit amet " * 20),
+    ("long.escaped", "<p>Lorem ipsum dolor sit amet</p> " * 20),
+):
+    n = 100000
+    print(f"escape.{label}: {timeit.timeit(lambda v=value: escape(v), number=n) / n * 1e6:.3f} us")
+
+# Deeply nested template functions, like a tree of comments, must render
+# in linear time and without hitting the recursion limit.
+deep = XMLTemplate(
+    """<div><py:def function="tree(n)"><ul><li>$n${tree(n - 1) if n else None}</li></ul></py:def
+>${tree(depth)}</div>"""
+)
+for depth in (200, 800, 3200):
+    with timing(f"render.deep.{depth}"):
+        deep({"depth": depth}).render()
+for depth in (800, 3200):
+    print(
+        f"Deep render time ratio {depth}/{depth // 4} (linear is 4):",
+        timings[f"render.deep.{depth}"] / timings[f"render.deep.{depth // 4}"],
+    )
@@ -1,3 +1,4 @@
+import json
 import sys
 from unittest import mock
 
@@ -16,6 +17,9 @@ class MainMocks:
             def render(self, *args, **kwargs):
                 return mocked_render(*args, **kwargs)
 
+            def render_to(self, fp):
+                fp.write(self.render())
+
         self.template_type = mock.Mock(return_value=MockedTemplate())
 
         mocked_import = mock.Mock(return_value=self.template_type)
@@ -167,3 +171,110 @@ def test_toml_template_variables(tmp_path, main_mocks):
         }
     )
     main_mocks.render.assert_called_once_with()
+
+
+@pytest.fixture
+def batch_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "page.html").write_text('<div><h1>$title</h1><py:include href="footer.html"/></div>')
+    (tmp_path / "footer.html").write_text("<p>$site</p>")
+    (tmp_path / "note.txt").write_text("Note: $title")
+    return tmp_path
+
+
+def test_batch_json(batch_dir, capsys):
+    manifest = batch_dir / "manifest.json"
+    manifest.write_text(
+        json.dumps(
+            [
+                {"template": "page.html", "variables": {"title": "One"}, "output": "out/one.html"},
+                {"template": "page.html", "variables": {"title": "Two"}, "output": "out/two.html"},
+                {"template": "note.txt", "variables": {"title": "Three"}, "output": "out/three.txt"},
+            ]
+        )
+    )
+    main(["--batch", str(manifest), "-j", "2", "-v", "site=Site"])
+
+    assert (batch_dir / "out" / "one.html").read_text() == "<div><h1>One</h1><p>Site</p></div>"
+    assert (batch_dir / "out" / "two.html").read_text() == "<div><h1>Two</h1><p>Site</p></div>"
+    assert (batch_dir / "out" / "three.txt").read_text() == "Note: Three"
+
+    captured = capsys.readouterr()
+    assert captured.out == ""
+    assert captured.err.count("compiled ") == 2
+    assert "rendered out/two.html in " in captured.err
+
+
+@pytest.mark.skipif(sys.version_info < (3, 11), reason="tomllib new in python3.11")
+def test_batch_toml(batch_dir):
+    manifest = batch_dir / "manifest.toml"
+    manifest.write_text('[[jobs]]\ntemplate = "note.txt"\noutput = "note.out"\nvariables = {title = "TOML"}\n')
+    cache_dir = batch_dir / "cache"
+    main(["--batch", str(manifest), "-j", "1", "--cache-dir", str(cache_dir)])
+
+    assert (batch_dir / "note.out").read_text() == "Note: TOML"
+    assert list(cache_dir.glob("*.kjc"))
+
+
+def test_batch_bad_manifest(batch_dir, capsys):
+    manifest = batch_dir / "manifest.json"
+    manifest.write_text('[{"template": "page.html"}]')
+    with pytest.raises(SystemExit) as e:
+        main(["--batch", str(manifest)])
+
+    assert e.value.code != 0
+    assert "job 0 must have a template and an output" in capsys.readouterr().err
+
+
+def test_batch_failed_jobs(batch_dir, capsys):
+    (batch_dir / "broken.html").write_text("<div>")
+    (batch_dir / "error.html").write_text("<div>${1 // 0}</div>")
+    manifest = batch_dir / "manifest.json"
+    jobs = [
+        {"template": "broken.html", "output": "broken.out"},
+        {"template": "error.html", "output": "error.out"},
+        {"template": "note.txt", "output": "note.out", "variables": {"title": "Fine"}},
+    ]
+    manifest.write_text(json.dumps(jobs))
+    with pytest.raises(SystemExit) as e:
+        main(["--batch", str(manifest), "-j", "1"])
+
+    assert e.value.code == 1
+    err = capsys.readouterr().err
+    assert "broken.html -> broken.out: XMLTemplateParseError:" in err
+    assert "error.html -> error.out: ZeroDivisionError: integer division or modulo by zero" in err
+    assert "2 of 3 batch jobs failed" in err
+    assert (batch_dir / "note.out").read_text() == "Note: Fine"
+
+
+def test_batch_with_template(batch_dir, capsys):
+    (batch_dir / "manifest.json").write_text("[]")
+    with pytest.raises(SystemExit) as e:
+        main(["--batch", "manifest.json", "page.html", "out.html"])
+
+    assert e.value.code != 0
+    assert "file_or_package and output_file can't be used with --batch" in capsys.readouterr().err
+
+
+def test_batch_or_template_required(capsys):
+    with pytest.raises(SystemExit) as e:
+        main([])
+
+    assert e.value.code != 0
+    assert "either a file_or_package or a --batch manifest is required" in capsys.readouterr().err
+
+
+def test_profile(batch_dir, capsys):
+    main(["-v", "title=Hi", "-v", "site=Site", "--profile", "render.folded", "page.html"])
+
+    captured = capsys.readouterr()
+    assert captured.out == "<div><h1>Hi</h1><p>Site</p></div>"
+    assert "page.html:1" in captured.err
+    assert "footer.html" in captured.err
+    stacks = (batch_dir / "render.folded").read_text().splitlines()
+    assert stacks
+    for stack in stacks:
+        path, microseconds = stack.rsplit(" ", 1)
+        assert path.split(";")[0] == "page.html"
+        assert not path.endswith(":0")
+        assert microseconds.isdigit()
@@ -0,0 +1,330 @@
+import concurrent.futures
+import functools
+import threading
+import time
+
+import pytest
+
+import kajiki.loader
+import kajiki.xml_template
+from kajiki import FileLoader, PackageLoader
+
+
+def _write(path, text):
+    path.write_text(text, encoding="utf-8")
+    return path
+
+
+@pytest.fixture
+def tpl_dir(tmp_path):
+    tpl_dir = tmp_path / "templates"
+    tpl_dir.mkdir()
+    return tpl_dir
+
+
+def _no_parse(monkeypatch):
+    def fail(*args, **kwargs):
+        pytest.fail("template was parsed instead of loaded from cache")
+
+    monkeypatch.setattr(kajiki.xml_template._Parser, "parse", fail)
+
+
+def test_cache_dir_skips_compile(tmp_path, tpl_dir, monkeypatch):
+    _write(tpl_dir / "page.html", "<p>Hello, $name!</p>")
+    cache_dir = tmp_path / "cache"
+
+    tpl = FileLoader(path=str(tpl_dir), cache_dir=cache_dir).import_("page.html")
+    assert tpl({"name": "World"}).render() == "<p>Hello, World!</p>"
+    assert len(list(cache_dir.glob("*.kjc"))) == 1
+
+    _no_parse(monkeypatch)
+    tpl = FileLoader(path=str(tpl_dir), cache_dir=cache_dir).import_("page.html")
+    assert tpl({"name": "Cache"}).render() == "<p>Hello, Cache!</p>"
+    assert tpl.filename == str(tpl_dir / "page.html")
+
+
+def test_cache_keyed_by_source_and_options(tmp_path, tpl_dir):
+    page = _write(tpl_dir / "page.html", "<p>One</p>")
+    cache_dir = tmp_path / "cache"
+
+    FileLoader(path=str(tpl_dir), cache_dir=cache_dir).import_("page.html")
+    _write(page, "<p>Two</p>")
+    tpl = FileLoader(path=str(tpl_dir), cache_dir=cache_dir).import_("page.html")
+    assert tpl().render() == "<p>Two</p>"
+
+    tpl = FileLoader(path=str(tpl_dir), cache_dir=cache_dir, force_mode="html5").import_("page.html")
+    assert tpl().render() == "<!DOCTYPE html>\n<p>Two</p>"
+    assert len(list(cache_dir.glob("*.kjc"))) == 3
+
+
+def test_cache_keyed_by_compiler(tmp_path, tpl_dir, monkeypatch):
+    _write(tpl_dir / "page.html", "<p>One</p>")
+    cache_dir = tmp_path / "cache"
+
+    FileLoader(path=str(tpl_dir), cache_dir=cache_dir).import_("page.html")
+    # The code of kajiki changed, without a new version.
+    monkeypatch.setattr(kajiki.loader, "_compiler_fingerprint", lambda: "changed")
+    FileLoader(path=str(tpl_dir), cache_dir=cache_dir).import_("page.html")
+    assert len(list(cache_dir.glob("*.kjc"))) == 2
+
+    loader = FileLoader(path=str(tpl_dir), cache_dir=cache_dir)
+    loader.extension_map["html"] = lambda **kw: kajiki.XMLTemplate(mode="html5", **kw)
+    assert loader.import_("page.html")().render() == "<!DOCTYPE html>\n<p>One</p>"
+    assert len(list(cache_dir.glob("*.kjc"))) == 3
+
+
+def test_cache_keyed_by_compile_arguments(tmp_path, tpl_dir):
+    _write(tpl_dir / "page.html", "<p><br/></p>")
+    cache_dir = tmp_path / "cache"
+
+    def compiler(mode):
+        return lambda **kw: kajiki.XMLTemplate(mode=mode, **kw)
+
+    def render(compile_func):
+        loader = FileLoader(path=str(tpl_dir), cache_dir=cache_dir)
+        loader.extension_map["html"] = compile_func
+        return loader.import_("page.html")().render()
+
+    assert render(functools.partial(kajiki.XMLTemplate, mode="xml")) == "<p><br/></p>"
+    assert render(functools.partial(kajiki.XMLTemplate, mode="html5")) == "<!DOCTYPE html>\n<p><br></p>"
+    assert render(compiler("xml")) == "<p><br/></p>"
+    assert render(compiler("html5")) == "<!DOCTYPE html>\n<p><br></p>"
+    assert len(list(cache_dir.glob("*.kjc"))) == 4
+
+    # Closing over an object without a stable repr, not cached.
+    marker = object()
+    assert render(lambda **kw: kajiki.XMLTemplate(mode="xml", **kw) if marker else None) == "<p><br/></p>"
+    assert len(list(cache_dir.glob("*.kjc"))) == 4
+
+
+def test_cache_corrupted_entry(tmp_path, tpl_dir):
+    _write(tpl_dir / "page.txt", "Hello, $name!")
+    cache_dir = tmp_path / "cache"
+
+    FileLoader(path=str(tpl_dir), cache_dir=cache_dir).import_("page.txt")
+    (cache_file,) = cache_dir.glob("*.kjc")
+    cache_file.write_bytes(b"garbage")
+
+    tpl = FileLoader(path=str(tpl_dir), cache_dir=cache_dir).import_("page.txt")
+    assert tpl({"name": "World"}).render() == "Hello, World!"
+
+
+def test_cache_keeps_template_lines(tmp_path, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    PackageLoader(cache_dir=cache_dir).import_("kajiki_test_data.debug")
+
+    _no_parse(monkeypatch)
+    tpl = PackageLoader(cache_dir=cache_dir).import_("kajiki_test_data.debug")
+    with pytest.raises(ValueError, match="Test error") as exc_info:
+        tpl().render()
+    assert any(entry.path.name == "debug.html" for entry in exc_info.traceback)
+
+
+def test_concurrent_import_compiles_once(tpl_dir, monkeypatch):
+    _write(tpl_dir / "page.html", "<p>Hello, $name!</p>")
+    loader = FileLoader(path=str(tpl_dir))
+    loads = []
+    started = threading.Barrier(8)
+    load = loader._load
+
+    def slow_load(name, **kwargs):
+        loads.append(name)
+        time.sleep(0.05)
+        return load(name, **kwargs)
+
+    monkeypatch.setattr(loader, "_load", slow_load)
+
+    def import_page():
+        started.wait()
+        return loader.import_("page.html")
+
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        templates = list(executor.map(lambda _: import_page(), range(8)))
+
+    assert loads == ["page.html"]
+    assert all(tpl is templates[0] for tpl in templates)
+
+
+def _count_loads(loader, monkeypatch):
+    loads = []
+    load = loader._load
+
+    def counting_load(name, **kwargs):
+        loads.append(name)
+        return load(name, **kwargs)
+
+    monkeypatch.setattr(loader, "_load", counting_load)
+    return loads
+
+
+def test_reload_only_changed(tpl_dir, monkeypatch):
+    page = _write(tpl_dir / "page.html", "<p>One</p>")
+    loader = FileLoader(path=str(tpl_dir), reload=True)
+    loads = _count_loads(loader, monkeypatch)
+
+    tpl = loader.import_("page.html")
+    assert loader.import_("page.html") is tpl
+    assert loads == ["page.html"]
+
+    _write(page, "<p>Changed</p>")
+    assert loader.import_("page.html")().render() == "<p>Changed</p>"
+    assert loads == ["page.html", "page.html"]
+
+
+def test_reload_parent_changed(tpl_dir):
+    parent = _write(tpl_dir / "parent.html", '<div><py:block name="body">Parent</py:block></div>')
+    _write(tpl_dir / "child.html", '<py:extends href="parent.html"><py:block name="body">Child</py:block></py:extends>')
+    loader = FileLoader(path=str(tpl_dir), reload=True)
+    assert loader.import_("child.html")().render() == "<div>Child</div>"
+
+    _write(parent, '<section><py:block name="body">Parent</py:block></section>')
+    assert loader.import_("child.html")().render() == "<section>Child</section>"
+
+
+def test_reload_interval(tpl_dir, monkeypatch):
+    page = _write(tpl_dir / "page.html", "<p>One</p>")
+    loader = FileLoader(path=str(tpl_dir), reload=True, reload_interval=3600)
+    loads = _count_loads(loader, monkeypatch)
+
+    loader.import_("page.html")
+    _write(page, "<p>Changed</p>")
+    assert loader.import_("page.html")().render() == "<p>One</p>"
+    assert loads == ["page.html"]
+
+
+def test_reload_after_broken_change(tpl_dir):
+    page = _write(tpl_dir / "page.html", "<p>One</p>")
+    loader = FileLoader(path=str(tpl_dir), reload=True)
+    loader.import_("page.html")
+
+    _write(page, "<p>Broken")
+    for _ in range(2):
+        with pytest.raises(kajiki.xml_template.XMLTemplateParseError):
+            loader.import_("page.html")
+
+    _write(page, "<p>Fixed</p>")
+    assert loader.import_("page.html")().render() == "<p>Fixed</p>"
+
+
+@pytest.fixture
+def site_dir(tpl_dir):
+    _write(tpl_dir / "base.html", '<div><py:block name="body"/><py:include href="footer.html"/></div>')
+    _write(tpl_dir / "footer.html", "<footer>Footer</footer>")
+    _write(tpl_dir / "lib.html", '<py:def function="hello(name)">Hello, $name!</py:def>')
+    _write(
+        tpl_dir / "page.html",
+        '<py:extends href="base.html"><py:block name="body">'
+        '<py:import href="lib.html" alias="lib"/>${lib.hello("World")}</py:block></py:extends>',
+    )
+    return tpl_dir
+
+
+def test_template_dependencies(site_dir):
+    tpl = FileLoader(path=str(site_dir)).import_("page.html")
+    assert tpl.dependencies == (("extends", "base.html"), ("import", "lib.html"))
+
+
+def test_text_template_dependencies(tpl_dir):
+    _write(tpl_dir / "page.txt", '%extends "base.txt"\n%import "lib.txt" as lib\n%include "footer.txt"\n')
+    tpl = FileLoader(path=str(tpl_dir)).import_("page.txt")
+    assert tpl.dependencies == (("extends", "base.txt"), ("import", "lib.txt"), ("include", "footer.txt"))
+
+
+def test_loader_dependencies_preloads(site_dir, monkeypatch):
+    loader = FileLoader(path=str(site_dir))
+    assert loader.dependencies("page.html") == ["base.html", "lib.html", "footer.html"]
+    assert set(loader.modules) == {"page.html", "base.html", "lib.html", "footer.html"}
+
+    loads = _count_loads(loader, monkeypatch)
+    rendered = loader.import_("page.html")().render()
+    assert rendered == "<div>Hello, World!<footer>Footer</footer></div>"
+    assert loads == []
+
+
+def test_loader_dependents_and_invalidate(site_dir):
+    loader = FileLoader(path=str(site_dir))
+    loader.dependencies("page.html")
+    _write(site_dir / "other.html", '<py:extends href="base.html"/>')
+    loader.import_("other.html")
+
+    assert loader.dependents("footer.html") == ["base.html", "other.html", "page.html"]
+    assert loader.dependents("lib.html") == ["page.html"]
+    assert loader.dependents("page.html") == []
+
+    loader.invalidate("lib.html")
+    assert set(loader.modules) == {"base.html", "footer.html", "other.html"}
+    assert loader.dependents("lib.html") == []
+    assert loader.dependents("base.html") == ["other.html"]
+
+
+def test_cache_keeps_dependencies(tmp_path, site_dir, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    FileLoader(path=str(site_dir), cache_dir=cache_dir).import_("page.html")
+
+    _no_parse(monkeypatch)
+    loader = FileLoader(path=str(site_dir), cache_dir=cache_dir)
+    assert loader.import_("page.html").dependencies == (("extends", "base.html"), ("import", "lib.html"))
+
+
+def test_preload(site_dir, monkeypatch):
+    _write(site_dir / "notes.md", "Not a template")
+    loader = FileLoader(path=str(site_dir))
+    timings = loader.preload()
+    assert sorted(timings) == ["base.html", "footer.html", "lib.html", "page.html"]
+    assert all(seconds >= 0 for seconds in timings.values())
+
+    loads = _count_loads(loader, monkeypatch)
+    assert loader.import_("page.html")().render() == "<div>Hello, World!<footer>Footer</footer></div>"
+    assert loads == []
+
+
+def test_preload_compiles_fragments_once(site_dir, monkeypatch):
+    loader = FileLoader(path=str(site_dir))
+    loads = _count_loads(loader, monkeypatch)
+    loader.preload()
+    # footer.html is included by base.html, loaded before it: compiled once.
+    # lib.html is imported by page.html, met before it as a page.
+    assert loads == ["base.html", "footer.html", "lib.html", "page.html", "lib.html"]
+
+
+def test_preload_pattern(site_dir):
+    (site_dir / "sub").mkdir()
+    _write(site_dir / "sub" / "page.txt", "Hello")
+    assert list(FileLoader(path=str(site_dir)).preload("**/*.txt")) == ["sub/page.txt"]
+
+
+def test_preload_fragments(site_dir):
+    loader = FileLoader(path=str(site_dir), force_mode="html5")
+    loader.preload()
+    rendered = loader.import_("page.html")().render()
+    assert rendered == "<!DOCTYPE html>\n<div>Hello, World!<footer>Footer</footer></div>"
+
+
+def test_preload_text_include(tpl_dir):
+    _write(tpl_dir / "page.txt", '%include "footer.txt"\n')
+    _write(tpl_dir / "footer.txt", "Footer")
+    loader = FileLoader(path=str(tpl_dir))
+    loader.preload()
+    assert loader.import_("page.txt")().render() == "Footer"
+
+
+def test_preload_workers(tmp_path, site_dir, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    loader = FileLoader(path=str(site_dir), cache_dir=cache_dir)
+    # The workers compile the templates, this process loads them from the cache.
+    monkeypatch.setattr(loader, "_compile", lambda *args: pytest.fail("compiled outside of the workers"))
+    timings = loader.preload(workers=2)
+    assert sorted(timings) == ["base.html", "footer.html", "lib.html", "page.html"]
+    assert loader.import_("page.html")().render() == "<div>Hello, World!<footer>Footer</footer></div>"
+
+
+def test_preload_workers_needs_cache_dir(site_dir):
+    with pytest.raises(ValueError, match="cache_dir"):
+        FileLoader(path=str(site_dir)).preload(workers=2)
+
+
+def test_package_preload():
+    loader = PackageLoader()
+    timings = loader.preload("kajiki_test_data", pattern="file_*.html")
+    assert sorted(timings) == ["kajiki_test_data.file_child", "kajiki_test_data.file_parent"]
+    assert set(loader.modules) == set(timings)
@@ -1,6 +1,15 @@
+import asyncio
+import io
+import os
+import sys
+import tempfile
 from unittest import TestCase
 
+import pytest
+
 import kajiki
+from kajiki.cache import FileCache, LRUCache
+from kajiki.profile import Profiler, profile_render
 
 
 class TestBasic(TestCase):
@@ -272,3 +281,316 @@ class TestDynamicExtends(TestCase):
         assert rsp == "Parent 0", rsp
         rsp = self.child_tpl({"p": 1}).render()
         assert rsp == "Parent 1", rsp
+
+
+class TestRenderChunks(TestCase):
+    def setUp(self):
+        class Tpl:
+            @kajiki.expose
+            def __main__():
+                for i in range(100):
+                    yield local.__kj__.escape(i)  # noqa: F821
+                    yield "é,"
+
+        self.tpl = kajiki.Template(Tpl)
+
+    def test_chunk_size(self):
+        expected = self.tpl().render().encode("utf-8")
+        chunks = list(self.tpl().render_chunks(chunk_size=64))
+        assert b"".join(chunks) == expected
+        assert all(len(chunk) == 64 for chunk in chunks[:-1])
+        assert 0 < len(chunks[-1]) <= 64
+
+    def test_encoding(self):
+        expected = self.tpl().render().encode("utf-16")
+        assert b"".join(self.tpl().render_chunks(chunk_size=7, encoding="utf-16")) == expected
+
+    def test_invalid_chunk_size(self):
+        with pytest.raises(ValueError, match="chunk_size"):
+            list(self.tpl().render_chunks(chunk_size=0))
+
+
+class TestRenderTo(TestCase):
+    def setUp(self):
+        class Tpl:
+            @kajiki.expose
+            def __main__():
+                for i in range(3):
+                    yield i
+                    yield inner(i)  # noqa: F821
+
+            @kajiki.expose
+            def inner(i):
+                yield "é<"
+                yield None
+                yield str(i)
+
+        self.tpl = kajiki.Template(Tpl)
+        self.expected = "0é<01é<12é<2"
+
+    def test_text(self):
+        fp = io.StringIO()
+        self.tpl().render_to(fp)
+        assert fp.getvalue() == self.expected
+
+    def test_bytes(self):
+        buf = bytearray(b">")
+        self.tpl().render_to(buf)
+        assert buf == b">" + self.expected.encode("utf-8")
+        fp = io.BytesIO()
+        self.tpl().render_to(fp, encoding="utf-16")
+        assert fp.getvalue() == self.expected.encode("utf-16")
+
+    def test_encoding(self):
+        chunks = []
+
+        class Writer:
+            write = chunks.append
+
+        self.tpl().render_to(Writer(), encoding="latin-1")
+        assert b"".join(chunks) == self.expected.encode("latin-1")
+
+
+class TestInstances(TestCase):
+    def setUp(self):
+        class Tpl:
+            @kajiki.expose
+            def __main__():
+                yield greeting()  # noqa: F821
+                yield name  # noqa: F821
+                yield str(defined("name"))  # noqa: F821
+
+            @kajiki.expose
+            def greeting():
+                yield prefix  # noqa: F821
+
+        self.tpl = kajiki.Template(Tpl)
+
+    def test_instances_are_independent(self):
+        self.tpl.base_globals = {"prefix": "Hi "}
+        first, second = self.tpl({"name": "Rick"}), self.tpl({})
+        assert first.render() == "Hi RickTrue"
+        assert second.__globals__["self"] is second
+        assert "name" not in second.__globals__
+        assert first.greeting is not second.greeting
+        assert first.__kj__.escape("<") == "&lt;"
+        assert first.__kj__.collect is first.__kj__.collect
+        assert first.__kj__.collect is not second.__kj__.collect
+
+    def test_base_globals_replaced(self):
+        self.tpl.base_globals = {"prefix": "Hi "}
+        assert self.tpl({"name": "Rick"}).render() == "Hi RickTrue"
+        self.tpl.base_globals = {"prefix": "Bye "}
+        assert self.tpl({"name": "Rick"}).render() == "Bye RickTrue"
+        assert self.tpl({"name": "Rick", "prefix": "Yo "}).render() == "Yo RickTrue"
+
+    def test_base_globals_changed_in_place(self):
+        self.tpl.base_globals = {"prefix": "Hi "}
+        assert self.tpl({"name": "Rick"}).render() == "Hi RickTrue"
+        self.tpl.base_globals["prefix"] = "Bye "
+        assert self.tpl({"name": "Rick"}).render() == "Bye RickTrue"
+
+
+class TestDeepNesting(TestCase):
+    def setUp(self):
+        class Tpl:
+            @kajiki.expose
+            def __main__():
+                yield tree(depth)  # noqa: F821
+
+            @kajiki.expose
+            def tree(n):
+                yield "("
+                if n:
+                    yield tree(n - 1)  # noqa: F821
+                    yield None
+                yield ")"
+
+        self.tpl = kajiki.Template(Tpl)
+
+    def test_deeper_than_recursion_limit(self):
+        depth = sys.getrecursionlimit() * 2
+        expected = "(" * (depth + 1) + ")" * (depth + 1)
+        assert self.tpl({"depth": depth}).render() == expected
+        assert self.tpl({"depth": depth}).tree(depth).accumulate_str() == expected
+
+    def test_nested_in_attributes(self):
+        depth = sys.getrecursionlimit() // 2
+        expected = '<i title="">0</i>'
+        for n in range(1, depth + 1):
+            expected = f'<i title="{expected}">{n}</i>'
+        # Rendered inline, and collected from a nested generator.
+        for value in ("${tree(n - 1) if n else ''}", "${tree(n - 1) if n else ''}${''}"):
+            # Each level renders the next one in an attribute, not escaped
+            # by escape=str so that the output doesn't grow at each level.
+            tpl = kajiki.XMLTemplate(
+                f"""<div><py:def function="tree(n)"><i title="{value}">$n</i></py:def
+>${{tree(depth)}}</div>""",
+                escape=str,
+            )
+            assert tpl({"depth": depth}).render() == f"<div>{expected}</div>"
+
+
+class TestFragmentCache(TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.timer = lambda: self.now
+
+    def test_lru_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache.set("a", "A")
+        cache.set("b", "B")
+        assert cache.get("a") == "A"
+        cache.set("c", "C")
+        assert cache.get("b") is None
+        assert cache.get("a") == "A"
+        assert cache.get("c") == "C"
+        assert len(cache) == 2
+
+    def test_lru_ttl(self):
+        cache = LRUCache(ttl=10, timer=self.timer)
+        cache.set("a", "A")
+        cache.set("b", "B", 30)
+        self.now = 20
+        assert cache.get("a") is None
+        assert cache.get("b") == "B"
+        self.now = 30
+        assert cache.get("b") is None
+
+    def test_file_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            directory = os.path.join(tmpdir, "fragments")
+            cache = FileCache(directory, timer=self.timer)
+            assert cache.get(("f", 1)) is None
+            cache.set(("f", 1), "one\r\ntwo\n")
+            cache.set(("f", 2), "two", 5)
+            assert FileCache(directory).get(("f", 1)) == "one\r\ntwo\n"
+            assert cache.get(("f", 2)) == "two"
+            self.now = 5
+            assert cache.get(("f", 2)) is None
+            assert len(os.listdir(directory)) == 1
+            cache.clear()
+            assert cache.get(("f", 1)) is None
+
+
+class TestMemoize(TestCase):
+    def setUp(self):
+        calls = self.calls = []
+
+        class Tpl:
+            @kajiki.expose
+            def __main__():
+                yield greet("<World>")  # noqa: F821
+                yield greet("<World>")  # noqa: F821
+
+            @kajiki.expose
+            @kajiki.memoize("process")
+            def greet(name):
+                calls.append(name)
+                yield "Hello, "
+                yield local.__kj__.escape(name)  # noqa: F821
+
+        self.tpl = kajiki.Template(Tpl)
+
+    def test_memoize(self):
+        assert self.tpl().render() == "Hello, &lt;World&gt;" * 2
+        assert self.tpl().render() == "Hello, &lt;World&gt;" * 2
+        assert self.calls == ["<World>"]
+
+    def test_unknown_scope(self):
+        with pytest.raises(ValueError, match="Unknown memoize scope"):
+            kajiki.memoize("request")
+
+
+class TestProfiler(TestCase):
+    source = """<div>
+<py:def function="item(x)">
+<li>$x</li>
+</py:def>
+<ul py:for="x in range(3)">${item(x)}</ul>
+</div>"""
+
+    def setUp(self):
+        ticks = iter(range(10**6))
+        self.timer = lambda: next(ticks)
+
+    def profile(self, **kwargs):
+        tpl = kajiki.XMLTemplate(self.source, filename="page.html", **kwargs)
+        with Profiler(self.timer) as profiler:
+            rsp = tpl().render()
+        assert rsp.count("<li>") == 3
+        return profiler
+
+    def test_lines_and_spans(self):
+        for accumulate in (False, True):
+            profiler = self.profile(accumulate=accumulate)
+            assert profiler.lines[("page.html", 3)][1] >= 3
+            assert profiler.spans["page.html:item()"][1] == 3
+            assert profiler.spans["page.html"][1] == 1
+            assert profiler.spans["page.html"][0] == sum(profiler.stacks.values())
+            assert ("page.html", "page.html:item()", "page.html:3") in profiler.stacks
+            # The lines of __main__ calling item() are told apart too.
+            assert profiler.lines[("page.html", 5)][1] >= 1
+            assert ("page.html", "page.html:5") in profiler.stacks
+            # No line 0 for the code of __main__ before its first line.
+            assert all(lineno for _, lineno in profiler.lines)
+            assert ("page.html",) in profiler.stacks
+            report = profiler.report()
+            assert "page.html:3" in report
+            assert "page.html:item()" in report
+            assert "page.html:0" not in report
+        if sys.version_info < (3, 12):
+            assert sys.gettrace() is None
+
+    def test_restores_tracing(self):
+        if sys.version_info < (3, 12):
+
+            def tracer(frame, event, arg):  # noqa: ARG001
+                return None
+
+            previous = sys.gettrace()
+            sys.settrace(tracer)
+            try:
+                self.profile()
+                assert sys.gettrace() is tracer
+            finally:
+                sys.settrace(previous)
+        else:
+            monitoring = sys.monitoring
+            held = [tool for tool in range(6) if monitoring.get_tool(tool) is None]
+            for tool in held:
+                monitoring.use_tool_id(tool, "other")
+            try:
+                with pytest.raises(RuntimeError, match="tool id"):
+                    self.profile()
+                # Like under cProfile, holding the profiler tool id.
+                fallback = 3
+                held.remove(fallback)
+                monitoring.free_tool_id(fallback)
+                assert self.profile().spans["page.html:item()"][1] == 3
+                assert monitoring.get_tool(fallback) is None
+                assert monitoring.get_tool(monitoring.PROFILER_ID) == "other"
+            finally:
+                for tool in held:
+                    monitoring.free_tool_id(tool)
+
+    def test_async(self):
+        async def render(tpl):
+            return "".join([chunk async for chunk in tpl().render_async()])
+
+        tpl = kajiki.XMLTemplate(self.source, filename="page.html", is_async=True)
+        with Profiler(self.timer) as profiler:
+            assert asyncio.run(render(tpl)).count("<li>") == 3
+        assert profiler.spans["page.html:item()"][1] == 3
+
+    def test_write_collapsed(self):
+        profiler = self.profile()
+        out = io.StringIO()
+        profiler.write_collapsed(out)
+        lines = out.getvalue().splitlines()
+        assert any(line.startswith("page.html;page.html:item();page.html:3 ") for line in lines)
+        assert sum(int(line.rsplit(" ", 1)[1]) for line in lines) == sum(profiler.stacks.values()) * 10**6
+
+    def test_profile_render(self):
+        profiler = profile_render(kajiki.XMLTemplate("<div>$x</div>", filename="page.html"), {"x": 1}, repeat=2)
+        assert profiler.spans["page.html"][1] == 2
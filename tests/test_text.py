@@ -1,9 +1,12 @@
+import asyncio
 import os
 from unittest import TestCase
 
 import pytest
 
 from kajiki import FileLoader, MockLoader, TextTemplate
+from kajiki.cache import LRUCache
+from kajiki.template import KajikiSyntaxError
 
 
 class TestBasic(TestCase):
@@ -20,6 +23,14 @@ class TestBasic(TestCase):
         rsp = tpl().render()
         assert rsp == "<h1>", rsp
 
+    def test_number_annotation(self):
+        tpl = TextTemplate(source="${int: n} ${float: x} ${'<'}", autoescape=True)
+        assert tpl.py_text.count("_kj_escape(") == 1
+        rsp = tpl({"n": 3, "x": 2}).render()
+        assert rsp == "3 2 &lt;", rsp
+        with pytest.raises(TypeError, match="annotated as float"):
+            tpl({"n": 3, "x": "2"}).render()
+
     def test_expr_brace(self):
         tpl = TextTemplate(source="Hello, ${name}\n")
         rsp = tpl({"name": "Rick"}).render()
@@ -48,6 +59,20 @@ class TestBasic(TestCase):
         rsp = tpl({"obj": Empty}).render()
         assert rsp == "Hello, Rick\n", rsp
 
+    def test_expr_brace_in_string(self):
+        tpl = TextTemplate(source="""Hello, ${'}' + "{\\"}" + '''}'''}\n""")
+        rsp = tpl().render()
+        assert rsp == 'Hello, }{"}}\n', rsp
+
+    def test_expr_unterminated(self):
+        with pytest.raises(KajikiSyntaxError, match="Braced expression not terminated"):
+            TextTemplate(source="Hello, ${name + '}'\n")
+
+    def test_expr_source_not_scanned(self):
+        tpl = TextTemplate(source='${"$x"} ${"""\n%for"""}\n')
+        rsp = tpl().render()
+        assert rsp == "$x \n%for\n", rsp
+
     def test_expr_multiline(self):
         tpl = TextTemplate(
             source="""Hello, ${{'name': 'Rick',
@@ -396,3 +421,50 @@ class TestDebug(TestCase):
                 break
         else:
             pytest.fail("Stacktrace is all python")
+
+
+class TestAsync(TestCase):
+    def test_async(self):
+        async def fetch(value):
+            await asyncio.sleep(0)
+            return value
+
+        async def rows(n):
+            for i in range(n):
+                await asyncio.sleep(0)
+                yield i
+
+        async def render(tpl):
+            return "".join([chunk async for chunk in tpl({"fetch": fetch, "rows": rows}).render_async()])
+
+        tpl = TextTemplate(
+            source="""%for async i in rows(2)
+${await fetch(i)}
+%end
+""",
+            is_async=True,
+        )
+        assert asyncio.run(render(tpl)) == "0\n1\n"
+
+
+class TestCache(TestCase):
+    def test_cache(self):
+        calls = []
+
+        def count(value):
+            calls.append(value)
+            return value
+
+        tpl = TextTemplate(
+            """%for x in items
+{%cache x, ttl=60%}${count(x)} {%end%}
+%end
+""",
+            fragment_cache=LRUCache(),
+        )
+        assert tpl({"items": [1, 2, 1], "count": count}).render() == "1 \n2 \n1 \n"
+        assert calls == [1, 2]
+
+    def test_bad_directive(self):
+        with pytest.raises(KajikiSyntaxError, match="Invalid cache directive"):
+            TextTemplate("{%cache x, expire=1%}x{%end%}")
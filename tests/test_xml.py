@@ -1,7 +1,8 @@
+import asyncio
 import os
 import sys
+import tempfile
 import traceback
-import xml.dom.minidom
 from io import BytesIO
 from unittest import TestCase
 
@@ -9,8 +10,11 @@ import pytest
 
 import kajiki
 from kajiki import FileLoader, MockLoader, PackageLoader, XMLTemplate, i18n
+from kajiki.cache import FileCache, LRUCache
+from kajiki.html_utils import escape_html
 from kajiki.ir import TranslatableTextNode
 from kajiki.template import KajikiSyntaxError
+from kajiki.util import literal
 from kajiki.xml_template import (
     XMLTemplateCompileError,
     XMLTemplateParseError,
@@ -38,7 +42,19 @@ class TestParser(TestCase):
   </py:for>
 </div>""",
         ).parse()
-        xml.dom.minidom.parseString(doc.toxml().encode("utf-8"))
+        assert doc.dtd.startswith("<!DOCTYPE html PUBLIC")
+        (root,) = doc.children
+        assert root.tag == "div"
+        assert root.get("xmlns") == "http://www.w3.org/1999/xhtml"
+        nodes = [n for n in root.children if not isinstance(n, kajiki.xml_template._Text)]
+        pi, comment, loop = nodes
+        assert (pi.target, pi.data, pi.lineno) == ("py", "import os ", 6)
+        assert comment.data == " This is a comment "
+        assert loop.tag == "py:for"
+        assert loop.attrs == [("each", "x in range(5)")]
+        assert all(n.parent is root for n in root.children)
+        text = "".join(n.data for n in loop.children)
+        assert text == "\n    Hello, $name &lt;\xa0&gt; $x\n  "
 
 
 class TestExpand(TestCase):
@@ -54,28 +70,41 @@ class TestExpand(TestCase):
         py:if="if"
         py:switch="switch"
         py:with="with"
+        py:cache="cache"
         py:replace="replace"
         py:block="block"
         py:extends="extends">Foo</div>""",
         ).parse()
         doc = kajiki.xml_template._DomTransformer(doc).transform()
-        node = doc.childNodes[0]
+        node = doc.children[0]
         for tagname, attr in kajiki.markup_template.QDIRECTIVES:
-            if node.tagName == "div":
-                node = node.childNodes[0]
+            if node.tag == "div":
+                node = node.children[0]
                 continue
-            assert node.tagName == tagname, f"{node.tagName} != {tagname}"
+            assert node.tag == tagname, f"{node.tag} != {tagname}"
             if attr:
-                if node.tagName != "py:case":
-                    assert len(node.attributes) == 1, node.attributes.items()
-                    assert node.hasAttribute(attr)
-                    assert node.getAttribute(attr) == tagname.split(":")[-1]
+                if node.tag != "py:case":
+                    assert len(node.attrs) == 1, node.attrs
+                    assert node.has(attr)
+                    assert node.get(attr) == tagname.split(":")[-1]
                 else:
-                    assert len(node.attributes) == 2
+                    assert len(node.attrs) == 2
             else:
-                assert len(node.attributes) == 0
-            assert len(node.childNodes) == 1
-            node = node.childNodes[0]
+                assert len(node.attrs) == 0
+            assert len(node.children) == 1
+            node = node.children[0]
+
+    def test_expand_extends_attribute(self):
+        doc = kajiki.xml_template._Parser("<string>", '<div py:extends="parent.html">Foo</div>').parse()
+        doc = kajiki.xml_template._DomTransformer(doc).transform()
+        (node,) = doc.children
+        assert node.tag == "div"
+        assert node.attrs == []
+        extends, text = node.children
+        assert extends.tag == "py:extends"
+        assert extends.attrs == [("href", "parent.html")]
+        assert extends.parent is node
+        assert text.data == "Foo"
 
 
 def perform(source, expected_output, context=None, **options):
@@ -84,6 +113,9 @@ def perform(source, expected_output, context=None, **options):
     rsp = tpl(context).render()
     assert isinstance(rsp, str), "render() must return a string."
     assert rsp == expected_output, (rsp, expected_output)
+    # The accumulator mode must render the same output.
+    rsp = XMLTemplate(source, **dict(options, accumulate=True))(context).render()
+    assert rsp == expected_output, (rsp, expected_output)
     return tpl
 
 
@@ -943,6 +975,22 @@ class TestAttributes(TestCase):
         perform('<div py:attrs="dict(checked=False)"/>', "<div/>")
         perform('<div py:attrs="dict(checked=None)"/>', "<div/>")
 
+    def test_attrs_unsorted(self):
+        perform('<div py:attrs="dict(b=6, a=5)"/>', '<div a="5" b="6"/>')
+        perform('<div py:attrs="dict(b=6, a=5)"/>', '<div b="6" a="5"/>', sort_attrs=False)
+        perform(
+            """<input py:attrs="[('type', 'checkbox'), ('checked', True), ('value', None)]"/>""",
+            '<input type="checkbox" checked>',
+            mode="html",
+            sort_attrs=False,
+        )
+
+    def test_html_attrs_collected(self):
+        tpl = '<input checked="${a}${b}" title="${a}${b}"/>'
+        perform(tpl, "<input>", {"a": None, "b": None}, mode="html")
+        perform(tpl, '<input checked title="1&lt;">', {"a": 1, "b": "<"}, mode="html")
+        perform(tpl, '<input checked="1&lt;" title="1&lt;"/>', {"a": 1, "b": "<"}, mode="xml")
+
     def test_strip(self):
         tpl = '<div><h1 py:strip="header">Header</h1></div>'
         perform(tpl, "<div>Header</div>", context={"header": True})
@@ -987,6 +1035,35 @@ class TestAttributes(TestCase):
         perform(source, output, context, mode="html")
         perform(source, output, context, mode="xml")
 
+    def test_static_attrs_folded(self):
+        """Attributes without expressions are rendered at compile time."""
+        source = """<div py:strip="strip" class="c"><input type="checkbox" checked="" title="a&amp;b"/></div>"""
+        output = '<div class="c"><input checked title="a&amp;b" type="checkbox"></div>'
+        tpl = perform(source, output, {"strip": False}, mode="html")
+        assert "render_attrs" not in tpl.py_text
+        assert """if not (strip): yield '<div class="c">'""" in tpl.py_text
+        perform(source, '<input checked title="a&amp;b" type="checkbox">', {"strip": True}, mode="html")
+        output = '<div class="c"><input checked="" title="a&amp;b" type="checkbox"/></div>'
+        perform(source, output, {"strip": False}, mode="xml")
+
+    def test_inline_attrs(self):
+        """Attributes made of text and a single expression don't use nested generators."""
+        source = """<a href="$url" class="row ${cls}" title="${a}${b}">Link</a>"""
+        tpl = perform(
+            source,
+            '<a class="row odd&amp;" href="/?a=1&amp;b=2" title="ab">Link</a>',
+            {"url": "/?a=1&b=2", "cls": "odd&", "a": "a", "b": "b"},
+        )
+        assert tpl.py_text.count("collect(") == 1
+        perform(source, '<a class="row ">Link</a>', {"url": None, "cls": None, "a": None, "b": None})
+        perform(source, '<a class="row 1" href="0">Link</a>', {"url": 0, "cls": 1, "a": None, "b": None})
+        perform("""<a class="row ${literal('&lt;b&gt;')}">Link</a>""", '<a class="row &lt;b&gt;">Link</a>')
+
+    def test_strip_empty_folded(self):
+        tpl = perform('<div py:strip="" class="x">${name}</div>', "Rick")
+        assert "if False" not in tpl.py_text
+        perform('<div><py:if test="True"><br py:strip="" class="x"/></py:if></div>', "<div></div>")
+
 
 class TestDebug(TestCase):
     def test_debug(self):
@@ -1099,6 +1176,12 @@ class TestTranslation(TestCase):
         finally:
             i18n.gettext = default_gettext
 
+    def test_extract_python_in_attributes(self):
+        pytest.importorskip("babel")
+        src = """<xml><a title="${_('One')}" href="/${_('Two')}/">${_('Body')}</a></xml>"""
+        extracted = i18n.extract(BytesIO(src.encode("utf-8")), ["_"], None, {"extract_python": True})
+        assert sorted(msgid for _, _, msgid, _ in extracted) == ["Body", "One", "Two"]
+
     def test_extract_python_inside_invalid(self):
         src = """<xml><div>${_('hi' +)}</div></xml>"""
         with pytest.raises(XMLTemplateCompileError, match=r"_\('hi' \+\)"):
@@ -1155,7 +1238,7 @@ class TestDOMTransformations(TestCase):
     def test_empty_text_extraction(self):
         doc = kajiki.xml_template._Parser("<string>", """<span>  text  </span>""").parse()
         doc = kajiki.xml_template._DomTransformer(doc, strip_text=False).transform()
-        text_data = [n.data for n in doc.firstChild.childNodes]
+        text_data = [n.data for n in doc.children[0].children]
         assert ["  ", "text", "  "] == text_data
 
     def test_empty_text_extraction_lineno(self):
@@ -1168,7 +1251,7 @@ class TestDOMTransformations(TestCase):
             </span>""",
         ).parse()
         doc = kajiki.xml_template._DomTransformer(doc, strip_text=False).transform()
-        linenos = [n.lineno for n in doc.firstChild.childNodes]
+        linenos = [n.lineno for n in doc.children[0].children]
         assert [1, 3, 3] == linenos  # Last node starts on same line as it starts with \n
 
 
@@ -1208,6 +1291,18 @@ class TestBracketsInExpression(TestCase):
     def test_brackets_asymmetric(self):
         perform("<x>${'{o{k}k  { '}</x>", "<x>{o{k}k  { </x>")
 
+    def test_escaped_quotes(self):
+        perform("""<x>${'}\\'}' + "\\"}"}</x>""", """<x>}'}&quot;}</x>""")
+
+    def test_triple_quoted_string(self):
+        perform("<x>${'''it's }\n}'''}</x>", "<x>it's }\n}</x>")
+
+    def test_nested_dict(self):
+        perform("<x>${ {'a': {'b': '}'}}['a']['b'] }</x>", "<x>}</x>")
+
+    def test_many_expressions(self):
+        perform("<x>" + "${1}" * 2000 + "</x>", "<x>" + "1" * 2000 + "</x>")
+
     def test_complex(self):
         perform(
             "<xml><div>${'ciao {  } {' + \"a {} b {{{{} w}}rar\"}${'sd{}'}" " ${1+1}</div></xml>",
@@ -1286,3 +1381,349 @@ class TestExtendsWithImport(TestCase):
         child = loader.import_("child.html")
         r = child().render()
         assert r == "<div><b>foo</b></div>"
+
+
+class TestAsync(TestCase):
+    @staticmethod
+    def render(tpl, context=None):
+        async def _render():
+            return "".join([chunk async for chunk in tpl(context or {}).render_async()])
+
+        return asyncio.run(_render())
+
+    @staticmethod
+    def context():
+        async def fetch(value):
+            await asyncio.sleep(0)
+            return value
+
+        async def rows(n):
+            for i in range(n):
+                await asyncio.sleep(0)
+                yield i
+
+        return {"fetch": fetch, "rows": rows}
+
+    def test_await_expr(self):
+        tpl = XMLTemplate(
+            '<p title="${await fetch(\'a&amp;b\')}">${await fetch(name)}</p>',
+            is_async=True,
+        )
+        context = self.context()
+        context["name"] = "<b>"
+        assert self.render(tpl, context) == '<p title="a&amp;b">&lt;b&gt;</p>'
+
+    def test_async_for(self):
+        tpl = XMLTemplate(
+            """<ul><li py:for="async i in rows(3)">${i}</li></ul>""",
+            is_async=True,
+        )
+        assert self.render(tpl, self.context()) == "<ul><li>0</li><li>1</li><li>2</li></ul>"
+
+    def test_def_and_call(self):
+        tpl = XMLTemplate(
+            """<div
+><py:def function="item(x)"><i>${await fetch(x)}</i></py:def
+><py:def function="wrap(caller)">[${caller(1)}]</py:def
+>${item(0)}<py:call args="n" function="wrap(%caller)">${await fetch(n)}</py:call
+></div>""",
+            is_async=True,
+        )
+        assert self.render(tpl, self.context()) == "<div><i>0</i>[1]</div>"
+
+    def test_async_extends(self):
+        loader = MockLoader(
+            {
+                "parent.html": XMLTemplate(
+                    '<div><py:block name="body">${await fetch("parent")}</py:block></div>',
+                    is_async=True,
+                ),
+                "child.html": XMLTemplate(
+                    """<py:extends href="parent.html"
+><py:block name="body">${await fetch("child")}</py:block></py:extends>""",
+                    is_async=True,
+                ),
+            }
+        )
+        child = loader.import_("child.html")
+        assert self.render(child, self.context()) == "<div>child</div>"
+
+    def test_sync_template(self):
+        tpl = XMLTemplate("<p>$name</p>")
+        assert self.render(tpl, {"name": "Rick"}) == "<p>Rick</p>"
+
+
+class TestAccumulate(TestCase):
+    def test_extends_and_import(self):
+        loader = MockLoader(
+            {
+                "lib.html": XMLTemplate(
+                    '<div><py:def function="item(x)"><li>$x</li></py:def></div>',
+                    accumulate=True,
+                ),
+                "parent.html": XMLTemplate(
+                    """<div><py:import href="lib.html"
+/><ul py:block="body"><li>parent</li></ul>${lib.item("lib")}</div>""",
+                    accumulate=True,
+                ),
+                "child.html": XMLTemplate(
+                    """<py:extends href="parent.html"
+><ul py:block="body">${parent_block()}<li>child</li></ul></py:extends>""",
+                    accumulate=True,
+                ),
+            }
+        )
+        child = loader.import_("child.html")
+        assert child().render() == "<div><ul><ul><li>parent</li></ul><li>child</li></ul><li>lib</li></div>"
+        assert "yield" not in child.py_text
+
+    def test_python_yield(self):
+        with pytest.raises(KajikiSyntaxError, match="yield can't be used"):
+            XMLTemplate("<div><?py yield 'x' ?></div>", accumulate=True)
+        perform("<div>${''.join(str(i) for i in range(3))}</div>", "<div>012</div>", accumulate=True)
+
+    def test_python_generator_function(self):
+        # A generator defined by a Python block isn't a template function.
+        source = """<div><?py
+def evens(n):
+    for i in range(n):
+        if i % 2 == 0:
+            yield i
+?><py:def function="item(x)"><?py
+def odd(): yield x + 1
+?><i>${list(odd())}</i></py:def><b py:for="i in evens(5)">${item(i)}</b></div>"""
+        expected = "<div><b><i>[1]</i></b><b><i>[3]</i></b><b><i>[5]</i></b></div>"
+        perform(source, expected)
+        with pytest.raises(KajikiSyntaxError, match="yield can't be used"):
+            XMLTemplate('<div><py:def function="f()"><?py yield 1 ?></py:def></div>', accumulate=True)
+
+    def test_async(self):
+        with pytest.raises(ValueError, match="accumulator mode"):
+            XMLTemplate("<div/>", accumulate=True, is_async=True)
+
+
+class TestEscape(TestCase):
+    def test_numbers(self):
+        perform(
+            "<div>${1} ${2.5} ${True} ${-3}</div>",
+            "<div>1 2.5 True -3</div>",
+        )
+
+    def test_number_subclass(self):
+        class Tag(int):
+            def __str__(self):
+                return "<b>"
+
+        tpl = XMLTemplate("<div>$x</div>")
+        assert tpl({"x": Tag(1)}).render() == "<div>&lt;b&gt;</div>"
+
+    def test_str_subclass(self):
+        tpl = XMLTemplate("<div>$x $y</div>")
+        rsp = tpl({"x": literal("<b>"), "y": type("S", (str,), {})("<i>")}).render()
+        assert rsp == "<div><b> &lt;i&gt;</div>"
+
+    def test_cached(self):
+        tpl = XMLTemplate('<ul><li py:for="x in items">$x</li></ul>')
+        items = ["a&b", "<c>", "plain", "a&b", "<c>", "plain", "x" * 200 + "<"]
+        expected = "".join(f"<li>{escape_html(x)}</li>" for x in items)
+        assert tpl({"items": items}).render() == f"<ul>{expected}</ul>"
+        assert tpl({"items": items}).render() == f"<ul>{expected}</ul>"
+
+    def test_custom_escape(self):
+        tpl = XMLTemplate('<div title="$x">$x ${1}</div>', escape=lambda text: text.upper())
+        assert tpl({"x": "a<b"}).render() == '<div title="A<B">A<B 1</div>'
+        assert XMLTemplate("<div>$x</div>")({"x": "a<b"}).render() == "<div>a&lt;b</div>"
+
+    def test_unknown_escape(self):
+        with pytest.raises(ValueError, match="Unknown escape"):
+            XMLTemplate("<div/>", escape="nope")
+
+    def test_markupsafe(self):
+        pytest.importorskip("markupsafe")
+        tpl = XMLTemplate("<div>$x</div>", escape="markupsafe")
+        assert tpl({"x": "<'>"}).render() == "<div>&lt;&#39;&gt;</div>"
+
+    def test_helpers_bound_once(self):
+        tpl = XMLTemplate(
+            """<ul><li py:for="x in items" class="a$x" py:attrs="{'id': x}">text ${x}</li></ul>"""
+        )
+        for name in ("escape", "escape_attr", "gettext", "render_attrs"):
+            assert tpl.py_text.count(f"__kj__.{name}\n") == 1, name
+        # Translations are looked up on local, as before they were bound once.
+        assert "_kj_gettext = local.__kj__.gettext\n" in tpl.py_text
+        rsp = tpl({"items": ["<", 1]}).render()
+        assert rsp == '<ul><li class="a&lt;" id="&lt;">text &lt;</li><li class="a1" id="1">text 1</li></ul>'
+
+    def test_escape_bound_once(self):
+        tpl = XMLTemplate('<ul><li py:for="x in items">$x</li></ul>')
+        assert tpl.py_text.count("__kj__.escape") == 1
+        assert tpl({"items": ["<", ">"]}).render() == "<ul><li>&lt;</li><li>&gt;</li></ul>"
+
+    def test_number_literals(self):
+        tpl = XMLTemplate("<div>${1} ${-2.5} ${1e3} ${0x10} ${1 + 1}</div>")
+        assert tpl.py_text.count("_kj_escape(") == 1
+        assert tpl().render() == "<div>1 -2.5 1000.0 16 2</div>"
+
+    def test_number_annotation(self):
+        tpl = XMLTemplate(
+            """<div title="${int: n}">${int: n} ${float:x} ${ int : len(items) }
+${int: n}</div>"""
+        )
+        assert "render_number(" in tpl.py_text
+        rsp = tpl({"n": 3, "x": 1, "items": "abc"}).render()
+        assert rsp == '<div title="3">3 1 3\n3</div>'
+        with pytest.raises(TypeError, match="annotated as int evaluated to str"):
+            tpl({"n": "<script>", "x": 1, "items": ""}).render()
+        # Rendered like the expression without the annotation.
+        perform("<div>${int: n} ${float: x}</div>", "<div>True 2.5</div>", {"n": True, "x": 2.5})
+
+
+class TestCache(TestCase):
+    def setUp(self):
+        self.calls = []
+
+    def count(self, value):
+        self.calls.append(value)
+        return value
+
+    def test_attribute(self):
+        tpl = XMLTemplate(
+            '<ul><li py:for="x in items" py:cache="x">${count(x)}</li></ul>', fragment_cache=LRUCache()
+        )
+        rsp = tpl({"items": [1, "<", 1], "count": self.count}).render()
+        assert rsp == "<ul><li>1</li><li>&lt;</li><li>1</li></ul>"
+        assert self.calls == [1, "<"]
+        tpl({"items": [1, "<"], "count": self.count}).render()
+        assert self.calls == [1, "<"]
+
+    def test_tag(self):
+        now = [0]
+        cache = LRUCache(timer=lambda: now[0])
+        tpl = XMLTemplate(
+            """<div><py:cache key="'a'" ttl="60">${count('a')}</py:cache><py:cache key="'a'">${count('b')}</py:cache></div>""",
+            fragment_cache=cache,
+        )
+        assert tpl({"count": self.count}).render() == "<div>ab</div>"
+        assert tpl({"count": self.count}).render() == "<div>ab</div>"
+        assert self.calls == ["a", "b"]
+        now[0] = 60
+        assert tpl({"count": self.count}).render() == "<div>ab</div>"
+        assert self.calls == ["a", "b", "a"]
+
+    def test_templates_dont_share_fragments(self):
+        cache = LRUCache()
+        tpl1 = XMLTemplate('<div py:cache="1">one</div>', fragment_cache=cache)
+        tpl2 = XMLTemplate('<div py:cache="1">two</div>', fragment_cache=cache)
+        assert tpl1().render() == "<div>one</div>"
+        assert tpl2().render() == "<div>two</div>"
+
+    def test_accumulate(self):
+        tpl = XMLTemplate(
+            '<ul><li py:for="x in items" py:cache="x">${count(x)}</li></ul>',
+            accumulate=True,
+            fragment_cache=LRUCache(),
+        )
+        rsp = tpl({"items": [1, 2, 1], "count": self.count}).render()
+        assert rsp == "<ul><li>1</li><li>2</li><li>1</li></ul>"
+        assert self.calls == [1, 2]
+
+    def test_async(self):
+        async def fetch(value):
+            await asyncio.sleep(0)
+            return self.count(value)
+
+        async def render(tpl):
+            return "".join([chunk async for chunk in tpl({"items": [1, 1], "fetch": fetch}).render_async()])
+
+        tpl = XMLTemplate(
+            '<ul><li py:for="x in items" py:cache="x">${await fetch(x)}</li></ul>',
+            is_async=True,
+            fragment_cache=LRUCache(),
+        )
+        assert asyncio.run(render(tpl)) == "<ul><li>1</li><li>1</li></ul>"
+        assert self.calls == [1]
+
+    def test_file_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tpl = XMLTemplate('<div py:cache="x">${count(x)}</div>', fragment_cache=FileCache(tmpdir))
+            assert tpl({"x": 1, "count": self.count}).render() == "<div>1</div>"
+            assert tpl({"x": 1, "count": self.count}).render() == "<div>1</div>"
+            assert self.calls == [1]
+
+    def test_modes_dont_share_fragments(self):
+        source = '<div py:cache="1"><br/><input checked="${True}"/></div>'
+        assert XMLTemplate(source, mode="xml")().render() == '<div><br/><input checked="True"/></div>'
+        assert XMLTemplate(source, mode="html")().render() == "<div><br><input checked></div>"
+
+    def test_escapes_dont_share_fragments(self):
+        source = '<div py:cache="1">$x</div>'
+        assert XMLTemplate(source)({"x": "<"}).render() == "<div>&lt;</div>"
+        assert XMLTemplate(source, escape=str.upper)({"x": "a"}).render() == "<div>A</div>"
+
+
+class TestMemoize(TestCase):
+    def setUp(self):
+        self.calls = []
+
+    def count(self, value):
+        self.calls.append(value)
+        return value
+
+    def render(self, tpl):
+        return tpl({"count": self.count, "lt": "<"}).render()
+
+    def test_render_scope(self):
+        tpl = XMLTemplate(
+            """<div><py:def function="icon(name)" py:memoize=""><i class="icon-$name">${count(name)}</i></py:def
+>${icon('a')}${icon('a')}${icon(name='a')}${icon(lt)}</div>"""
+        )
+        expected = '<div><i class="icon-a">a</i><i class="icon-a">a</i><i class="icon-a">a</i>'
+        expected += '<i class="icon-&lt;">&lt;</i></div>'
+        assert self.render(tpl) == expected
+        assert self.calls == ["a", "a", "<"]
+        assert self.render(tpl) == expected
+        assert self.calls == ["a", "a", "<"] * 2
+
+    def test_process_scope(self):
+        tpl = XMLTemplate(
+            """<div><span py:def="badge(n)" py:memoize="process">${count(n)}</span>${badge(1)}${badge(2)}</div>""",
+            accumulate=True,
+        )
+        assert self.render(tpl) == "<div><span>1</span><span>2</span></div>"
+        assert self.render(tpl) == "<div><span>1</span><span>2</span></div>"
+        assert self.calls == [1, 2]
+
+    def test_typed_arguments(self):
+        tpl = XMLTemplate(
+            """<div><py:def function="f(x)" py:memoize="">[${x}]</py:def
+>${f(1)}${f(True)}${f(1.0)}${f(x=1)}${f(x=True)}${f(1)}</div>"""
+        )
+        assert self.render(tpl) == "<div>[1][True][1.0][1][True][1]</div>"
+
+    def test_unhashable_arguments(self):
+        tpl = XMLTemplate(
+            '<div><py:def function="f(x)" py:memoize="">${count(len(x))}</py:def>${f([1])}${f([1])}</div>'
+        )
+        assert self.render(tpl) == "<div>11</div>"
+        assert self.calls == [1, 1]
+
+    def test_async(self):
+        async def fetch(value):
+            await asyncio.sleep(0)
+            return self.count(value)
+
+        async def render(tpl):
+            return "".join([chunk async for chunk in tpl({"fetch": fetch}).render_async()])
+
+        tpl = XMLTemplate(
+            """<div><py:def function="f(x)" py:memoize="">${await fetch(x)}</py:def>${f(1)}${f(1)}</div>""",
+            is_async=True,
+        )
+        assert asyncio.run(render(tpl)) == "<div>11</div>"
+        assert self.calls == [1]
+
+    def test_invalid(self):
+        with pytest.raises(XMLTemplateCompileError, match="py:memoize"):
+            XMLTemplate('<div><py:def function="f()" py:memoize="forever">x</py:def></div>')
+        with pytest.raises(XMLTemplateCompileError, match="py:memoize"):
+            XMLTemplate('<div py:def="f()"><py:def function="g()" py:memoize="">x</py:def>${g()}</div>')